@@ -0,0 +1,98 @@
+""" Load test of the routines endpoints against a local redis-server
+
+Fill the profiles databases with random routines, then request /routines/{user_id}
+from concurrent clients and show the latency percentiles.
+
+    redis-server --port 6379 &
+    python benchmarks/load_test_routines.py --users 10000 --clients 64
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+
+"""
+import argparse
+import asyncio
+import random
+import time
+from typing import List
+
+import httpx  # type: ignore
+import numpy as np
+
+from personal_context_builder import config
+from personal_context_builder.wenet_fastapi_app import app
+from personal_context_builder.wenet_user_profile_db import (
+    AsyncDatabaseProfileHandler,
+    DatabaseProfileHandler,
+)
+
+
+def fill_databases(host: str, port: int, nb_users: int, profile_size: int):
+    """write random profiles for all the models"""
+    user_ids = [f"load_test_user_{i}" for i in range(nb_users)]
+    for db_index in config.MAP_DB_TO_MODEL.keys():
+        handler = DatabaseProfileHandler(
+            db_index=db_index, host=host, port=port, use_fake=False
+        )
+        for start in range(0, nb_users, config.PCB_PROFILES_BATCH_SIZE):
+            batch = user_ids[start : start + config.PCB_PROFILES_BATCH_SIZE]
+            handler.set_profiles(
+                batch, np.random.random((len(batch), profile_size)).tolist()
+            )
+
+
+async def client(
+    http_client: httpx.AsyncClient, nb_requests: int, nb_users: int
+) -> List[float]:
+    """request random users one after the other, give the latencies in seconds"""
+    latencies = []
+    for _ in range(nb_requests):
+        user_id = f"load_test_user_{random.randrange(nb_users)}"
+        start = time.perf_counter()
+        response = await http_client.get(f"/routines/{user_id}")
+        latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+    return latencies
+
+
+async def load_test(nb_clients: int, nb_requests: int, nb_users: int) -> List[float]:
+    """run the concurrent clients against the app, in the same event loop"""
+    async with httpx.AsyncClient(app=app, base_url="http://load-test") as http_client:
+        results = await asyncio.gather(
+            *[client(http_client, nb_requests, nb_users) for _ in range(nb_clients)]
+        )
+    return [latency for latencies in results for latency in latencies]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of /routines/{user_id}")
+    parser.add_argument("--host", default="localhost", help="redis host")
+    parser.add_argument("--port", default=6379, type=int, help="redis port")
+    parser.add_argument("--users", default=10000, type=int, help="number of users")
+    parser.add_argument(
+        "--profile_size", default=1392, type=int, help="size of the profiles"
+    )
+    parser.add_argument(
+        "--clients", default=64, type=int, help="number of concurrent clients"
+    )
+    parser.add_argument(
+        "--requests", default=200, type=int, help="number of requests per client"
+    )
+    parser.add_argument(
+        "--no_fill", help="use the profiles already in redis", action="store_true"
+    )
+    args = parser.parse_args()
+    if not args.no_fill:
+        fill_databases(args.host, args.port, args.users, args.profile_size)
+    config.PCB_MOCK_DATABASEHANDLER = False
+    for db_index in config.MAP_DB_TO_MODEL.keys():
+        AsyncDatabaseProfileHandler.get_instance(
+            db_index=db_index, host=args.host, port=args.port, use_fake=False
+        )
+    start = time.perf_counter()
+    latencies = asyncio.run(load_test(args.clients, args.requests, args.users))
+    duration = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    print(f"{len(latencies)} requests with {args.clients} clients in {duration:.1f}s")
+    print(f"{len(latencies) / duration:.0f} requests/s")
+    print(f"latency p50 {p50:.1f}ms, p95 {p95:.1f}ms, p99 {p99:.1f}ms")
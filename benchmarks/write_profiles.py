@@ -0,0 +1,118 @@
+""" Benchmark of the writes of the profiles, one by one or through a ProfilesSink
+
+Write random profiles for many users and show the number of round-trips to Redis and
+the duration. Runs against fakeredis, or a local redis-server with --redis
+
+    redis-server --port 6379 &
+    python benchmarks/write_profiles.py --users 10000 --chunk_size 500 --redis
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+
+"""
+import argparse
+import time
+from typing import Any, List, Tuple
+
+import numpy as np
+
+from personal_context_builder.wenet_profiles_writer import ProfilesSink
+from personal_context_builder.wenet_user_profile_db import DatabaseProfileHandler
+
+
+def count_round_trips(server: Any) -> List[int]:
+    """count the commands and pipelines sent by a redis client
+
+    Args:
+        server: redis client, patched in place
+
+    Return:
+        list with the number of round-trips, updated by the client
+    """
+    round_trips = [0]
+    execute_command = server.execute_command
+    pipeline = server.pipeline
+
+    def counted_execute_command(*args, **kwargs):
+        round_trips[0] += 1
+        return execute_command(*args, **kwargs)
+
+    def counted_pipeline(*args, **kwargs):
+        new_pipeline = pipeline(*args, **kwargs)
+        execute = new_pipeline.execute
+
+        def counted_execute(*execute_args, **execute_kwargs):
+            round_trips[0] += 1
+            return execute(*execute_args, **execute_kwargs)
+
+        new_pipeline.execute = counted_execute
+        return new_pipeline
+
+    server.execute_command = counted_execute_command
+    server.pipeline = counted_pipeline
+    return round_trips
+
+
+def write_one_by_one(
+    database: DatabaseProfileHandler, user_ids: List[str], profiles: np.ndarray
+) -> Tuple[int, float]:
+    """write each profile with set_profile, give the round-trips and the duration"""
+    round_trips = count_round_trips(database._server)
+    start = time.perf_counter()
+    for user_id, profile in zip(user_ids, profiles.tolist()):
+        database.set_profile(user_id, profile)
+    return round_trips[0], time.perf_counter() - start
+
+
+def write_with_sink(
+    database: DatabaseProfileHandler,
+    user_ids: List[str],
+    profiles: np.ndarray,
+    chunk_size: int,
+) -> Tuple[int, float]:
+    """write the profiles through a ProfilesSink, give the round-trips and the duration"""
+    round_trips = count_round_trips(database._server)
+    start = time.perf_counter()
+    with ProfilesSink(database, chunk_size=chunk_size) as sink:
+        for user_id, profile in zip(user_ids, profiles.tolist()):
+            sink.add(user_id, profile)
+    return round_trips[0], time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the profiles writes")
+    parser.add_argument(
+        "--redis", help="use a redis-server instead of fakeredis", action="store_true"
+    )
+    parser.add_argument("--host", default="localhost", help="redis host")
+    parser.add_argument("--port", default=6379, type=int, help="redis port")
+    parser.add_argument("--db", default=15, type=int, help="redis db, it is flushed")
+    parser.add_argument("--users", default=10000, type=int, help="number of users")
+    parser.add_argument(
+        "--profile_size", default=1392, type=int, help="size of the profiles"
+    )
+    parser.add_argument(
+        "--chunk_size", default=500, type=int, help="profiles written at once"
+    )
+    args = parser.parse_args()
+    user_ids = [f"benchmark_user_{i}" for i in range(args.users)]
+    profiles = np.random.random((args.users, args.profile_size))
+    for name, write in [
+        ("set_profile", write_one_by_one),
+        (
+            f"ProfilesSink({args.chunk_size})",
+            lambda database, user_ids, profiles: write_with_sink(
+                database, user_ids, profiles, args.chunk_size
+            ),
+        ),
+    ]:
+        database = DatabaseProfileHandler(
+            db_index=args.db, host=args.host, port=args.port, use_fake=not args.redis
+        )
+        database.clean_db()
+        round_trips, duration = write(database, user_ids, profiles)
+        print(
+            f"{name}: {round_trips} round-trips for {args.users} users, "
+            f"{round_trips * 10000 / args.users:.0f} per 10k users, {duration:.2f}s"
+        )
+        database.clean_db()
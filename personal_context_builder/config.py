@@ -36,6 +36,18 @@ PCB_PROFILE_MANAGER_LIMIT = 1000000
 PCB_STREAMBASE_BATCH_URL = "https://wenet.u-hopper.com/{}/streambase/data"
 PCB_USER_LOCATION_URL = "https://lab.idiap.ch/devel/hub/wenet/users_locations/"
 #  PCB_STREAMBASE_BATCH_URL = "https://wenet.u-hopper.com/{}/api/common/data/"
+# number of concurrent requests to StreamBase
+PCB_STREAMBASE_MAX_WORKERS = 8
+# maximum requests per second to each StreamBase host, 0 for no limit
+PCB_STREAMBASE_RATE_LIMIT = 0.0
+# failed requests to StreamBase are retried after PCB_STREAMBASE_BACKOFF_S, doubled each time
+PCB_STREAMBASE_MAX_RETRY = 3
+PCB_STREAMBASE_BACKOFF_S = 1.0
+PCB_STREAMBASE_TIMEOUT_S = 60.0
+# if true, the StreamBase loaders load each user when first asked instead of all at start
+PCB_STREAMBASE_LAZY = False
+# in lazy mode, how many next users are loaded in background
+PCB_STREAMBASE_PREFETCH = 8
 # How many hours before re-updating the profiles with the semantic routines
 
 PCB_GENERATOR_START_URL = "http://streambase4.disi.unitn.it:8190/generator/start"
@@ -63,6 +75,11 @@ PCB_STAYPOINTS_DISTANCE_MAX_M = 200
 PCB_STAYREGION_DISTANCE_THRESHOLD_M = 200
 PCB_STAYREGION_INC_DELTA = 0.000001
 
+# size (degrees) of the cells of the grid used to index the stay regions
+PCB_REGIONS_INDEX_CELL_DEG = 0.005
+# regions over more cells than this (or with invalid bounds) are tested against every location
+PCB_REGIONS_INDEX_MAX_CELLS = 1000
+
 PCB_USERPLACE_TIME_MAX_DELTA_MS = 5 * 60 * 1000
 PCB_USERPLACE_STAY_POINT_SAMPLING = 5 * 60 * 1000
 
@@ -76,9 +93,36 @@ PCB_VIRTUAL_HOST_LOCATION = ""
 
 PCB_REDIS_HOST = "wenet-redis"
 PCB_REDIS_PORT = 6379
+# size of the connection pool of the asyncio redis clients
+PCB_REDIS_MAX_CONNECTIONS = 50
+# how the profiles are written: "json", "float32" or "float16", see the README before changing it
+PCB_PROFILE_ENCODING = "json"
+# number of profiles retrieved at once (SCAN COUNT + MGET)
+PCB_PROFILES_BATCH_SIZE = 1000
+# maximum number of users in a request to /routines/batch
+PCB_ROUTINES_BATCH_MAX_USERS = 1000
+# the similarity indexes use HNSW from this number of routines (if hnswlib is installed)
+PCB_SIMILARITY_INDEX_HNSW_MIN_SIZE = 10000
+# size of the candidates list of the HNSW queries (higher is slower but more accurate)
+PCB_SIMILARITY_INDEX_HNSW_EF = 100
 
 PCB_REALTIME_REDIS_HOST = "wenet-realtime-redis"
 PCB_REALTIME_REDIS_PORT = 6379
+# first radius of the GEO search of the closest users, doubled until enough users
+PCB_CLOSEST_USERS_RADIUS_M = 5000.0
+# the GEO index of the closest users is built again after this time (seconds), to see
+# the locations written by the real-time service
+PCB_CLOSEST_USERS_GEO_INDEX_TTL_S = 60
+# db of the real-time Redis with the GEO index of the closest users, the real-time
+# service only uses the db 0
+PCB_CLOSEST_USERS_GEO_INDEX_DB = 1
+# number of real-time locations retrieved at once (SCAN COUNT + MGET)
+PCB_REALTIME_BATCH_SIZE = 1000
+# fake population of the mocked real-time locations (generated once per process)
+PCB_MOCK_REALTIME_NB_USERS = 3000
+PCB_MOCK_REALTIME_SEED = 0
+PCB_MOCK_REALTIME_CENTER_LAT = 46.07
+PCB_MOCK_REALTIME_CENTER_LNG = 11.12
 
 PCB_WENET_API_HOST = "wenet-api"
 
@@ -90,6 +134,29 @@ PCB_REDIS_DATABASE_MODEL_2 = "SimpleHDP:PipelineWithCorpus"
 
 PCB_REGION_MAPPING_FILE = "wenet_regions_mapping.json"
 
+# how many processes are used to vectorize the users during training, 1 to disable
+PCB_TRAIN_WORKERS = 1
+# if not empty, the training matrix is spilled to this .npy file in PCB_DATA_FOLDER
+PCB_TRAIN_MATRIX_FILE = ""
+# comma separated pipelines (e.g. "PipelineBOW") that use sparse CSR day vectors
+PCB_SPARSE_PIPELINES = ""
+# SQLite file in PCB_DATA_FOLDER that caches the features of the users, empty to disable
+PCB_FEATURES_CACHE_FILE = ""
+# maximum size of the cached features in MB, least recently used are evicted first
+PCB_FEATURES_CACHE_MAX_MB = 512.0
+# SQLite file in PCB_DATA_FOLDER that stores the data of StreamBase, so that only the new
+# records are requested at each run, empty to disable
+PCB_STREAMBASE_STORE_FILE = ""
+# if true, the profiles are updated with the new days only (running sums per user)
+PCB_PROFILES_INCREMENTAL = False
+# file in PCB_DATA_FOLDER with the state of the incremental profiles
+PCB_PROFILES_STATE_FILE = "_profiles_state.p"
+# the incremental state of a user (stay regions and days) is built again after this
+# number of runs, to follow the changes of its stay regions
+PCB_PROFILES_INCREMENTAL_MAX_RUNS = 7
+# number of profiles written at once in the db by the profiles writer
+PCB_PROFILES_WRITE_CHUNK_SIZE = 500
+
 PCB_DATA_FOLDER = "."
 
 # Shouldn't be used
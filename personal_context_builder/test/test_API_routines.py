@@ -3,19 +3,23 @@
 Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
 Written by William Droz <william.droz@idiap.ch>,
 """
+import json
 import unittest
+from unittest import mock
 from uuid import uuid4
 
 from fastapi.testclient import TestClient  # type: ignore
 
 from personal_context_builder import config
 from personal_context_builder.wenet_cli_entrypoint import train, update
-from personal_context_builder.wenet_fastapi_app import app
+from personal_context_builder.wenet_fastapi_app import NEXT_CURSOR_HEADER, app
 
 train(is_mock=True)
 update(is_mock=True)
 
 
+#  the routines were written in the mocked databases
+@mock.patch.object(config, "PCB_MOCK_DATABASEHANDLER", True)
 class APIRoutinesTestCase(unittest.TestCase):
     def setUp(self):
         self.client = TestClient(app)
@@ -38,3 +42,50 @@ class APIRoutinesTestCase(unittest.TestCase):
             config.PCB_VIRTUAL_HOST_LOCATION + "/routines/mock_user_1"
         )
         self.assertIn("mock_user_1", response.json().get("SimpleLDA:PipelineBOW"))
+
+    def test_routines_pages_same_as_all(self):
+        url = config.PCB_VIRTUAL_HOST_LOCATION + "/routines/"
+        expected = self.client.get(url).json()
+        res = dict()
+        response = self.client.get(url + "?limit=2")
+        while True:
+            for model_name, routines in response.json().items():
+                res.setdefault(model_name, dict()).update(routines)
+            cursor = response.headers.get(NEXT_CURSOR_HEADER)
+            if cursor is None:
+                break
+            response = self.client.get(url, params={"limit": 2, "cursor": cursor})
+        self.assertEqual(expected, res)
+
+    def test_routines_invalid_cursor(self):
+        response = self.client.get(
+            config.PCB_VIRTUAL_HOST_LOCATION + "/routines/?cursor=abc"
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_routines_stream(self):
+        url = config.PCB_VIRTUAL_HOST_LOCATION + "/routines/"
+        expected = self.client.get(url).json()
+        response = self.client.get(url + "?stream=true")
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual(len(lines), sum(len(r) for r in expected.values()))
+        for line in lines:
+            self.assertEqual(expected[line["model"]][line["user_id"]], line["routine"])
+
+    def test_routines_batch(self):
+        url = config.PCB_VIRTUAL_HOST_LOCATION + "/routines/"
+        expected = self.client.get(url + "mock_user_1").json()
+        response = self.client.post(
+            url + "batch", json={"user_ids": ["mock_user_1", "not_a_user"]}
+        )
+        self.assertEqual(response.json(), expected)
+
+    def test_similar_routines(self):
+        url = config.PCB_VIRTUAL_HOST_LOCATION + "/similar_routines/"
+        response = self.client.get(url + "mock_user_1/SimpleLDA:PipelineBOW?k=2")
+        res = response.json()
+        self.assertEqual(len(res), 2)
+        self.assertNotIn("mock_user_1", res)
+        self.assertEqual(list(res.values()), sorted(res.values()))
+        response = self.client.get(url + "not_a_user/SimpleLDA:PipelineBOW")
+        self.assertEqual(response.status_code, 404)
@@ -8,6 +8,7 @@ import unittest
 from os import remove
 from os.path import join
 
+import numpy as np
 from regions_builder.algorithms import estimate_stay_points  # type: ignore
 from regions_builder.algorithms import estimate_stay_regions, labelize_stay_region
 from regions_builder.data_loading import (  # type: ignore
@@ -19,6 +20,49 @@ from personal_context_builder import config
 from personal_context_builder.wenet_analysis import BagOfWordsVectorizer
 
 
+def _reference_vectorize(vectorizer, locations):
+    """one location at a time, region after region"""
+    mapping = vectorizer._regions_mapping
+    big_vector = []
+    for location in locations:
+        current_vector = [0] * vectorizer._inner_vector_size
+        if location is None or np.isnan(location._lat):
+            current_vector[mapping["no_data"]] = 1
+        else:
+            is_in_region = False
+            for region in vectorizer._labelled_stay_regions:
+                if location in region:
+                    label = mapping.get(
+                        region._label, mapping["unknown_labelled_region"]
+                    )
+                    current_vector[label] = 1
+                    is_in_region = True
+                    break
+            for region in vectorizer._stay_regions:
+                if location in region:
+                    current_vector[mapping["unknown_region"]] = 1
+                    is_in_region = True
+                    break
+            if not is_in_region:
+                current_vector[mapping["unknown"]] = 1
+        big_vector += current_vector
+    return big_vector
+
+
+def _create_vectorizer(user_id):
+    source_locations = MockWenetSourceLocations()
+    source_labels = MockWenetSourceLabels(source_locations)
+    stay_points = estimate_stay_points(source_locations.get_locations(user_id))
+    stay_regions = estimate_stay_regions(stay_points)
+    user_places = source_labels.get_labels(user_id)
+    labelled_stay_regions = labelize_stay_region(stay_regions, user_places)
+    stay_regions = list(set(stay_regions) - set(labelled_stay_regions))
+    return (
+        BagOfWordsVectorizer(labelled_stay_regions, stay_regions),
+        source_locations.get_locations(user_id),
+    )
+
+
 class BagOfWordsVectorizerTestCase(unittest.TestCase):
     def test_save_load(self):
         source_locations = MockWenetSourceLocations()
@@ -51,6 +95,24 @@ class BagOfWordsVectorizerTestCase(unittest.TestCase):
         vector = vectorizer.vectorize(first_day)
         self.assertEqual(sum(vector), 48)
 
+    def test_vectorize_same_as_reference(self):
+        vectorizer, locations = _create_vectorizer("mock_user_1")
+        days_locations = BagOfWordsVectorizer.group_by_days(locations, "mock_user_1")
+        for day in days_locations:
+            self.assertEqual(
+                vectorizer.vectorize(day), _reference_vectorize(vectorizer, day)
+            )
+
+    def test_vectorize_array_all_days(self):
+        vectorizer, locations = _create_vectorizer("mock_user_1")
+        days_locations = BagOfWordsVectorizer.group_by_days(locations, "mock_user_1")
+        lats = np.array([[l._lat for l in day] for day in days_locations])
+        lngs = np.array([[l._lng for l in day] for day in days_locations])
+        vectors = vectorizer.vectorize_array(lats, lngs)
+        self.assertEqual(vectors.shape[0], len(days_locations))
+        for vector, day in zip(vectors, days_locations):
+            self.assertEqual(vector.tolist(), _reference_vectorize(vectorizer, day))
+
     def test_group_by_days(self):
         locations = MockWenetSourceLocations._create_fake_locations("test_user", 10)
         days_locations = BagOfWordsVectorizer.group_by_days(
@@ -59,6 +121,17 @@ class BagOfWordsVectorizerTestCase(unittest.TestCase):
         first_day = days_locations[0]
         self.assertEqual(len(first_day), 48)
 
+    def test_group_by_days_array(self):
+        locations = MockWenetSourceLocations._create_fake_locations("test_user", 10)
+        days, slots = BagOfWordsVectorizer.group_by_days_array(
+            locations, start_day="00:00:00", dt_hours=23.5, freq="30T"
+        )
+        days_locations = BagOfWordsVectorizer.group_by_days(locations, "test_user")
+        self.assertEqual(slots.shape, (len(days_locations), 48, 3))
+        self.assertEqual(len(days), len(days_locations))
+        lats = np.array([[l._lat for l in day] for day in days_locations])
+        np.testing.assert_array_equal(slots[:, :, 0], lats)
+
 
 if __name__ == "__main__":  # pragma: no cover
     unittest.main()
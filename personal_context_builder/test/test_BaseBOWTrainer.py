@@ -5,6 +5,8 @@ Written by William Droz <william.droz@idiap.ch>,
 """
 
 import unittest
+from os import remove
+from os.path import join
 
 from regions_builder.data_loading import (  # type: ignore
     MockWenetSourceLabels,
@@ -42,6 +44,36 @@ class BagOfWordsVectorizerTestCase(unittest.TestCase):
         )
         self.assertEqual(vectors.shape, (nb_users, vectors_size))
 
+    def test_vectorize_parallel(self):
+        source_locations = MockWenetSourceLocations(nb=20)
+        source_labels = MockWenetSourceLabels(source_locations)
+        vectors = BaseBOWTrainer(source_locations, source_labels).vectorize()
+        vectors_parallel = BaseBOWTrainer(
+            source_locations, source_labels, workers=2
+        ).vectorize()
+        self.assertTrue((vectors == vectors_parallel).all())
+
+    def test_vectorize_sparse(self):
+        source_locations = MockWenetSourceLocations(nb=20)
+        source_labels = MockWenetSourceLabels(source_locations)
+        vectors = BaseBOWTrainer(source_locations, source_labels).vectorize()
+        vectors_sparse = BaseBOWTrainer(
+            source_locations, source_labels, sparse=True
+        ).vectorize()
+        self.assertTrue((vectors == vectors_sparse.toarray()).all())
+
+    def test_vectorize_memory_mapped(self):
+        source_locations = MockWenetSourceLocations(nb=20)
+        source_labels = MockWenetSourceLabels(source_locations)
+        vectors = BaseBOWTrainer(source_locations, source_labels).vectorize()
+        filename = "matrix_delete_me.npy"
+        vectors_mapped = BaseBOWTrainer(
+            source_locations, source_labels, matrix_file=filename
+        ).vectorize()
+        self.assertTrue((vectors == vectors_mapped).all())
+        del vectors_mapped
+        remove(join(config.PCB_DATA_FOLDER, filename))
+
 
 if __name__ == "__main__":  # pragma: no cover
     unittest.main()
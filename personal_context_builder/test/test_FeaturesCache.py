@@ -0,0 +1,109 @@
+""" Test for the features cache
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+"""
+
+import unittest
+from os import remove
+from os.path import exists, join
+from unittest import mock
+
+from regions_builder.data_loading import (  # type: ignore
+    MockWenetSourceLabels,
+    MockWenetSourceLocations,
+)
+
+from personal_context_builder import config, wenet_trainer
+from personal_context_builder.wenet_analysis import BagOfWordsVectorizer
+from personal_context_builder.wenet_features_cache import (
+    FeaturesCache,
+    cached_features,
+    fingerprint,
+    stay_parameters,
+)
+from personal_context_builder.wenet_trainer import BaseBOWTrainer
+
+_CACHE_FILE = "test_features_cache.sqlite"
+
+
+class FeaturesCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self._previous_file = config.PCB_FEATURES_CACHE_FILE
+        config.PCB_FEATURES_CACHE_FILE = _CACHE_FILE
+        FeaturesCache._INSTANCE = None
+
+    def tearDown(self):
+        config.PCB_FEATURES_CACHE_FILE = self._previous_file
+        FeaturesCache._INSTANCE = None
+        location = join(config.PCB_DATA_FOLDER, _CACHE_FILE)
+        if exists(location):
+            remove(location)
+
+    def test_fingerprint(self):
+        locations = MockWenetSourceLocations._create_fake_locations("user", 20)
+        self.assertEqual(fingerprint(locations), fingerprint(list(locations)))
+        self.assertNotEqual(fingerprint(locations), fingerprint(locations[1:]))
+        self.assertNotEqual(
+            fingerprint(locations), fingerprint(locations, parameters=(False,))
+        )
+
+    def test_cached_features(self):
+        locations = MockWenetSourceLocations._create_fake_locations("user", 20)
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return [1, 2, 3]
+
+        self.assertEqual(cached_features("user", "test", compute, locations), [1, 2, 3])
+        self.assertEqual(cached_features("user", "test", compute, locations), [1, 2, 3])
+        self.assertEqual(len(calls), 1)
+        cached_features("user", "test", compute, locations[1:])
+        self.assertEqual(len(calls), 2)
+
+    def test_stay_parameters_in_fingerprint(self):
+        locations = MockWenetSourceLocations._create_fake_locations("user", 20)
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return [1, 2, 3]
+
+        cached_features("user", "test", compute, locations, None, stay_parameters())
+        with mock.patch.object(config, "PCB_STAYREGION_DISTANCE_THRESHOLD_M", 50):
+            cached_features("user", "test", compute, locations, None, stay_parameters())
+        cached_features("user", "test", compute, locations, None, stay_parameters())
+        self.assertEqual(len(calls), 2)
+
+    def test_evict_least_recently_used(self):
+        cache = FeaturesCache(_CACHE_FILE, max_size_mb=2.5)
+        value = b"0" * 1024 * 1024
+        cache.set("user1", "test", "a", value)
+        cache.set("user2", "test", "a", value)
+        self.assertIsNotNone(cache.get("user1", "test", "a"))
+        cache.set("user3", "test", "a", value)
+        self.assertIsNotNone(cache.get("user1", "test", "a"))
+        self.assertIsNone(cache.get("user2", "test", "a"))
+        self.assertIsNotNone(cache.get("user3", "test", "a"))
+
+    def test_vectorize_with_cache(self):
+        source_locations = MockWenetSourceLocations(nb=20)
+        source_labels = MockWenetSourceLabels(source_locations)
+        bow_trainer = BaseBOWTrainer(source_locations, source_labels)
+        with mock.patch.object(
+            wenet_trainer, "_estimate_regions", wraps=wenet_trainer._estimate_regions
+        ) as estimate_regions, mock.patch.object(
+            BagOfWordsVectorizer,
+            "group_by_days_array",
+            wraps=BagOfWordsVectorizer.group_by_days_array,
+        ) as group_by_days_array:
+            vectors = bow_trainer.vectorize()
+            self.assertGreater(estimate_regions.call_count, 0)
+            self.assertGreater(group_by_days_array.call_count, 0)
+            estimate_regions.reset_mock()
+            group_by_days_array.reset_mock()
+            vectors_cached = bow_trainer.vectorize()
+            self.assertEqual(estimate_regions.call_count, 0)
+            self.assertEqual(group_by_days_array.call_count, 0)
+        self.assertTrue((vectors == vectors_cached).all())
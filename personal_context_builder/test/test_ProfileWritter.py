@@ -0,0 +1,282 @@
+""" Test for the profiles writer
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+"""
+
+import unittest
+from unittest import mock
+
+import fakeredis  # type: ignore
+import numpy as np
+
+from regions_builder.data_loading import (  # type: ignore
+    MockWenetSourceLabels,
+    MockWenetSourceLocations,
+)
+
+from personal_context_builder.wenet_analysis_models import SimpleBOW
+from personal_context_builder.wenet_profiles_writer import (
+    ProfilesSink,
+    ProfileWritter,
+    ProfileWritterMultiModels,
+)
+from personal_context_builder.wenet_trainer import BaseBOWTrainer, _estimate_regions
+from personal_context_builder.wenet_user_profile_db import (
+    DatabaseProfileHandler,
+    DatabaseProfileHandlerMock,
+)
+
+
+class _CountingRedis(fakeredis.FakeRedis):
+    """fake redis that counts the round-trips to the server"""
+
+    round_trips = 0
+
+    def execute_command(self, *args, **kwargs):
+        self.round_trips += 1
+        return super().execute_command(*args, **kwargs)
+
+    def pipeline(self, *args, **kwargs):
+        pipeline = super().pipeline(*args, **kwargs)
+        execute = pipeline.execute
+
+        def counted_execute(*execute_args, **execute_kwargs):
+            self.round_trips += 1
+            return execute(*execute_args, **execute_kwargs)
+
+        pipeline.execute = counted_execute
+        return pipeline
+
+
+class _WindowLocations(object):
+    """source of locations that gives only the locations after date_from"""
+
+    def __init__(self, source_locations):
+        self._source_locations = source_locations
+        self.date_from = None
+
+    def _in_window(self, locations):
+        if self.date_from is None:
+            return locations
+        return [
+            location
+            for location in locations
+            if np.datetime64(location._pts_t, "ns") >= self.date_from
+        ]
+
+    def get_users(self):
+        return self._source_locations.get_users()
+
+    def get_locations(self, user_id):
+        return self._in_window(self._source_locations.get_locations(user_id))
+
+    def get_locations_all_users(self):
+        return {
+            user: self._in_window(locations)
+            for user, locations in self._source_locations.get_locations_all_users().items()
+        }
+
+
+class ProfileWritterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.source_locations = MockWenetSourceLocations()
+        self.source_labels = MockWenetSourceLabels(self.source_locations)
+        self.bow_trainer = BaseBOWTrainer(self.source_locations, self.source_labels)
+        self.db_single = DatabaseProfileHandlerMock(db_index=13)
+        self.db_multi_1 = DatabaseProfileHandlerMock(db_index=14)
+        self.db_multi_2 = DatabaseProfileHandlerMock(db_index=15)
+
+    def test_multi_models_same_as_single(self):
+        ProfileWritter(
+            self.source_locations,
+            self.source_labels,
+            SimpleBOW(),
+            self.bow_trainer,
+            self.db_single,
+        ).update_profiles()
+        ProfileWritterMultiModels(
+            self.source_locations,
+            self.source_labels,
+            [(SimpleBOW(), self.db_multi_1), (SimpleBOW(), self.db_multi_2)],
+            self.bow_trainer,
+        ).update_profiles()
+        expected = self.db_single.get_all_profiles()
+        self.assertGreater(len(expected), 0)
+        self.assertEqual(expected, self.db_multi_1.get_all_profiles())
+        self.assertEqual(expected, self.db_multi_2.get_all_profiles())
+
+    def test_incremental_same_as_full(self):
+        state_file = "test_profiles_state.p"
+        ProfileWritter.clean_state(state_file)
+        ProfileWritter(
+            self.source_locations,
+            self.source_labels,
+            SimpleBOW(),
+            self.bow_trainer,
+            self.db_single,
+        ).update_profiles()
+        expected = self.db_single.get_all_profiles()
+        for _ in range(2):
+            ProfileWritter(
+                self.source_locations,
+                self.source_labels,
+                SimpleBOW(),
+                self.bow_trainer,
+                self.db_multi_1,
+                incremental=True,
+                state_file=state_file,
+            ).update_profiles()
+            profiles = self.db_multi_1.get_all_profiles()
+            self.assertEqual(set(expected.keys()), set(profiles.keys()))
+            for user, profile in expected.items():
+                self.assertTrue(np.allclose(profile, profiles[user]))
+        state = ProfileWritter.load_state(state_file)
+        self.assertEqual(set(state.keys()), set(expected.keys()))
+        ProfileWritter.clean_state(state_file)
+
+    def test_incremental_keeps_regions(self):
+        state_file = "test_profiles_state.p"
+        ProfileWritter.clean_state(state_file)
+
+        def writter():
+            return ProfileWritter(
+                self.source_locations,
+                self.source_labels,
+                SimpleBOW(),
+                self.bow_trainer,
+                self.db_multi_1,
+                incremental=True,
+                state_file=state_file,
+            )
+
+        writter().update_profiles()
+        state = ProfileWritter.load_state(state_file)
+        with mock.patch.object(
+            self.bow_trainer, "train", side_effect=AssertionError
+        ), mock.patch.object(
+            self.bow_trainer, "user_regions", side_effect=AssertionError
+        ), mock.patch.object(
+            self.bow_trainer,
+            "vectorize_with_regions",
+            wraps=self.bow_trainer.vectorize_with_regions,
+        ) as vectorize_with_regions:
+            writter().update_profiles()
+        self.assertEqual(len(vectorize_with_regions.call_args_list), len(state))
+        nb_new_locations = sum(
+            len(locations)
+            for (_, locations), _ in vectorize_with_regions.call_args_list
+        )
+        nb_locations = sum(
+            len(locations)
+            for locations in self.source_locations.get_locations_all_users().values()
+        )
+        self.assertLess(nb_new_locations, nb_locations)
+        ProfileWritter.clean_state(state_file)
+
+    def test_incremental_after_window_moves(self):
+        state_file = "test_profiles_state.p"
+        ProfileWritter.clean_state(state_file)
+        all_locations = self.source_locations.get_locations_all_users()
+        regions = dict()
+
+        #  same stay regions for the incremental and the full profiles
+        def fixed_regions(user_id, locations, user_places):
+            if user_id not in regions:
+                regions[user_id] = _estimate_regions(
+                    all_locations[user_id], user_places
+                )
+            return regions[user_id]
+
+        source_locations = _WindowLocations(self.source_locations)
+        bow_trainer = BaseBOWTrainer(source_locations, self.source_labels)
+
+        def writter(database, incremental):
+            return ProfileWritter(
+                source_locations,
+                self.source_labels,
+                SimpleBOW(),
+                bow_trainer,
+                database,
+                incremental=incremental,
+                state_file=state_file,
+            )
+
+        with mock.patch.object(
+            BaseBOWTrainer, "_user_regions", staticmethod(fixed_regions)
+        ):
+            writter(self.db_multi_1, True).update_profiles()
+            oldest_day = min(
+                np.datetime64(location._pts_t, "D")
+                for locations in all_locations.values()
+                for location in locations
+            )
+            source_locations.date_from = np.datetime64(
+                oldest_day + np.timedelta64(3, "D"), "ns"
+            )
+            writter(self.db_multi_1, True).update_profiles()
+            writter(self.db_multi_2, False).update_profiles()
+        state = ProfileWritter.load_state(state_file)
+        for days_outputs, _, _ in state.values():
+            for day in days_outputs.keys():
+                self.assertGreaterEqual(day, source_locations.date_from)
+        expected = self.db_multi_2.get_all_profiles()
+        profiles = self.db_multi_1.get_all_profiles()
+        self.assertGreater(len(expected), 0)
+        for user, profile in expected.items():
+            self.assertTrue(np.allclose(profile, profiles[user]))
+        ProfileWritter.clean_state(state_file)
+
+    def test_incremental_rebuilt_after_max_runs(self):
+        state_file = "test_profiles_state.p"
+        ProfileWritter.clean_state(state_file)
+        nb_users = len(self.source_locations.get_locations_all_users())
+        with mock.patch.object(
+            self.bow_trainer, "user_regions", wraps=self.bow_trainer.user_regions
+        ) as user_regions:
+            for _ in range(3):
+                ProfileWritter(
+                    self.source_locations,
+                    self.source_labels,
+                    SimpleBOW(),
+                    self.bow_trainer,
+                    self.db_multi_1,
+                    incremental=True,
+                    state_file=state_file,
+                    max_runs=2,
+                ).update_profiles()
+        self.assertEqual(user_regions.call_count, 2 * nb_users)
+        ProfileWritter.clean_state(state_file)
+
+    def test_sink_round_trips(self):
+        nb_users = 10000
+        chunk_size = 500
+        database = DatabaseProfileHandler(use_fake=True)
+        database._server = _CountingRedis()
+        for user in range(nb_users):
+            database.set_profile(f"user_{user}", [0.5, 0.5])
+        self.assertEqual(database._server.round_trips, nb_users)
+        database._server = _CountingRedis()
+        with ProfilesSink(database, chunk_size=chunk_size) as sink:
+            for user in range(nb_users):
+                sink.add(f"user_{user}", [0.5, 0.5])
+        self.assertEqual(database._server.round_trips, nb_users // chunk_size)
+        self.assertEqual(len(database.get_all_profiles()), nb_users)
+
+    def test_writer_flushes_last_chunk(self):
+        ProfileWritter(
+            self.source_locations,
+            self.source_labels,
+            SimpleBOW(),
+            self.bow_trainer,
+            self.db_single,
+            chunk_size=7,
+        ).update_profiles()
+        self.assertEqual(
+            len(self.db_single.get_all_profiles()),
+            len(self.source_locations.get_users()),
+        )
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,124 @@
+""" Test for the spatial index over the stay regions
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+"""
+
+import unittest
+
+import numpy as np
+from regions_builder.algorithms import estimate_stay_points  # type: ignore
+from regions_builder.algorithms import estimate_stay_regions, labelize_stay_region
+from regions_builder.data_loading import (  # type: ignore
+    MockWenetSourceLabels,
+    MockWenetSourceLocations,
+)
+
+from personal_context_builder import config
+from personal_context_builder.wenet_analysis import _loads_regions
+from personal_context_builder.wenet_regions_index import (
+    RegionsIndex,
+    _points_in_bounds,
+    _regions_bounds,
+    _RegionsGrid,
+)
+
+
+class RegionsIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        user_id = "mock_user_1"
+        source_locations = MockWenetSourceLocations()
+        source_labels = MockWenetSourceLabels(source_locations)
+        self.locations = source_locations.get_locations(user_id)
+        stay_points = estimate_stay_points(self.locations)
+        stay_regions = estimate_stay_regions(stay_points)
+        user_places = source_labels.get_labels(user_id)
+        self.labelled_stay_regions = labelize_stay_region(stay_regions, user_places)
+        self.stay_regions = list(set(stay_regions) - set(self.labelled_stay_regions))
+        self.regions_mapping = _loads_regions(config.PCB_REGION_MAPPING_FILE)
+
+    def test_same_as_linear_scan(self):
+        regions_index = RegionsIndex(self.labelled_stay_regions, self.stay_regions)
+        lats = np.array([l._lat for l in self.locations])
+        lngs = np.array([l._lng for l in self.locations])
+        labelled_words, in_stay = regions_index.words(lats, lngs, self.regions_mapping)
+        for location, labelled_word, is_in_stay in zip(
+            self.locations, labelled_words, in_stay
+        ):
+            expected_word = -1
+            for region in self.labelled_stay_regions:
+                if location in region:
+                    expected_word = self.regions_mapping.get(
+                        region._label, self.regions_mapping["unknown_labelled_region"]
+                    )
+                    break
+            self.assertEqual(labelled_word, expected_word)
+            self.assertEqual(
+                is_in_stay, any(location in region for region in self.stay_regions)
+            )
+
+    def test_no_data(self):
+        regions_index = RegionsIndex(self.labelled_stay_regions, self.stay_regions)
+        labelled_words, in_stay = regions_index.words(
+            np.array([np.nan]), np.array([np.nan]), self.regions_mapping
+        )
+        self.assertEqual(labelled_words[0], -1)
+        self.assertFalse(in_stay[0])
+
+    def test_empty_index(self):
+        regions_index = RegionsIndex(None, None)
+        labelled_words, in_stay = regions_index.words(
+            np.array([46.5]), np.array([6.5]), self.regions_mapping
+        )
+        self.assertEqual(labelled_words[0], -1)
+        self.assertFalse(in_stay[0])
+
+
+class _Region(object):
+    def __init__(self, topleft_lat, topleft_lng, bottomright_lat, bottomright_lng):
+        self._topleft_lat = topleft_lat
+        self._topleft_lng = topleft_lng
+        self._bottomright_lat = bottomright_lat
+        self._bottomright_lng = bottomright_lng
+
+
+class RegionsGridTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.lats = 46.5 + rng.random(500) * 0.1
+        self.lngs = 6.5 + rng.random(500) * 0.1
+        self.regions = [
+            _Region(lat + 0.002, lng, lat, lng + 0.002)
+            for lat, lng in zip(self.lats[:20], self.lngs[:20])
+        ]
+
+    def _linear_scan(self, regions):
+        inside = _points_in_bounds(self.lats, self.lngs, _regions_bounds(regions))
+        return np.where(inside.any(axis=1), inside.argmax(axis=1), -1)
+
+    def test_degenerate_regions(self):
+        regions = (
+            self.regions[:5]
+            + [
+                _Region(np.nan, 6.5, 46.5, 6.6),
+                _Region(90.0, -180.0, -90.0, 180.0),
+                _Region(np.inf, -np.inf, -np.inf, np.inf),
+            ]
+            + self.regions[5:]
+        )
+        grid = _RegionsGrid(regions, config.PCB_REGIONS_INDEX_CELL_DEG)
+        self.assertEqual(grid._fallback.tolist(), [5, 6, 7])
+        res = grid.first_region(self.lats, self.lngs)
+        self.assertTrue(np.array_equal(res, self._linear_scan(regions)))
+        self.assertTrue((res <= 6).all())
+
+    def test_max_cells(self):
+        grid = _RegionsGrid(self.regions, config.PCB_REGIONS_INDEX_CELL_DEG, 1)
+        self.assertGreater(len(grid._fallback), 0)
+        self.assertLess(len(grid._fallback), len(self.regions))
+        res = grid.first_region(self.lats, self.lngs)
+        self.assertTrue(np.array_equal(res, self._linear_scan(self.regions)))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
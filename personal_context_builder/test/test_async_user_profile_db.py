@@ -0,0 +1,43 @@
+""" Test for the asyncio user profiles db
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+"""
+
+import unittest
+
+from personal_context_builder.wenet_user_profile_db import (
+    AsyncDatabaseProfileHandler,
+    AsyncDatabaseProfileHandlerMock,
+    DatabaseProfileHandlerMock,
+    encode_profile,
+)
+
+
+class AsyncUserProfileDBTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_get_profiles(self):
+        handler = AsyncDatabaseProfileHandler(use_fake=True)
+        await handler._server.set("test_user_1", encode_profile([0, 1, 0.5]))
+        await handler._server.set("test_user_2", encode_profile([1, 0, 0.5], "json"))
+        self.assertEqual(await handler.get_profile("test_user_1"), [0, 1, 0.5])
+        self.assertIsNone(await handler.get_profile("test_user_3"))
+        self.assertEqual(
+            await handler.get_profiles(["test_user_1", "test_user_3"]),
+            {"test_user_1": [0, 1, 0.5], "test_user_3": None},
+        )
+        res = await handler.get_all_profiles(match="test_*", batch_size=1)
+        self.assertEqual(res, {"test_user_1": [0, 1, 0.5], "test_user_2": [1, 0, 0.5]})
+
+    async def test_mock_same_data(self):
+        DatabaseProfileHandlerMock.get_instance(db_index=12).set_profile(
+            "test_user_1", [0, 1]
+        )
+        handler = AsyncDatabaseProfileHandlerMock.get_instance(db_index=12)
+        self.assertEqual(await handler.get_profile("test_user_1"), [0, 1])
+        DatabaseProfileHandlerMock.get_instance(db_index=12).delete_profile(
+            "test_user_1"
+        )
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
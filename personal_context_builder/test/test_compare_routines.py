@@ -0,0 +1,113 @@
+""" Test for the comparison of the routines
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+"""
+
+import asyncio
+import unittest
+
+import numpy as np
+from scipy import spatial  # type: ignore
+
+from personal_context_builder import config
+from personal_context_builder.wenet_analysis import (
+    compare_routines,
+    compare_routines_async,
+)
+from personal_context_builder.wenet_user_profile_db import (
+    AsyncDatabaseProfileHandlerMock,
+    DatabaseProfileHandlerMock,
+)
+
+_MODEL = "SimpleLDA:PipelineBOW"
+
+
+class CompareRoutinesTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.users = [f"test_compare_{i}" for i in range(20)]
+        self.routines = rng.random((len(self.users), 15)).tolist()
+        self.db = DatabaseProfileHandlerMock.get_instance(
+            db_index=config.MAP_MODEL_TO_DB[_MODEL]
+        )
+        self.db.set_profiles(self.users, self.routines)
+
+    def tearDown(self):
+        for user in self.users:
+            self.db.delete_profile(user)
+
+    def _reference(self, function):
+        res = [
+            (user, function(self.routines[0], routine))
+            for user, routine in zip(self.users[1:], self.routines[1:])
+        ]
+        return sorted(res, key=lambda x: -x[1])
+
+    def test_same_as_scipy(self):
+        for metric, function in [
+            ("cosine", spatial.distance.cosine),
+            ("euclidean", spatial.distance.euclidean),
+            ("dot", np.dot),
+        ]:
+            res = compare_routines(
+                self.users[0], self.users[1:], _MODEL, metric, is_mock=True
+            )
+            expected = self._reference(function)
+            self.assertEqual(list(res.keys()), [user for user, _ in expected])
+            self.assertTrue(
+                np.allclose(list(res.values()), [value for _, value in expected])
+            )
+
+    def test_custom_function(self):
+        function = spatial.distance.cityblock
+        res = compare_routines(
+            self.users[0], self.users[1:], _MODEL, function, is_mock=True
+        )
+        expected = self._reference(function)
+        self.assertEqual(list(res.items()), expected)
+
+    def test_missing_users(self):
+        res = compare_routines(
+            self.users[0], ["not_a_user", self.users[1]], _MODEL, is_mock=True
+        )
+        self.assertEqual(list(res.keys()), [self.users[1]])
+        res = compare_routines(self.users[0], ["not_a_user"], _MODEL, is_mock=True)
+        self.assertEqual(res, dict())
+
+    def test_top_k(self):
+        res = compare_routines(
+            self.users[0], self.users[1:], _MODEL, is_mock=True, top_k=5
+        )
+        closest = [user for user, _ in self._reference(spatial.distance.cosine)][-5:]
+        self.assertEqual(list(res.keys()), closest)
+
+    def test_async_same_as_sync(self):
+        for metric in ["cosine", "euclidean", "dot"]:
+            res = asyncio.run(
+                compare_routines_async(
+                    self.users[0],
+                    self.users[1:] + ["not_a_user"],
+                    _MODEL,
+                    metric,
+                    AsyncDatabaseProfileHandlerMock,
+                    top_k=5,
+                )
+            )
+            expected = compare_routines(
+                self.users[0], self.users[1:], _MODEL, metric, is_mock=True, top_k=5
+            )
+            self.assertEqual(res, expected)
+        res = asyncio.run(
+            compare_routines_async(
+                "not_a_user",
+                self.users,
+                _MODEL,
+                handler_class=AsyncDatabaseProfileHandlerMock,
+            )
+        )
+        self.assertEqual(res, dict())
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,57 @@
+""" Test for the encoding of the profiles in the db
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+"""
+
+import json
+import unittest
+
+import numpy as np
+
+from personal_context_builder.wenet_user_profile_db import (
+    DatabaseProfileHandler,
+    decode_profile,
+    encode_profile,
+    profile_encoding,
+)
+
+
+class ProfileCodecTestCase(unittest.TestCase):
+    def setUp(self):
+        self.vector = [0, 1, 1, 0, 1, 0.5, 0.25]
+
+    def test_binary_round_trip(self):
+        for encoding in ["float32", "float16"]:
+            value = encode_profile(self.vector, encoding)
+            self.assertEqual(profile_encoding(value), encoding)
+            self.assertEqual(decode_profile(value).tolist(), self.vector)
+
+    def test_binary_is_not_copied(self):
+        value = encode_profile(self.vector, "float32")
+        profile = decode_profile(value)
+        self.assertEqual(profile.dtype, np.dtype("<f4"))
+        self.assertFalse(profile.flags.writeable)
+        self.assertEqual(len(value), 8 + 4 * len(self.vector))
+
+    def test_legacy_json(self):
+        value = json.dumps(self.vector).encode("utf-8")
+        self.assertEqual(profile_encoding(value), "json")
+        self.assertEqual(decode_profile(value).tolist(), self.vector)
+
+    def test_unknown_encoding(self):
+        with self.assertRaises(ValueError):
+            encode_profile(self.vector, "float8")
+
+    def test_migrate_profiles(self):
+        database = DatabaseProfileHandler(db_index=14, use_fake=True, encoding="json")
+        database.clean_db()
+        database.set_profiles(["user_1", "user_2"], [self.vector, self.vector])
+        self.assertEqual(database.migrate_profiles("float32"), 2)
+        self.assertEqual(database.migrate_profiles("float32"), 0)
+        self.assertEqual(profile_encoding(database._server.get("user_1")), "float32")
+        self.assertEqual(database.get_profile("user_2"), self.vector)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
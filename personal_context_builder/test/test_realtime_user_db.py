@@ -0,0 +1,183 @@
+""" Test for the real-time locations db
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+"""
+
+import json
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import numpy as np
+import redis  # type: ignore
+from regions_builder.models import UserLocationPoint  # type: ignore
+
+from personal_context_builder.wenet_analysis import closest_users
+from personal_context_builder.wenet_realtime_user_db import (
+    GEO_INDEX_KEY,
+    DatabaseRealtimeLocationsHandler,
+    DatabaseRealtimeLocationsHandlerMock,
+    decode_location,
+    encode_location,
+    fake_users_locations,
+)
+
+
+def _haversine_m(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * 6372797.560856 * np.arcsin(np.sqrt(a))
+
+
+class RealtimeUserDBTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.lats = 46.1 + rng.random(200)
+        self.lngs = 6.5 + rng.random(200)
+        self.users = [f"test_realtime_{i}" for i in range(200)]
+
+    def _locations(self):
+        return [
+            UserLocationPoint(datetime(2021, 6, 1, 12), lat, lng, user=user)
+            for lat, lng, user in zip(self.lats, self.lngs, self.users)
+        ]
+
+    def _expected(self, N):
+        distances = _haversine_m(46.5, 7.0, self.lats, self.lngs)
+        return [self.users[i] for i in np.argsort(distances)[:N]]
+
+    def test_closest_users_mock(self):
+        db = DatabaseRealtimeLocationsHandlerMock()
+        db.update(self._locations())
+        res = db.closest_users(46.5, 7.0, 10)
+        self.assertEqual([location._user for _, location in res], self._expected(10))
+        distances = [distance for distance, _ in res]
+        self.assertEqual(distances, sorted(distances))
+
+    def _geo_db(self):
+        db = DatabaseRealtimeLocationsHandler(use_fake=True)
+        db._server.flushall()
+        if not db.has_geosearch():
+            self.skipTest("this fakeredis has no GEO commands")
+        return db
+
+    def test_closest_users_real(self):
+        db = DatabaseRealtimeLocationsHandler(use_fake=True)
+        db._server.flushall()
+        db.update(self._locations())
+        res = db.closest_users(46.5, 7.0, 10)
+        self.assertEqual([location._user for _, location in res], self._expected(10))
+        self.assertEqual(len(db.get_all_users()), len(self.users))
+        self.assertEqual(len(db.closest_users(0, 0, 500)), len(self.users))
+
+    def test_closest_users_index_refreshed(self):
+        db = self._geo_db()
+        locations = self._locations()
+        db.update(locations[:100])
+        self.assertEqual(len(db.closest_users(46.5, 7.0, 500)), 100)
+        self.assertGreater(db._geo_server.ttl(GEO_INDEX_KEY), 0)
+        #  only the users are in the db of the locations
+        self.assertEqual(len(db._server.keys()), 100)
+        #  written by the real-time service, without the index
+        for location in locations[100:]:
+            db._server.set(location._user, encode_location(location))
+        self.assertEqual(len(db.closest_users(46.5, 7.0, 500)), 100)
+        db._geo_server.expire(GEO_INDEX_KEY, 0)
+        res = db.closest_users(46.5, 7.0, 10)
+        self.assertEqual([location._user for _, location in res], self._expected(10))
+
+    def test_closest_users_out_of_geo_range(self):
+        db = self._geo_db()
+        locations = self._locations()
+        db.update(locations[:10])
+        outside = [
+            UserLocationPoint(datetime(2021, 6, 1, 12), 89.0, 7.0, user="north_pole"),
+            UserLocationPoint(datetime(2021, 6, 1, 12), np.nan, 7.0, user="no_lat"),
+        ]
+        db.update(outside)
+        for location in outside:
+            db._server.set(location._user, encode_location(location))
+        db._geo_server.expire(GEO_INDEX_KEY, 0)
+        res = db.closest_users(46.5, 7.0, 500)
+        self.assertEqual(len(res), 10)
+
+    def test_fake_without_geo_commands(self):
+        db = DatabaseRealtimeLocationsHandler(use_fake=True)
+        db._server.flushall()
+        with mock.patch.object(
+            db._geo_server, "geosearch", side_effect=redis.ResponseError
+        ):
+            self.assertFalse(db.has_geosearch())
+        db.update(self._locations())
+        self.assertEqual(len(db._geo_server.keys()), 0)
+        res = db.closest_users(46.5, 7.0, 10)
+        self.assertEqual([location._user for _, location in res], self._expected(10))
+
+    def test_closest_users_without_geosearch(self):
+        db = DatabaseRealtimeLocationsHandler(use_fake=True)
+        db._server.flushall()
+        db._has_geosearch = False
+        self.assertEqual(db.closest_users(46.5, 7.0, 10), [])
+        db.update(self._locations())
+        res = db.closest_users(46.5, 7.0, 10)
+        self.assertEqual([location._user for _, location in res], self._expected(10))
+        distances = [distance for distance, _ in res]
+        self.assertEqual(distances, sorted(distances))
+
+    def test_location_codec(self):
+        location = UserLocationPoint(
+            datetime(2021, 6, 1, 12, 30, 15, 123456), 46.1, 6.5, user="test_user"
+        )
+        res = decode_location("test_user", encode_location(location))
+        self.assertEqual(vars(res), vars(location))
+        legacy = dict(vars(location), _pts_t="2021-06-01 12:30:15.123456")
+        res = decode_location("test_user", json.dumps(legacy).encode("utf-8"))
+        self.assertEqual(vars(res), vars(location))
+
+    def test_location_codec_unknown_accuracy(self):
+        location = UserLocationPoint(
+            datetime(2021, 6, 1, 12), 46.1, 6.5, accuracy_m=None, user="test_user"
+        )
+        res = decode_location("test_user", encode_location(location))
+        self.assertIsNone(res._accuracy_m)
+        self.assertEqual(vars(res), vars(location))
+
+    def test_get_users_bulk(self):
+        db = DatabaseRealtimeLocationsHandler(use_fake=True)
+        db._server.flushall()
+        db.update(self._locations())
+        res = db.get_users(self.users[:5] + ["not_a_user"], batch_size=2)
+        self.assertEqual(list(res.keys()), self.users[:5])
+        res = db.get_all_users(batch_size=7)
+        self.assertEqual(set(res.keys()), set(self.users))
+        self.assertEqual(res[self.users[0]]._pts_t, datetime(2021, 6, 1, 12))
+
+    def test_fake_users_locations_seeded(self):
+        first = fake_users_locations(100, seed=1)
+        second = fake_users_locations(100, seed=1)
+        self.assertEqual(
+            [vars(location) for location in first],
+            [vars(location) for location in second],
+        )
+        other = fake_users_locations(100, seed=2)
+        self.assertNotEqual(
+            [location._lat for location in first], [location._lat for location in other]
+        )
+
+    def test_mock_closest_users_same_population(self):
+        first = closest_users(46.07, 11.12, 5, is_mock=True)
+        nb_users = len(DatabaseRealtimeLocationsHandlerMock.get_instance()._my_dict)
+        second = closest_users(46.07, 11.12, 5, is_mock=True)
+        self.assertEqual(first, second)
+        self.assertEqual(
+            len(DatabaseRealtimeLocationsHandlerMock.get_instance()._my_dict),
+            nb_users,
+        )
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
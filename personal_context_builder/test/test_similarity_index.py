@@ -0,0 +1,82 @@
+""" Test for the similarity index of the routines
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+"""
+
+import unittest
+from os import remove
+from os.path import join
+
+import numpy as np
+from scipy import spatial  # type: ignore
+
+from personal_context_builder import config
+from personal_context_builder.wenet_similarity_index import (
+    SimilarityIndex,
+    get_similarity_index,
+    refresh_similarity_indexes,
+    similarity_index_filename,
+)
+from personal_context_builder.wenet_user_profile_db import DatabaseProfileHandlerMock
+
+
+class SimilarityIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.users = [f"test_similar_{i}" for i in range(50)]
+        self.routines = rng.random((len(self.users), 15))
+
+    def test_same_as_scipy(self):
+        index = SimilarityIndex(self.users, self.routines)
+        res = index.similar(self.users[0], 5)
+        distances = [
+            (user, spatial.distance.cosine(self.routines[0], routine))
+            for user, routine in zip(self.users[1:], self.routines[1:])
+        ]
+        expected = sorted(distances, key=lambda x: x[1])[:5]
+        self.assertEqual([user for user, _ in res], [user for user, _ in expected])
+        self.assertTrue(
+            np.allclose([d for _, d in res], [d for _, d in expected], atol=1e-5)
+        )
+
+    def test_hnsw_same_as_brute_force(self):
+        index = SimilarityIndex(self.users, self.routines, use_hnsw=True)
+        self.assertIsNotNone(index._hnsw)
+        expected = SimilarityIndex(self.users, self.routines, use_hnsw=False)
+        for user in self.users[:10]:
+            res = index.similar(user, 5)
+            self.assertEqual(
+                [user for user, _ in res],
+                [user for user, _ in expected.similar(user, 5)],
+            )
+        filename = "_test_similarity_index_hnsw.p"
+        index.save(filename)
+        loaded = SimilarityIndex.load(filename)
+        remove(join(config.PCB_DATA_FOLDER, filename))
+        self.assertEqual(
+            loaded.similar(self.users[0], 5), index.similar(self.users[0], 5)
+        )
+
+    def test_k_larger_than_index(self):
+        index = SimilarityIndex(self.users[:3], self.routines[:3])
+        res = index.similar(self.users[0], 10)
+        self.assertEqual(set(user for user, _ in res), set(self.users[1:3]))
+
+    def test_refresh_and_load(self):
+        db = DatabaseProfileHandlerMock.get_instance(db_index=13)
+        db.set_profiles(self.users, self.routines.tolist())
+        refresh_similarity_indexes([13], DatabaseProfileHandlerMock)
+        index = get_similarity_index(13)
+        self.assertEqual(len(index), len(self.users))
+        self.assertEqual(
+            index.similar(self.users[0], 5),
+            SimilarityIndex(self.users, self.routines).similar(self.users[0], 5),
+        )
+        for user in self.users:
+            db.delete_profile(user)
+        remove(join(config.PCB_DATA_FOLDER, similarity_index_filename(13)))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
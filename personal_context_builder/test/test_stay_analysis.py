@@ -0,0 +1,106 @@
+""" Test for the store of the stay points and stay regions shared in a run
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+"""
+
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from regions_builder.models import LocationPoint  # type: ignore
+
+from personal_context_builder import wenet_stay_analysis
+from personal_context_builder.wenet_stay_analysis import StayAnalysisStore
+
+
+class _StayPoint(object):
+    def __init__(self, t_start: datetime):
+        self._t_start = t_start
+
+
+class StayAnalysisStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        start = datetime(2021, 6, 1)
+        self.locations = [
+            LocationPoint(start + timedelta(minutes=i), 46.5, 7.5 + i * 0.001)
+            for i in range(10)
+        ]
+        self.calls = []
+        stay_points = [_StayPoint(start + timedelta(hours=h)) for h in [2, 0, 1]]
+
+        def estimate_stay_points(locations, **parameters):
+            self.calls.append(("stay_points", parameters))
+            return set(stay_points)
+
+        def estimate_stay_regions(stay_points, **parameters):
+            self.calls.append(("stay_regions", parameters))
+            return [stay_point._t_start for stay_point in stay_points]
+
+        patchers = [
+            mock.patch.object(
+                wenet_stay_analysis, "estimate_stay_points", estimate_stay_points
+            ),
+            mock.patch.object(
+                wenet_stay_analysis, "estimate_stay_regions", estimate_stay_regions
+            ),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.store = StayAnalysisStore()
+
+    def test_stay_points_reused(self):
+        stay_points = self.store.stay_points("user_0", self.locations)
+        self.assertIsInstance(stay_points, set)
+        self.assertIs(self.store.stay_points("user_0", self.locations), stay_points)
+        self.assertEqual(self.calls, [("stay_points", {})])
+        self.assertEqual(self.store.stats(), (1, 1))
+
+    def test_stay_points_sorted_by_time(self):
+        stay_points = self.store.stay_points("user_0", self.locations)
+        sorted_stay_points = self.store.stay_points(
+            "user_0", self.locations, sort_by_time=True
+        )
+        self.assertEqual(
+            sorted_stay_points, sorted(stay_points, key=lambda sp: sp._t_start)
+        )
+        self.assertEqual(self.calls, [("stay_points", {})])
+        regions = self.store.stay_regions("user_0", self.locations)
+        sorted_regions = self.store.stay_regions(
+            "user_0", self.locations, sort_by_time=True
+        )
+        self.assertEqual(sorted_regions, sorted(regions))
+        self.assertEqual(len(self.calls), 3)
+
+    def test_parameters_in_key(self):
+        regions_50 = self.store.stay_regions(
+            "user_0", self.locations, distance_threshold_m=50
+        )
+        regions_default = self.store.stay_regions("user_0", self.locations)
+        self.assertEqual(regions_50, regions_default)
+        self.assertEqual(
+            self.calls,
+            [
+                ("stay_points", {}),
+                ("stay_regions", {"distance_threshold_m": 50}),
+                ("stay_regions", {}),
+            ],
+        )
+        self.store.stay_regions("user_0", self.locations, distance_threshold_m=50)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_locations_in_key(self):
+        self.store.stay_points("user_0", self.locations)
+        self.store.stay_points("user_0", self.locations[:5])
+        self.assertEqual(len(self.calls), 2)
+
+    def test_discard(self):
+        self.store.stay_points("user_0", self.locations)
+        self.store.discard("user_0")
+        self.store.stay_points("user_0", self.locations)
+        self.assertEqual(len(self.calls), 2)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,219 @@
+""" Test for the concurrent StreamBase client, against a local stub of StreamBase
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+"""
+
+import json
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+
+from personal_context_builder import config, wenet_profile_manager
+from personal_context_builder.wenet_profile_manager import (
+    StreamBaseLocationsLoader,
+    _PrefetchedUsersData,
+)
+from personal_context_builder.wenet_streambase_client import StreamBaseClient
+from personal_context_builder.wenet_streambase_store import StreamBaseStore
+
+_START_TS = 1622548800000
+
+
+def _payload(user: str):
+    """locations of a user, as given by StreamBase /data"""
+    nb = int(user.split("_")[-1]) + 1
+    records = [
+        {
+            "ts": _START_TS + i * 60000,
+            "payload": {"point": {"latitude": 46 + i, "longitude": 7.5}},
+        }
+        for i in range(nb)
+    ]
+    if user.startswith("reversed"):
+        records = records[::-1]
+    return [{"data": {"locationeventpertime": records}}]
+
+
+class _StreamBaseStub(BaseHTTPRequestHandler):
+    requests_per_user: Counter = Counter()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        query = parse_qs(urlsplit(self.path).query)
+        user = query["userId"][0]
+        with self.lock:
+            self.requests_per_user[user] += 1
+            nb_requests = self.requests_per_user[user]
+        if user.startswith("flaky") and nb_requests == 1:
+            self.send_response(503)
+            self.end_headers()
+            return
+        body = json.dumps(_payload(user)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StreamBaseClientTestCase(unittest.TestCase):
+    def setUp(self):
+        _StreamBaseStub.requests_per_user.clear()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _StreamBaseStub)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/data"
+        self.date_from = datetime(2021, 6, 1)
+        self.date_to = self.date_from + timedelta(days=1)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_load_users_locations(self):
+        client = StreamBaseClient(max_workers=4, backoff_s=0.01)
+        users = [f"user_{i}" for i in range(20)] + ["flaky_user_3"]
+        res = StreamBaseLocationsLoader.load_users_locations(
+            users, self.date_from, self.date_to, self.url, client
+        )
+        self.assertEqual(set(res.keys()), set(users))
+        self.assertEqual(len(res["user_4"]), 5)
+        self.assertEqual(len(res["flaky_user_3"]), 4)
+        self.assertEqual(res["user_4"][1]._lat, 47)
+        self.assertEqual(_StreamBaseStub.requests_per_user["flaky_user_3"], 2)
+        self.assertEqual(_StreamBaseStub.requests_per_user["user_4"], 1)
+
+    def test_unordered_locations(self):
+        client = StreamBaseClient(max_workers=2)
+        for parser in [wenet_profile_manager.ijson, None]:
+            with mock.patch.object(wenet_profile_manager, "ijson", parser):
+                res = StreamBaseLocationsLoader.load_users_locations(
+                    ["reversed_user_9", "user_9"],
+                    self.date_from,
+                    self.date_to,
+                    self.url,
+                    client,
+                )
+            self.assertEqual(
+                [vars(location) for location in res["reversed_user_9"]],
+                [
+                    dict(vars(location), _user="reversed_user_9")
+                    for location in res["user_9"]
+                ],
+            )
+            self.assertEqual(res["user_9"][3]._lat, 49)
+            self.assertEqual(res["user_9"][3]._lng, 7.5)
+
+    def test_streamed_parsing(self):
+        self.assertIsNotNone(wenet_profile_manager.ijson)
+        response = StreamBaseClient().get(
+            self.url, params={"userId": "user_3"}, stream=True
+        )
+        timestamps, lats, lngs = wenet_profile_manager._response_location_columns(
+            response
+        )
+        #  the body was parsed from the stream, never loaded at once
+        self.assertIs(response._content, False)
+        self.assertEqual(list(lats), [46, 47, 48, 49])
+        self.assertEqual(list(lngs), [7.5] * 4)
+        self.assertEqual(timestamps[1] - timestamps[0], 60000)
+
+    def test_load_with_store(self):
+        client = StreamBaseClient(max_workers=2)
+        users = ["user_5", "reversed_user_5"]
+        expected = StreamBaseLocationsLoader.load_users_locations(
+            users, self.date_from, self.date_to, self.url, client
+        )
+        with tempfile.TemporaryDirectory() as folder, mock.patch.object(
+            config, "PCB_DATA_FOLDER", folder
+        ), mock.patch.object(config, "PCB_STREAMBASE_STORE_FILE", "store.sqlite"):
+            store = StreamBaseStore("store.sqlite")
+            with mock.patch.object(StreamBaseStore, "_INSTANCE", store):
+                res = StreamBaseLocationsLoader.load_users_locations(
+                    users, self.date_from, self.date_to, self.url, client
+                )
+            self.assertEqual(
+                store.high_water_mark("user_5", "locationeventpertime"),
+                res["user_5"][-1]._pts_t,
+            )
+        for user in users:
+            self.assertEqual(
+                [vars(location) for location in res[user]],
+                [vars(location) for location in expected[user]],
+            )
+
+    def test_no_retry_left(self):
+        client = StreamBaseClient(max_retry=0)
+        response = client.get(self.url, params={"userId": "flaky_user_0"})
+        self.assertEqual(response.status_code, 503)
+
+    def test_rate_limit(self):
+        client = StreamBaseClient(max_workers=4, rate_limit=50)
+        start = time.monotonic()
+        client.map(
+            lambda user: client.get(self.url, params={"userId": user}),
+            [f"user_{i}" for i in range(11)],
+        )
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_lazy_loader(self):
+        users = [f"user_{i}" for i in range(10)]
+        with mock.patch.object(
+            StreamBaseLocationsLoader, "get_latest_users", return_value=users
+        ), mock.patch.object(config, "PCB_STREAMBASE_BATCH_URL", self.url):
+            loader = StreamBaseLocationsLoader(lazy=True, prefetch=2)
+        self.assertTrue(loader.is_lazy)
+        self.assertEqual(loader.get_users(), users)
+        self.assertEqual(len(_StreamBaseStub.requests_per_user), 0)
+        self.assertEqual(len(loader.get_locations("user_4")), 5)
+        self.assertEqual(len(loader.get_locations_all_users()), 55)
+        loader.close()
+        self.assertTrue(loader._lazy_locations._executor._shutdown)
+
+
+class PrefetchedUsersDataTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loaded: Counter = Counter()
+        self.users = [f"user_{i}" for i in range(10)]
+
+    def _load(self, user: str):
+        self.loaded[user] += 1
+        return user.upper()
+
+    def test_prefetch_next_users(self):
+        data = _PrefetchedUsersData(self.users, self._load, prefetch=3)
+        self.assertEqual(data.get("user_2"), "USER_2")
+        data._executor.shutdown(wait=True)
+        self.assertEqual(
+            set(self.loaded.keys()), {"user_2", "user_3", "user_4", "user_5"}
+        )
+
+    def test_evict_previous_users(self):
+        data = _PrefetchedUsersData(self.users, self._load, prefetch=1)
+        for user in self.users:
+            self.assertEqual(data.get(user), user.upper())
+        self.assertEqual(list(data._futures.keys()), ["user_9"])
+        self.assertEqual(data.get("user_0"), "USER_0")
+        self.assertEqual(self.loaded["user_0"], 2)
+        self.assertEqual(data.get("unknown"), "UNKNOWN")
+
+    def test_close(self):
+        with _PrefetchedUsersData(self.users, self._load, prefetch=3) as data:
+            self.assertEqual(data.get("user_0"), "USER_0")
+        self.assertTrue(data._executor._shutdown)
+        self.assertEqual(len(data._futures), 0)
+        self.assertEqual(data.get("user_1"), "USER_1")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
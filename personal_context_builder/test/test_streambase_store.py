@@ -0,0 +1,87 @@
+""" Test for the local store of the StreamBase data
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+"""
+
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from os.path import join
+
+from personal_context_builder.wenet_streambase_store import StreamBaseStore
+
+_PROPERTY = "locationeventpertime"
+
+
+def _record(pts_t: datetime):
+    return {
+        "ts": int(pts_t.timestamp()) * 1000,
+        "payload": {"point": {"latitude": 46, "longitude": 7}},
+    }
+
+
+class StreamBaseStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.store = StreamBaseStore(join(self.folder.name, "store.sqlite"))
+        self.start = datetime(2021, 6, 1)
+        self.records = [_record(self.start + timedelta(hours=i)) for i in range(48)]
+        self.fetched_from = []
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def _fetch(self, nb_available):
+        def fetch(date_from):
+            self.fetched_from.append(date_from)
+            records = [
+                record
+                for record in self.records[:nb_available]
+                if record["ts"] >= date_from.timestamp() * 1000
+            ]
+            return [{"data": {_PROPERTY: records}}]
+
+        return fetch
+
+    def test_only_new_records_are_requested(self):
+        date_to = self.start + timedelta(days=2)
+        res = self.store.sync("user", _PROPERTY, self.start, date_to, self._fetch(24))
+        self.assertEqual(res[0]["data"][_PROPERTY], self.records[:24])
+        res = self.store.sync("user", _PROPERTY, self.start, date_to, self._fetch(48))
+        self.assertEqual(res[0]["data"][_PROPERTY], self.records)
+        self.assertEqual(
+            self.fetched_from, [self.start, self.start + timedelta(hours=23)]
+        )
+
+    def test_window_and_prune(self):
+        date_to = self.start + timedelta(days=2)
+        self.store.sync("user", _PROPERTY, self.start, date_to, self._fetch(48))
+        date_from = self.start + timedelta(days=1)
+        res = self.store.sync("user", _PROPERTY, date_from, date_to, lambda _: None)
+        self.assertEqual(res[0]["data"][_PROPERTY], self.records[24:])
+        res = self.store.window("user", _PROPERTY, self.start, date_to)
+        self.assertEqual(res[0]["data"][_PROPERTY], self.records[24:])
+
+    def test_failed_request_without_data(self):
+        res = self.store.sync(
+            "user",
+            _PROPERTY,
+            self.start,
+            self.start + timedelta(days=1),
+            lambda _: None,
+        )
+        self.assertIsNone(res)
+
+    def test_answer_without_data(self):
+        date_to = self.start + timedelta(days=1)
+        for payload in [[], [{}], [{"data": None}], {"error": "no data"}]:
+            res = self.store.sync(
+                "user", _PROPERTY, self.start, date_to, lambda _: payload
+            )
+            self.assertEqual(res, [{"data": {_PROPERTY: []}}])
+        self.assertIsNone(self.store.high_water_mark("user", _PROPERTY))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
@@ -6,7 +6,10 @@ Written by William Droz <william.droz@idiap.ch>,
 
 import unittest
 
-from personal_context_builder.wenet_user_profile_db import DatabaseProfileHandler
+from personal_context_builder.wenet_user_profile_db import (
+    DatabaseProfileHandler,
+    DatabaseProfileHandlerMock,
+)
 
 
 class UserProfileDBRealTestCase(unittest.TestCase):
@@ -49,6 +52,27 @@ class UserProfileDBRealTestCase(unittest.TestCase):
         res = DatabaseProfileHandler.get_instance().get_all_profiles(match="test_*")
         self.assertEqual(v2, res[self.user_6])
 
+    def test_one_instance_per_class_and_db(self):
+        DatabaseProfileHandlerMock.get_instance(db_index=9)
+        handler = DatabaseProfileHandler.get_instance(db_index=9)
+        self.assertIsInstance(handler, DatabaseProfileHandler)
+        handler.set_profile(self.user_1, [1.0, 2.0])
+        self.assertIsNone(
+            DatabaseProfileHandler.get_instance(db_index=10).get_profile(self.user_1)
+        )
+        self.assertEqual(handler.get_profile(self.user_1), [1.0, 2.0])
+        handler.delete_profile(self.user_1)
+
+    def test_iter_profiles(self):
+        handler = DatabaseProfileHandler.get_instance()
+        user_ids = [f"test_iter_{i}" for i in range(25)]
+        handler.set_profiles(user_ids, [[i, 1] for i in range(25)])
+        res = dict(handler.iter_profiles(match="test_iter_*", batch_size=4))
+        for user_id in user_ids:
+            handler.delete_profile(user_id)
+        self.assertEqual(set(res.keys()), set(user_ids))
+        self.assertEqual(res["test_iter_3"], [3, 1])
+
     def tearDown(self):
         DatabaseProfileHandler.get_instance().delete_profile(self.user_1)
         #  2 is deleted in another testcase
@@ -7,53 +7,143 @@ Written by William Droz <william.droz@idiap.ch>,
 """
 import json
 import pickle
-from copy import deepcopy
-from datetime import datetime, timedelta
+from collections import namedtuple
 from functools import lru_cache
 from os.path import join
-from typing import Any, Callable, List, Optional
-from uuid import uuid4
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
 
 import numpy as np
 import pandas as pd  # type: ignore
-from regions_builder.algorithms import closest_locations  # type: ignore
-from regions_builder.data_loading import MockWenetSourceLocations  # type: ignore
-from regions_builder.models import GPSPoint  # type: ignore
+from pandas.tseries.frequencies import to_offset  # type: ignore
 from regions_builder.models import (
     LabelledStayRegion,
     LocationPoint,
     StayRegion,
     UserLocationPoint,
 )
-from scipy import spatial  # type: ignore
+from scipy import sparse, spatial  # type: ignore
 
 from personal_context_builder import config
 from personal_context_builder.wenet_realtime_user_db import (
     DatabaseRealtimeLocationsHandler,
     DatabaseRealtimeLocationsHandlerMock,
+    fake_users_locations,
 )
+from personal_context_builder.wenet_regions_index import RegionsIndex
 from personal_context_builder.wenet_user_profile_db import (
+    AsyncDatabaseProfileHandler,
+    AsyncDatabaseProfileHandlerBase,
     DatabaseProfileHandler,
     DatabaseProfileHandlerMock,
 )
 
+_DAY_NS = pd.Timedelta(days=1).value
+
+_LocationRow = namedtuple("_LocationRow", ["pts_t", "lat", "lng", "accuracy_m", "user"])
+
+
+#  known comparison functions that have a vectorized implementation
+_COMPARISON_METRICS = {
+    spatial.distance.cosine: "cosine",
+    spatial.distance.euclidean: "euclidean",
+    np.dot: "dot",
+}
+
+
+def _routines_distances(
+    source_routine: np.ndarray, routines: np.ndarray, metric: str
+) -> np.ndarray:
+    """compare a routine to many routines at once
+
+    Args:
+        source_routine: 1D array
+        routines: 2D array, one routine per row
+        metric: "cosine" (distance), "euclidean" (distance) or "dot" (similarity)
+
+    Return:
+        1D array with the value for each routine, NaN for the cosine distance to
+        an empty routine
+    """
+    if metric == "dot":
+        return routines @ source_routine
+    if metric == "euclidean":
+        return np.linalg.norm(routines - source_routine, axis=1)
+    if metric == "cosine":
+        norms = np.linalg.norm(routines, axis=1) * np.linalg.norm(source_routine)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return 1.0 - (routines @ source_routine) / norms
+    raise ValueError(f"unknown metric {metric}")
+
+
+def _compare_routines(
+    source_routine: Optional[List[float]],
+    users_profiles: Dict[str, Optional[List[float]]],
+    function: Union[str, Callable] = "cosine",
+    top_k: Optional[int] = None,
+) -> Dict[str, float]:
+    """compare a routine to the routines of users
+
+    Args:
+        source_routine: routine of the source user, None if the user has no routine
+        users_profiles: dict user -> routine, None if the user has no routine
+        function: the similarity function to use, a metric name or a callable
+        top_k: if given, keep only the k closest users
+    Return:
+        dict user -> value, sorted by decreasing value
+    """
+    if source_routine is None:
+        return dict()
+    metric = _COMPARISON_METRICS.get(function, function)
+    users_routines = [
+        (user, routine)
+        for user, routine in users_profiles.items()
+        if routine is not None
+    ]
+    if len(users_routines) == 0:
+        return dict()
+    users, routines = zip(*users_routines)
+    if isinstance(metric, str):
+        routines_dist = _routines_distances(
+            np.asarray(source_routine, dtype=np.float64),
+            np.asarray(routines, dtype=np.float64),
+            metric,
+        )
+    else:
+        routines_dist = np.array([metric(source_routine, r) for r in routines])
+    indexes = np.arange(len(users))
+    if top_k is not None and top_k < len(users):
+        closeness = -routines_dist if metric == "dot" else routines_dist
+        indexes = np.argpartition(closeness, top_k - 1)[:top_k]
+    indexes = indexes[np.argsort(-routines_dist[indexes], kind="stable")]
+    return dict((users[i], float(routines_dist[i])) for i in indexes)
+
 
 def compare_routines(
     source_user: str,
     users: List[str],
     model: Any,
-    function: Callable = spatial.distance.cosine,
+    function: Union[str, Callable] = "cosine",
     is_mock: bool = False,
+    top_k: Optional[int] = None,
 ):
     """
     compare routines of users
+
+    The routines are fetched at once and compared with a single matrix-vector
+    product for the "cosine", "euclidean" and "dot" metrics, any other callable
+    is applied to each routine. The result is sorted by decreasing value.
+
     Args:
         source_user: the user that will be compared to the users
         users: list of users to compare to
         model: on which model the comparison should be applied
-        function: the similarity function to use
+        function: the similarity function to use, a metric name or a callable
         is_mock: if true, use mocked data
+        top_k: if given, keep only the k closest users (smallest distances, or
+               largest values for "dot")
     """
+    if top_k is not None and top_k < 1:
+        raise ValueError("top_k must be at least 1")
     model_num = config.MAP_MODEL_TO_DB[model]
     if is_mock:
         db = DatabaseProfileHandlerMock.get_instance(db_index=model_num)
@@ -62,18 +152,58 @@ def compare_routines(
     source_routine = db.get_profile(source_user)
     if source_routine is None:
         return dict()
-    routines = [db.get_profile(u) for u in users]
-    users, routines = zip(
-        *[
-            (user, routine)
-            for (user, routine) in zip(users, routines)
-            if routines is not None
-        ]
+    return _compare_routines(
+        source_routine, db.get_profiles(list(users)), function, top_k
     )
-    routines_dist = [function(source_routine, r) for r in routines]
-    res = list(zip(users, routines_dist))
-    res = sorted(res, key=lambda x: -x[1])
-    return dict(res)
+
+
+async def compare_routines_async(
+    source_user: str,
+    users: List[str],
+    model: Any,
+    function: Union[str, Callable] = "cosine",
+    handler_class: Type[AsyncDatabaseProfileHandlerBase] = AsyncDatabaseProfileHandler,
+    top_k: Optional[int] = None,
+) -> Dict[str, float]:
+    """compare routines of users, with an asyncio database handler
+
+    Same as compare_routines, without blocking the event loop on Redis
+
+    Args:
+        source_user: the user that will be compared to the users
+        users: list of users to compare to
+        model: on which model the comparison should be applied
+        function: the similarity function to use, a metric name or a callable
+        handler_class: class of the database handler
+        top_k: if given, keep only the k closest users (smallest distances, or
+               largest values for "dot")
+    Return:
+        dict user -> value, sorted by decreasing value
+    """
+    if top_k is not None and top_k < 1:
+        raise ValueError("top_k must be at least 1")
+    db = handler_class.get_instance(db_index=config.MAP_MODEL_TO_DB[model])
+    source_routine = await db.get_profile(source_user)
+    if source_routine is None:
+        return dict()
+    users_profiles = await db.get_profiles(list(users))
+    return _compare_routines(source_routine, users_profiles, function, top_k)
+
+
+@lru_cache(maxsize=None)
+def _mock_realtime_db(nb_users: int, seed: int) -> DatabaseRealtimeLocationsHandlerMock:
+    """mocked real-time DB, filled once with a fake population
+
+    Args:
+        nb_users: size of the population
+        seed: seed of the fake locations
+
+    Return:
+        the mocked DB
+    """
+    db = DatabaseRealtimeLocationsHandlerMock.get_instance()
+    db.update(fake_users_locations(nb_users, seed))
+    return db
 
 
 def closest_users(lat: float, lng: float, N: int, is_mock: bool = False):
@@ -84,20 +214,16 @@ def closest_users(lat: float, lng: float, N: int, is_mock: bool = False):
         lng: the longitude
         N: how many users in output
         is_mock: if true, use mocked data
+    Return:
+        list of (distance in meters, user location) by increasing distance
     """
-    point = GPSPoint(lat, lng)
     if is_mock:
-        db = DatabaseRealtimeLocationsHandlerMock.get_instance()
-        fake_locations = [
-            MockWenetSourceLocations._create_fake_locations(str(uuid4()), nb=1)[0]
-            for _ in range(3000)
-        ]
-        db.update(fake_locations)
+        db = _mock_realtime_db(
+            config.PCB_MOCK_REALTIME_NB_USERS, config.PCB_MOCK_REALTIME_SEED
+        )
     else:
         db = DatabaseRealtimeLocationsHandler.get_instance()
-    users_locations = db.get_all_users().values()
-    sorted_users_locations = closest_locations(point, users_locations, N=N)
-    return sorted_users_locations
+    return db.closest_users(lat, lng, N)
 
 
 @lru_cache(maxsize=None)
@@ -116,6 +242,52 @@ def _loads_regions(regions_mapping_file: str):
         return json.load(f)
 
 
+def _grouped_median(groups: np.ndarray, values: np.ndarray):
+    """median of the values for each group, ignoring NaN
+
+    Args:
+        groups: 1D integer array with the group of each value
+        values: 1D array of values
+
+    Return:
+        tuple with the sorted unique groups and the median of each of them
+        (NaN if a group has only NaN)
+    """
+    order = np.lexsort((values, groups))
+    sorted_groups = groups[order]
+    sorted_values = values[order]
+    unique_groups, starts = np.unique(sorted_groups, return_index=True)
+    #  NaN are sorted at the end of each group
+    nb_valid = np.add.reduceat(~np.isnan(sorted_values), starts)
+    has_valid = nb_valid > 0
+    low = starts + np.maximum(nb_valid - 1, 0) // 2
+    high = starts + nb_valid // 2
+    high = np.where(has_valid, high, low)
+    medians = (sorted_values[low] + sorted_values[high]) / 2
+    medians[~has_valid] = np.nan
+    return unique_groups, medians
+
+
+def _locations_to_arrays(locations: List[Optional[LocationPoint]]):
+    """latitudes and longitudes of the locations as arrays
+
+    Args:
+        locations: list of LocationPoint, None when there is no data
+
+    Return:
+        tuple of two 1D arrays (lats, lngs) with NaN for the missing locations
+    """
+    lats = np.array(
+        [np.nan if location is None else location._lat for location in locations],
+        dtype=np.float64,
+    )
+    lngs = np.array(
+        [np.nan if location is None else location._lng for location in locations],
+        dtype=np.float64,
+    )
+    return lats, lngs
+
+
 class BagOfWordsVectorizer(object):
     def __init__(
         self,
@@ -133,6 +305,9 @@ class BagOfWordsVectorizer(object):
             self._stay_regions = []
         self._regions_mapping = _loads_regions(regions_mapping_file)
         self._inner_vector_size = max(self._regions_mapping.values())
+        self._regions_index = RegionsIndex(
+            self._labelled_stay_regions, self._stay_regions
+        )
 
     @classmethod
     def group_by_days(
@@ -153,43 +328,116 @@ class BagOfWordsVectorizer(object):
         Return:
             List of list of location, each sublist is a day
         """
-        data = [l.__dict__ for l in locations]
-        df = pd.DataFrame.from_records(data)
-        df["_pts_t"] = pd.to_datetime(df["_pts_t"])
-        df["days"] = df["_pts_t"].dt.strftime("%Y%m%d")
-        df["index"] = df["_pts_t"]
-        df = df.set_index("index")
+        days, slots = cls.group_by_days_array(locations, start_day, dt_hours, freq)
+        slots_times = cls.slots_times(days, slots.shape[1], start_day, freq)
         days_list = []
-        for name, grouped in df.groupby("days"):
+        for day_times, day_slots in zip(slots_times.tolist(), slots.tolist()):
             current_day = []
-            fullday = str(name)
-            year = fullday[:4]
-            month = fullday[4:6]
-            days = fullday[6:]
-            start_date = datetime.strptime(
-                f"{year}-{month}-{days} {start_day}", "%Y-%m-%d %H:%M:%S"
-            )
-            end_date = start_date + timedelta(hours=dt_hours)
-            df_median = grouped.resample(freq).median()
-            df_day_activity = df_median.reindex(
-                pd.date_range(start=start_date, end=end_date, freq=freq)
-            )
-            df_day_activity["_pts_t"] = df_day_activity.index
-            df_day_activity["_user"] = [user for _ in range(len(df_day_activity))]
-            for row in df_day_activity.rename(
-                columns={
-                    "_pts_t": "pts_t",
-                    "_user": "user",
-                    "_lat": "lat",
-                    "_lng": "lng",
-                    "_accuracy_m": "accuracy_m",
-                }
-            ).itertuples():
-                location = UserLocationPoint.from_namedtuple(row)
-                current_day.append(location)
+            for pts_t, (lat, lng, accuracy_m) in zip(day_times, day_slots):
+                row = _LocationRow(pts_t, lat, lng, accuracy_m, user)
+                current_day.append(UserLocationPoint.from_namedtuple(row))
             days_list.append(current_day)
         return days_list
 
+    @classmethod
+    def group_by_days_array(
+        cls,
+        locations: List[LocationPoint],
+        start_day: str = "00:00:00",
+        dt_hours: float = 23.5,
+        freq: str = "30T",
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """class method to group the locations by days, as dense arrays
+
+        Timestamps are binned into (day, slot) cells with integer arithmetic and
+        each cell holds the median of its locations, like a resample per day
+
+        Args:
+            locations: list of location to use
+            start_day: "HH:MM:SS" to define the start of a day
+            dt_hours: how many hours we use from the start_day to define the day
+            freq: at which freqency the data will be sample
+        Return:
+            tuple with the days (datetime64[D] array, only days with data) and
+            the slots as array of shape (n_days, n_slots, 3) with lat, lng, accuracy
+            (NaN when there is no data in the slot)
+        """
+        freq_ns = to_offset(freq).nanos
+        start_ns = pd.Timedelta(start_day).value
+        nb_slots = int(pd.Timedelta(hours=dt_hours).value // freq_ns) + 1
+        if len(locations) == 0:
+            return (
+                np.empty(0, dtype="datetime64[D]"),
+                np.empty((0, nb_slots, 3), dtype=np.float64),
+            )
+        times = np.array(
+            [location._pts_t for location in locations], dtype="datetime64[ns]"
+        ).astype(np.int64)
+        values = np.array(
+            [
+                (location._lat, location._lng, location._accuracy_m)
+                for location in locations
+            ],
+            dtype=np.float64,
+        )
+        days_number = times // _DAY_NS
+        days, days_index = np.unique(days_number, return_inverse=True)
+        #  bins start at midnight, as the resampling of a day does
+        bins = (times - days_number * _DAY_NS) // freq_ns
+        bins_per_day = int(-(-_DAY_NS // freq_ns))
+        cells = days_index * bins_per_day + bins
+        day_bins = np.full((len(days), bins_per_day, 3), np.nan)
+        for column in range(values.shape[1]):
+            unique_cells, medians = _grouped_median(cells, values[:, column])
+            day_bins[
+                unique_cells // bins_per_day, unique_cells % bins_per_day, column
+            ] = medians
+        slots = np.full((len(days), nb_slots, 3), np.nan)
+        if start_ns % freq_ns == 0:
+            first_bin = start_ns // freq_ns
+            nb_in_day = max(0, min(nb_slots, bins_per_day - first_bin))
+            slots[:, :nb_in_day] = day_bins[:, first_bin : first_bin + nb_in_day]
+        return days.astype("datetime64[D]"), slots
+
+    @staticmethod
+    def count_days(locations: List[LocationPoint]) -> int:
+        """number of days that group_by_days_array would give
+
+        Args:
+            locations: list of location to use
+        Return:
+            number of distinct days with data
+        """
+        if len(locations) == 0:
+            return 0
+        times = np.array(
+            [location._pts_t for location in locations], dtype="datetime64[ns]"
+        ).astype(np.int64)
+        return len(np.unique(times // _DAY_NS))
+
+    @staticmethod
+    def slots_times(
+        days: np.ndarray,
+        nb_slots: int,
+        start_day: str = "00:00:00",
+        freq: str = "30T",
+    ) -> np.ndarray:
+        """timestamps of the slots created by group_by_days_array
+
+        Args:
+            days: days as given by group_by_days_array
+            nb_slots: number of slots per day
+            start_day: "HH:MM:SS" to define the start of a day
+            freq: at which freqency the data is sampled
+        Return:
+            datetime64[us] array of shape (n_days, n_slots)
+        """
+        start = np.timedelta64(pd.Timedelta(start_day).value, "ns")
+        step = np.timedelta64(to_offset(freq).nanos, "ns")
+        offsets = start + step * np.arange(nb_slots)
+        slots_times = days.astype("datetime64[ns]")[:, np.newaxis] + offsets
+        return slots_times.astype("datetime64[us]")
+
     def vectorize(self, locations: List[LocationPoint]):
         """Create a bag of words vector
         Args:
@@ -198,32 +446,86 @@ class BagOfWordsVectorizer(object):
         Return:
             vector (list of floats)
         """
-        big_vector = []
-        inner_vector = [0] * self._inner_vector_size
-        for location in locations:
-            current_vector = deepcopy(inner_vector)
-            if location is None or np.isnan(location._lat):
-                current_vector[self._regions_mapping["no_data"]] = 1
-            else:
-                is_in_region = False
-                for region in self._labelled_stay_regions:
-                    if location in region:
-                        if region._label in self._regions_mapping:
-                            label = self._regions_mapping[region._label]
-                        else:
-                            label = self._regions_mapping["unknown_labelled_region"]
-                        current_vector[label] = 1
-                        is_in_region = True
-                        break
-                for region in self._stay_regions:
-                    if location in region:
-                        current_vector[self._regions_mapping["unknown_region"]] = 1
-                        is_in_region = True
-                        break
-                if not is_in_region:
-                    current_vector[self._regions_mapping["unknown"]] = 1
-            big_vector += current_vector
-        return big_vector
+        lats, lngs = _locations_to_arrays(locations)
+        return self.vectorize_array(lats, lngs).tolist()
+
+    def vectorize_array(self, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+        """Create the bag of words vectors of one or many days at once
+
+        Each slot is one-hot encoded with the same priority as `vectorize`:
+        no data, then labelled regions, then unlabelled regions, then unknown
+
+        Args:
+            lats: latitudes of the slots, NaN when there is no data.
+                  Shape (n_slots,) for a day or (n_days, n_slots) for many days
+            lngs: longitudes of the slots, same shape as lats
+
+        Return:
+            array of shape (n_slots * size,) or (n_days, n_slots * size)
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        hot_slots, hot_words = self._hot_words(lats, lngs)
+        vectors = np.zeros((lats.size, self._inner_vector_size), dtype=np.uint8)
+        vectors[hot_slots, hot_words] = 1
+        return vectors.reshape(
+            lats.shape[:-1] + (lats.shape[-1] * self._inner_vector_size,)
+        )
+
+    def vectorize_sparse(self, lats: np.ndarray, lngs: np.ndarray) -> sparse.csr_matrix:
+        """Create the bag of words vectors of many days as a sparse matrix
+
+        Same encoding as `vectorize_array`, but only the non-zero entries are stored
+
+        Args:
+            lats: latitudes of the slots, shape (n_days, n_slots), NaN for no data
+            lngs: longitudes of the slots, same shape as lats
+
+        Return:
+            CSR matrix of shape (n_days, n_slots * size)
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        nb_days, nb_slots = lats.shape
+        hot_slots, hot_words = self._hot_words(lats, lngs)
+        rows = hot_slots // nb_slots
+        columns = (hot_slots % nb_slots) * self._inner_vector_size + hot_words
+        return sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.uint8), (rows, columns)),
+            shape=(nb_days, nb_slots * self._inner_vector_size),
+        )
+
+    def _hot_words(
+        self, lats: np.ndarray, lngs: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """find the words that are set for each slot
+
+        Args:
+            lats: latitudes of the slots, NaN when there is no data
+            lngs: longitudes of the slots, same shape as lats
+
+        Return:
+            tuple with the (flat) indices of the slots and the words set to one
+        """
+        flat_lats = np.asarray(lats, dtype=np.float64).ravel()
+        flat_lngs = np.asarray(lngs, dtype=np.float64).ravel()
+        slots = np.arange(flat_lats.shape[0])
+        no_data = np.isnan(flat_lats)
+        labelled_words, in_stay = self._regions_index.words(
+            flat_lats, flat_lngs, self._regions_mapping
+        )
+        is_labelled = labelled_words >= 0
+        is_unknown = ~no_data & ~is_labelled & ~in_stay
+        hot_slots = np.concatenate(
+            [slots[is_labelled], slots[in_stay], slots[is_unknown], slots[no_data]]
+        )
+        hot_words = np.concatenate(
+            [
+                labelled_words[is_labelled],
+                np.full(in_stay.sum(), self._regions_mapping["unknown_region"]),
+                np.full(is_unknown.sum(), self._regions_mapping["unknown"]),
+                np.full(no_data.sum(), self._regions_mapping["no_data"]),
+            ]
+        ).astype(np.int64)
+        return hot_slots, hot_words
 
     def save(
         self,
@@ -254,6 +556,9 @@ class BagOfWordsVectorizer(object):
         with open(location, "rb") as f:
             instance = BagOfWordsVectorizer(None, None)
             instance.__dict__ = load_fct(f)
+            instance._regions_index = RegionsIndex(
+                instance._labelled_stay_regions, instance._stay_regions
+            )
             return instance
 
 
@@ -278,30 +583,21 @@ class BagOfWordsCorpuzer(BagOfWordsVectorizer):
         Return:
             list of list of "word"
         """
+        lats, lngs = _locations_to_arrays(locations)
+        labelled_words, in_stay = self._regions_index.words(
+            lats, lngs, self._regions_mapping
+        )
         big_vector = []
-        for location in locations:
+        for lat, labelled_word, is_in_stay in zip(lats, labelled_words, in_stay):
             inner_vector = []
-            if location is None or np.isnan(location._lat):
+            if np.isnan(lat):
                 inner_vector.append(str(self._regions_mapping["no_data"]))
             else:
-                is_in_region = False
-                for region in self._labelled_stay_regions:
-                    if location in region:
-                        if region._label in self._regions_mapping:
-                            label = self._regions_mapping[region._label]
-                        else:
-                            label = self._regions_mapping["unknown_labelled_region"]
-                        inner_vector.append(str(label))
-                        is_in_region = True
-                        break
-                for region in self._stay_regions:
-                    if location in region:
-                        inner_vector.append(
-                            str(self._regions_mapping["unknown_region"])
-                        )
-                        is_in_region = True
-                        break
-                if not is_in_region:
+                if labelled_word >= 0:
+                    inner_vector.append(str(labelled_word))
+                if is_in_stay:
+                    inner_vector.append(str(self._regions_mapping["unknown_region"]))
+                if labelled_word < 0 and not is_in_stay:
                     inner_vector.append(str(self._regions_mapping["unknown"]))
             big_vector.append(inner_vector)
         return big_vector
@@ -12,6 +12,7 @@ from typing import Callable, List, Optional
 
 import numpy as np
 from gensim.corpora import Dictionary  # type: ignore
+from scipy import sparse  # type: ignore
 from sklearn.decomposition import LatentDirichletAllocation  # type: ignore
 
 from personal_context_builder import config
@@ -120,6 +121,8 @@ class SimpleBOW(BaseModelWrapper):
 
     def predict(self, *args, **kwargs):
         X = args[0]
+        if sparse.issparse(X):
+            return np.asarray(X.mean(axis=0)).ravel()
         return np.mean(X, axis=0)
 
     def fit(self, *args, **kwargs):
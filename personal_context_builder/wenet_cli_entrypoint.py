@@ -43,6 +43,7 @@ from personal_context_builder.wenet_realtime_user_db import (
     DatabaseRealtimeLocationsHandlerMock,
 )
 from personal_context_builder.wenet_semantic_models import SemanticModelHist
+from personal_context_builder.wenet_stay_analysis import StayAnalysisStore
 from personal_context_builder.wenet_trainer import BaseBOWTrainer, BaseModelTrainer
 from personal_context_builder.wenet_update_realtime import WenetRealTimeUpdateHandler
 from personal_context_builder.wenet_user_profile_db import (
@@ -65,35 +66,43 @@ def compute_semantic_routines(
         try:
             _LOGGER.debug("get source locations")
             source_locations = StreamBaseLocationsLoader(last_days=200)
-            semantic_model_hist = SemanticModelHist(
-                source_locations,
-                StreambaseLabelsLoader(source_locations, last_days=400),
-            )
-            _LOGGER.info("Compute semantic routines")
-            users = source_locations.get_users()
-            for user in users:
-                try:
-                    (
-                        routines,
-                        labelled_stay_regions,
-                    ) = semantic_model_hist.compute_weekdays(user)
-                    if update:
-                        labels_current_user = (
-                            semantic_model_hist.compute_labels_for_user(
-                                user, labelled_stay_regions
+            #  the stay points are computed once for the labels and the routines
+            stay_analysis = StayAnalysisStore()
+            #  the background loads of the lazy mode are stopped at the end
+            with source_locations, StreambaseLabelsLoader(
+                source_locations, last_days=400, stay_analysis=stay_analysis
+            ) as source_labels:
+                semantic_model_hist = SemanticModelHist(
+                    source_locations, source_labels, stay_analysis=stay_analysis
+                )
+                _LOGGER.info("Compute semantic routines")
+                users = source_locations.get_users()
+                for user in users:
+                    try:
+                        (
+                            routines,
+                            labelled_stay_regions,
+                        ) = semantic_model_hist.compute_weekdays(user)
+                        if update:
+                            labels_current_user = (
+                                semantic_model_hist.compute_labels_for_user(
+                                    user, labelled_stay_regions
+                                )
                             )
-                        )
-                        _LOGGER.info(f"sending the routines for user {user}...")
-                        update_profile(routines, user, labels_current_user)
-                    if update_relevant_locations:
+                            _LOGGER.info(f"sending the routines for user {user}...")
+                            update_profile(routines, user, labels_current_user)
+                        if update_relevant_locations:
+                            _LOGGER.info(
+                                f"sending the relevantLocations for user {user}..."
+                            )
+                            update_profile_relevant_locations(
+                                labelled_stay_regions, user
+                            )
+                    except wenet_exceptions.SemanticRoutinesComputationError as e:
                         _LOGGER.info(
-                            f"sending the relevantLocations for user {user}..."
+                            f"cannot create semantic routines for user {user} - {e}"
                         )
-                        update_profile_relevant_locations(labelled_stay_regions, user)
-                except wenet_exceptions.SemanticRoutinesComputationError as e:
-                    _LOGGER.info(
-                        f"cannot create semantic routines for user {user} - {e}"
-                    )
+                    stay_analysis.discard(user)
             _LOGGER.info(
                 f"next computation of semantic routines in {config.PCB_PROFILE_MANAGER_UPDATE_CD_H} hours"
             )
@@ -164,7 +173,7 @@ def update(is_mock: bool = False):
     """update the embedded profile using the pretrained models
 
     Args:
-        is_mock: if true, will mock the data source (not  the db)
+        is_mock: if true, will mock the data source and DB
     """
     for (
         pipeline_class_name,
@@ -207,14 +216,17 @@ def show_all_profiles(is_mock: bool = False):
         if is_mock:
             users_profiles = DatabaseProfileHandlerMock.get_instance(
                 db_index=db_index
-            ).get_all_profiles()
+            ).iter_profiles()
         else:  # pragma: no cover
             users_profiles = DatabaseProfileHandler.get_instance(
                 db_index=db_index
-            ).get_all_profiles()
-        print(f"number of profiles for DB_INDEX {db_index:02d}: {len(users_profiles)}")
-        for user_id, profile in users_profiles.items():
+            ).iter_profiles()
+        print(f"profiles for DB_INDEX {db_index:02d}:")
+        nb_profiles = 0
+        for user_id, profile in users_profiles:
             print(f"\t[{user_id}] {profile}")
+            nb_profiles += 1
+        print(f"number of profiles for DB_INDEX {db_index:02d}: {nb_profiles}")
 
 
 def clean_db_cmd(is_mock: bool = False):
@@ -230,6 +242,21 @@ def clean_db_cmd(is_mock: bool = False):
             DatabaseProfileHandler.get_instance(db_index=db_index).clean_db()
 
 
+def migrate_profiles_cmd(is_mock: bool = False):
+    """encode again the profiles DB with PCB_PROFILE_ENCODING
+
+    Args:
+        is_mock: if true, will migrate the mocked database
+    """
+    for db_index in config.MAP_DB_TO_MODEL.keys():
+        if is_mock:
+            handler = DatabaseProfileHandlerMock.get_instance(db_index=db_index)
+        else:  # pragma: no cover
+            handler = DatabaseProfileHandler.get_instance(db_index=db_index)
+        nb_migrated = handler.migrate_profiles(config.PCB_PROFILE_ENCODING)
+        print(f"DB_INDEX : {db_index:02d} - {nb_migrated} profiles migrated")
+
+
 def show_models():
     """show the list of the models (embedded routines)"""
     models = [model_name.split(":")[0] for model_name in config.MAP_MODEL_TO_DB.keys()]
@@ -326,6 +353,11 @@ if __name__ == "__main__":  # pragma: no cover
         action="store_true",
     )
     parser.add_argument("--clean_db", help="clean the db", action="store_true")
+    parser.add_argument(
+        "--migrate_profiles",
+        help="encode the profiles of the db with PCB_PROFILE_ENCODING",
+        action="store_true",
+    )
     parser.add_argument(
         "--compute_semantic_routines",
         help="compute the semantic routines",
@@ -372,6 +404,8 @@ if __name__ == "__main__":  # pragma: no cover
     args = parser.parse_args()
     if args.clean_db:
         clean_db_cmd(args.mock)
+    if args.migrate_profiles:
+        migrate_profiles_cmd(args.mock)
     if args.train:
         train(args.mock)
     if args.update:
@@ -3,25 +3,33 @@
 Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
 Written by William Droz <william.droz@idiap.ch>,
 """
-from typing import List, Optional, Type, Union
+import json
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Type, Union
 
 import uvicorn  # type: ignore
-from fastapi import Depends, FastAPI, HTTPException, Query  # type: ignore
+from fastapi import Depends, FastAPI, HTTPException, Query, Response  # type: ignore
+from fastapi.responses import StreamingResponse  # type: ignore
 
 import personal_context_builder.config
 from personal_context_builder import config, wenet_analysis_models
-from personal_context_builder.wenet_analysis import closest_users, compare_routines
+from personal_context_builder.wenet_analysis import (
+    closest_users,
+    compare_routines_async,
+)
 from personal_context_builder.wenet_fastapi_models import (
     EmbeddedModelName,
     EmbeddedModels,
     EmbeddedRoutineOut,
     EmbeddedRoutinesDist,
     SemanticRoutine,
+    UsersIn,
 )
+from personal_context_builder.wenet_similarity_index import get_similarity_index
 from personal_context_builder.wenet_user_profile_db import (
-    DatabaseProfileHandler,
-    DatabaseProfileHandlerBase,
-    DatabaseProfileHandlerMock,
+    AsyncDatabaseProfileHandler,
+    AsyncDatabaseProfileHandlerBase,
+    AsyncDatabaseProfileHandlerMock,
+    get_routines,
 )
 
 tags_metadata = [
@@ -44,32 +52,152 @@ title = "WeNet - personal_context_builder"
 
 app = FastAPI(openapi_tags=tags_metadata, description=description, title=title)
 
+#  header with the cursor of the next page of /routines/
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def _handler_class() -> Type[AsyncDatabaseProfileHandlerBase]:
+    """class of the profiles database handler to use"""
+    if config.PCB_MOCK_DATABASEHANDLER:
+        return AsyncDatabaseProfileHandlerMock
+    return AsyncDatabaseProfileHandler
+
+
+def _models_db_dict(models: Optional[List[str]]) -> Dict[int, str]:
+    """databases of the models
+    Args:
+        models: names of the models, None for all
+    Return:
+        dict db_index -> model name
+    """
+    if models is None:
+        return config.MAP_DB_TO_MODEL
+    models_set = set(models)
+    return dict(
+        [
+            (db_index, model_name)
+            for db_index, model_name in config.MAP_DB_TO_MODEL.items()
+            if model_name in models_set
+        ]
+    )
+
+
+def _decode_routines_cursor(cursor: str) -> Tuple[int, int]:
+    """decode a cursor of /routines/
+    Args:
+        cursor: "db_index:scan_cursor"
+    Return:
+        tuple with the db index and the SCAN cursor in that db
+    """
+    try:
+        db_index, scan_cursor = cursor.split(":")
+        return int(db_index), int(scan_cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"invalid cursor {cursor}")
+
+
+async def _routines_page(
+    handler_to_use: Type[AsyncDatabaseProfileHandlerBase],
+    db_dict: Dict[int, str],
+    cursor: Optional[str],
+    limit: int,
+) -> Tuple[Dict[str, Dict[str, List[float]]], Optional[str]]:
+    """get a page of routines, the databases are scanned in order
+    Args:
+        handler_to_use: class of the database handler
+        db_dict: dict db_index -> model name
+        cursor: cursor of the page, None for the first page
+        limit: about how many routines in the page
+    Return:
+        tuple with the routines per model and the cursor of the next page (None
+        after the last page)
+    """
+    db_indexes = sorted(db_dict.keys())
+    if len(db_indexes) == 0:
+        return dict(), None
+    if cursor is None:
+        db_index, scan_cursor = db_indexes[0], 0
+    else:
+        db_index, scan_cursor = _decode_routines_cursor(cursor)
+        if db_index not in db_dict:
+            raise HTTPException(status_code=400, detail=f"invalid cursor {cursor}")
+    position = db_indexes.index(db_index)
+    res: Dict[str, Dict[str, List[float]]] = dict()
+    count = 0
+    while position < len(db_indexes) and count < limit:
+        db_index = db_indexes[position]
+        handler = handler_to_use.get_instance(db_index=db_index)
+        scan_cursor, profiles = await handler.scan_profiles(
+            scan_cursor, batch_size=limit - count
+        )
+        res.setdefault(db_dict[db_index], dict()).update(profiles)
+        count += len(profiles)
+        if scan_cursor == 0:
+            position += 1
+    if position == len(db_indexes):
+        return res, None
+    return res, f"{db_indexes[position]}:{scan_cursor}"
+
+
+async def _routines_ndjson(
+    handler_to_use: Type[AsyncDatabaseProfileHandlerBase], db_dict: Dict[int, str]
+) -> AsyncIterator[str]:
+    """all the routines, one JSON document per line
+    Args:
+        handler_to_use: class of the database handler
+        db_dict: dict db_index -> model name
+    Return:
+        iterator over the lines
+    """
+    for db_index, model_name in db_dict.items():
+        handler = handler_to_use.get_instance(db_index=db_index)
+        async for user_id, routine in handler.iter_profiles():
+            yield json.dumps(
+                {"model": model_name, "user_id": user_id, "routine": routine}
+            ) + "\n"
+
 
 @app.get(
     "/routines/",
     tags=["User's embedded routines"],
     response_model=EmbeddedRoutineOut,
 )
-async def routines(models: Optional[List[str]] = Query(None)):
+async def routines(
+    response: Response,
+    models: Optional[List[str]] = Query(None),
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    stream: bool = False,
+):
+    """routines of all users
+
+    With cursor or limit, only a page of about limit routines is given and the cursor
+    of the next page is in the X-Next-Cursor header (no header after the last page).
+    A routine can be in more than one page.
+    With stream, all routines are streamed as NDJSON, one routine per line
+    """
     res = dict()
-    handler_to_use: Optional[Type[DatabaseProfileHandlerBase]]
-    if config.PCB_MOCK_DATABASEHANDLER:
-        handler_to_use = DatabaseProfileHandlerMock
-    else:
-        handler_to_use = DatabaseProfileHandler
-    if models is not None:
-        models_set = set(models)
-        db_dict = dict(
-            [
-                (db_index, model_name)
-                for db_index, model_name in config.MAP_DB_TO_MODEL.items()
-                if model_name in models_set
-            ]
+    handler_to_use = _handler_class()
+    db_dict = _models_db_dict(models)
+    if stream:
+        if cursor is not None or limit is not None:
+            raise HTTPException(
+                status_code=400, detail="stream can't be used with cursor or limit"
+            )
+        return StreamingResponse(
+            _routines_ndjson(handler_to_use, db_dict),
+            media_type="application/x-ndjson",
         )
-    else:
-        db_dict = config.MAP_DB_TO_MODEL
+    if cursor is not None or limit is not None:
+        if limit is None:
+            limit = config.PCB_PROFILES_BATCH_SIZE
+        res, next_cursor = await _routines_page(handler_to_use, db_dict, cursor, limit)
+        if next_cursor is not None:
+            response.headers[NEXT_CURSOR_HEADER] = next_cursor
+        return res
     for db_index, model_name in db_dict.items():
-        routines = handler_to_use.get_instance(db_index=db_index).get_all_profiles()
+        handler = handler_to_use.get_instance(db_index=db_index)
+        routines = await handler.get_all_profiles()
         res[model_name] = routines
     return res
 
@@ -80,27 +208,33 @@ async def routines(models: Optional[List[str]] = Query(None)):
     response_model=EmbeddedRoutineOut,
 )
 async def routines_for_user(user_id: str, models: Optional[List[str]] = Query(None)):
-    res = dict()
-    handler_to_use: Optional[Type[DatabaseProfileHandlerBase]] = None
-    if config.PCB_MOCK_DATABASEHANDLER:
-        handler_to_use = DatabaseProfileHandlerMock
-    else:
-        handler_to_use = DatabaseProfileHandler
-    if models is not None:
-        models_set = set(models)
-        db_dict = dict(
-            [
-                (db_index, model_name)
-                for db_index, model_name in config.MAP_DB_TO_MODEL.items()
-                if model_name in models_set
-            ]
+    handler_to_use = _handler_class()
+    db_dict = _models_db_dict(models)
+    return await get_routines([user_id], db_dict, handler_to_use)
+
+
+@app.post(
+    "/routines/batch",
+    tags=["User's embedded routines"],
+    response_model=EmbeddedRoutineOut,
+)
+async def routines_for_users(users: UsersIn, models: Optional[List[str]] = Query(None)):
+    """routines of many users at once, the users without routine are not given"""
+    if len(users.user_ids) > config.PCB_ROUTINES_BATCH_MAX_USERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"at most {config.PCB_ROUTINES_BATCH_MAX_USERS} users per request",
         )
-    else:
-        db_dict = config.MAP_DB_TO_MODEL
-    for db_index, model_name in db_dict.items():
-        routines = handler_to_use.get_instance(db_index=db_index).get_profile(user_id)
-        res[model_name] = {user_id: routines}
-    return res
+    user_ids = list(dict.fromkeys(users.user_ids))
+    res = await get_routines(user_ids, _models_db_dict(models), _handler_class())
+    return {
+        model_name: {
+            user_id: routine
+            for user_id, routine in routines.items()
+            if routine is not None
+        }
+        for model_name, routines in res.items()
+    }
 
 
 @app.get(
@@ -122,14 +256,38 @@ async def get_available_models():
     response_model=EmbeddedRoutinesDist,
 )
 async def get_compare_routines(
-    user_id: str, model: str, users: List[str] = Query(None)
+    user_id: str,
+    model: str,
+    users: List[str] = Query(None),
+    metric: str = Query("cosine", regex="^(cosine|euclidean|dot)$"),
+    top_k: Optional[int] = Query(None, ge=1),
 ):
-    res = compare_routines(
-        user_id, users, model, is_mock=config.PCB_MOCK_DATABASEHANDLER
+    res = await compare_routines_async(
+        user_id, users, model, metric, _handler_class(), top_k=top_k
     )
     return res
 
 
+@app.get(
+    "/similar_routines/{user_id}/{model}",
+    tags=["User's embedded routines"],
+    response_model=EmbeddedRoutinesDist,
+)
+async def get_similar_routines(user_id: str, model: str, k: int = Query(10, ge=1)):
+    """the k users with the most similar routines, by increasing cosine distance
+
+    The index of the model is built again after each update of the routines
+    """
+    if model not in config.MAP_MODEL_TO_DB:
+        raise HTTPException(status_code=404, detail=f"unknown model {model}")
+    index = get_similarity_index(config.MAP_MODEL_TO_DB[model])
+    if index is None or user_id not in index:
+        raise HTTPException(
+            status_code=404, detail=f"no routine of {user_id} in the index of {model}"
+        )
+    return dict(index.similar(user_id, k))
+
+
 @app.get(
     "/semantic_routines/{user_id}/{weekday}/{time}/",
     tags=["User's semantic routines"],
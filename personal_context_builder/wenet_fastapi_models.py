@@ -27,6 +27,15 @@ class EmbeddedRoutineOut(BaseModel):
         }
 
 
+class UsersIn(BaseModel):
+    """list of users"""
+
+    user_ids: List[str]
+
+    class Config:
+        schema_extra = {"example": {"user_ids": ["mock_user_1", "mock_user_2"]}}
+
+
 class EmbeddedModels(BaseModel):
     __root__: Optional[Dict[str, str]]
     """descriptions of the embedded models"""
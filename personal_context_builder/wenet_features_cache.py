@@ -0,0 +1,233 @@
+""" module with an on-disk cache for the features of the users
+
+Stay regions, labelled stay regions and days of the users are expensive to compute
+and most users don't change from one run to the next. The features are stored in a
+SQLite file, keyed by user, kind of features and a fingerprint of the data used to
+compute them. The least recently used entries are evicted when the cache is full.
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+
+"""
+from __future__ import annotations
+
+import hashlib
+import pickle
+import sqlite3
+from os import getpid
+from os.path import join
+from time import time
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+from regions_builder.models import LocationPoint  # type: ignore
+
+from personal_context_builder import config
+from personal_context_builder.wenet_logger import create_logger
+
+_LOGGER = create_logger(__name__)
+
+
+def fingerprint(
+    locations: List[LocationPoint],
+    user_places: Optional[List[Any]] = None,
+    parameters: Iterable[Any] = (),
+) -> str:
+    """fingerprint of the data used to compute some features
+
+    Args:
+        locations: locations of the user
+        user_places: labels of the user
+        parameters: any other parameters that change the features
+
+    Return:
+        hexadecimal sha256 digest
+    """
+    digest = hashlib.sha256()
+    digest.update(
+        pickle.dumps(
+            [(l._pts_t, l._lat, l._lng, l._accuracy_m) for l in locations], protocol=4
+        )
+    )
+    if user_places is not None:
+        digest.update(
+            pickle.dumps(
+                [sorted(vars(place).items()) for place in user_places], protocol=4
+            )
+        )
+    digest.update(repr(tuple(parameters)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def stay_parameters() -> Tuple[Any, ...]:
+    """parameters of the estimation of the stay points and stay regions
+
+    To give as parameters of cached_features for the features that use stay regions
+
+    Return:
+        tuple with the PCB_STAYPOINTS_* and PCB_STAYREGION_* values
+    """
+    return (
+        config.PCB_STAYPOINTS_TIME_MIN_MS,
+        config.PCB_STAYPOINTS_TIME_MAX_MS,
+        config.PCB_STAYPOINTS_DISTANCE_MAX_M,
+        config.PCB_STAYREGION_DISTANCE_THRESHOLD_M,
+        config.PCB_STAYREGION_INC_DELTA,
+    )
+
+
+class FeaturesCache(object):
+    """Size-bounded LRU cache of the users features, in a SQLite file
+
+    is a Singleton
+    """
+
+    _INSTANCE: Optional[FeaturesCache] = None
+
+    def __init__(
+        self,
+        filename: str = config.PCB_FEATURES_CACHE_FILE,
+        max_size_mb: float = config.PCB_FEATURES_CACHE_MAX_MB,
+    ):
+        """Constructor
+        Args:
+            filename: SQLite file, in PCB_DATA_FOLDER
+            max_size_mb: maximum size of the cached values, in MB
+        """
+        self._location = join(config.PCB_DATA_FOLDER, filename)
+        self._max_size = int(max_size_mb * 1024 * 1024)
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+
+    @classmethod
+    def get_instance(cls) -> Optional[FeaturesCache]:
+        """get the instance or create if doesn't exist
+
+        Return:
+            the cache, None if PCB_FEATURES_CACHE_FILE is empty (disabled)
+        """
+        if config.PCB_FEATURES_CACHE_FILE == "":
+            return None
+        if cls._INSTANCE is None:
+            cls._INSTANCE = cls()
+        return cls._INSTANCE
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """connection to the SQLite file, one per process"""
+        #  a connection can't be used by the forked processes of the trainer
+        if self._connection is None or self._pid != getpid():
+            self._connection = sqlite3.connect(self._location, timeout=60)
+            with self._connection:
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS features ("
+                    "user_id TEXT, kind TEXT, fingerprint TEXT, value BLOB, "
+                    "size INTEGER, last_access REAL, PRIMARY KEY (user_id, kind))"
+                )
+            self._pid = getpid()
+        return self._connection
+
+    def get(self, user_id: str, kind: str, data_fingerprint: str) -> Optional[Any]:
+        """get some features of a user
+
+        Args:
+            user_id: the user
+            kind: kind of features
+            data_fingerprint: fingerprint of the data used to compute the features
+
+        Return:
+            the features or None if not in the cache (or outdated)
+        """
+        connection = self._get_connection()
+        row = connection.execute(
+            "SELECT value FROM features WHERE user_id=? AND kind=? AND fingerprint=?",
+            (user_id, kind, data_fingerprint),
+        ).fetchone()
+        if row is None:
+            return None
+        with connection:
+            connection.execute(
+                "UPDATE features SET last_access=? WHERE user_id=? AND kind=?",
+                (time(), user_id, kind),
+            )
+        return pickle.loads(row[0])
+
+    def set(self, user_id: str, kind: str, data_fingerprint: str, features: Any):
+        """set some features of a user, replace the previous ones
+
+        Args:
+            user_id: the user
+            kind: kind of features
+            data_fingerprint: fingerprint of the data used to compute the features
+            features: the features (picklable)
+        """
+        value = pickle.dumps(features, protocol=pickle.HIGHEST_PROTOCOL)
+        connection = self._get_connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, kind, data_fingerprint, value, len(value), time()),
+            )
+        self._evict()
+
+    def _evict(self):
+        """delete the least recently used features until the cache is small enough"""
+        connection = self._get_connection()
+        total_size = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM features"
+        ).fetchone()[0]
+        if total_size <= self._max_size:
+            return
+        to_delete = []
+        for user_id, kind, size in connection.execute(
+            "SELECT user_id, kind, size FROM features ORDER BY last_access"
+        ):
+            if total_size <= self._max_size:
+                break
+            to_delete.append((user_id, kind))
+            total_size -= size
+        _LOGGER.debug(f"evict {len(to_delete)} features from the cache")
+        with connection:
+            connection.executemany(
+                "DELETE FROM features WHERE user_id=? AND kind=?", to_delete
+            )
+
+    def clean(self):
+        """delete all the features"""
+        connection = self._get_connection()
+        with connection:
+            connection.execute("DELETE FROM features")
+
+
+def cached_features(
+    user_id: str,
+    kind: str,
+    compute: Callable[[], Any],
+    locations: List[LocationPoint],
+    user_places: Optional[List[Any]] = None,
+    parameters: Iterable[Any] = (),
+) -> Any:
+    """get features from the cache, or compute and cache them
+
+    If the cache is disabled, the features are simply computed
+
+    Args:
+        user_id: the user
+        kind: kind of features
+        compute: function without arguments that computes the features
+        locations: locations used to compute the features
+        user_places: labels used to compute the features
+        parameters: any other parameters that change the features
+
+    Return:
+        the features
+    """
+    cache = FeaturesCache.get_instance()
+    if cache is None:
+        return compute()
+    data_fingerprint = fingerprint(locations, user_places, parameters)
+    features = cache.get(user_id, kind, data_fingerprint)
+    if features is None:
+        features = compute()
+        cache.set(user_id, kind, data_fingerprint, features)
+    else:
+        _LOGGER.debug(f"features {kind} of user {user_id} served from the cache")
+    return features
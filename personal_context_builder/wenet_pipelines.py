@@ -25,7 +25,9 @@ from personal_context_builder.wenet_logger import create_logger
 from personal_context_builder.wenet_profiles_writer import (
     ProfileWritter,
     ProfileWritterFromMock,
+    ProfileWritterMultiModels,
 )
+from personal_context_builder.wenet_similarity_index import refresh_similarity_indexes
 from personal_context_builder.wenet_trainer import (
     BaseBOWTrainer,
     BaseModelTrainer,
@@ -40,12 +42,20 @@ _LOGGER = create_logger(__name__)
 
 
 class BasePipeline(ABC):
-    def __init__(self, mock_db=False, mock_datasources=False, db_map=None):
+    def __init__(self, mock_db=False, mock_datasources=False, db_map=None, sparse=None):
         self._mock_db = mock_db
         self._mock_datasources = mock_datasources
         self._db_map = db_map
         if self._db_map is None:
             raise ValueError("db_map must not be None")
+        if sparse is None:
+            sparse = type(self).__name__ in config.PCB_SPARSE_PIPELINES.split(",")
+        self._sparse = sparse
+
+    @property
+    def profiles_state_file(self) -> str:
+        """file with the running sums of the incremental profiles of this pipeline"""
+        return f"{type(self).__name__}{config.PCB_PROFILES_STATE_FILE}"
 
     @abstractmethod
     def train(self):
@@ -66,8 +76,9 @@ class PipelineBOW(BasePipeline):
         mock_db: bool = False,
         mock_datasources: bool = False,
         db_map: Optional[Dict[str, int]] = None,
+        sparse: Optional[bool] = None,
     ):
-        super().__init__(mock_db, mock_datasources, db_map)
+        super().__init__(mock_db, mock_datasources, db_map, sparse)
 
     def train(self):
         if self._mock_datasources:
@@ -78,7 +89,13 @@ class PipelineBOW(BasePipeline):
             _LOGGER.info("Training from real data sources")
             source_locations = MockWenetSourceLocations()
             source_labels = MockWenetSourceLabels(source_locations)
-        bow_trainer = BaseBOWTrainer(source_locations, source_labels)
+        bow_trainer = BaseBOWTrainer(
+            source_locations, source_labels, sparse=self._sparse
+        )
+        #  the running sums were computed with the previous models
+        ProfileWritter.clean_state(self.profiles_state_file)
+        #  features are computed once and shared by all the models
+        X = bow_trainer.vectorize()
         for model_class_name, db_index in self._db_map.items():
             _LOGGER.info(f"Train model {model_class_name}")
             model_class = getattr(wenet_analysis_models, model_class_name)
@@ -86,7 +103,7 @@ class PipelineBOW(BasePipeline):
             model_trainer = BaseModelTrainer(
                 source_locations, source_labels, bow_trainer, model_untrained
             )
-            model = model_trainer.train()
+            model = model_trainer.train(X)
             model.save(filename=f"_models_{db_index:02d}_{model_class_name}.p")
             _LOGGER.info(f"Model {model_class_name} saved")
         _LOGGER.info("done")
@@ -100,28 +117,37 @@ class PipelineBOW(BasePipeline):
             _LOGGER.info("updating profiles from real data sources")
             source_locations = MockWenetSourceLocations()
             source_labels = MockWenetSourceLabels(source_locations)
-        bow_trainer = BaseBOWTrainer(source_locations, source_labels)
+        bow_trainer = BaseBOWTrainer(
+            source_locations, source_labels, sparse=self._sparse
+        )
         if self._mock_db:
             _LOGGER.info("Mocked database will be used")
             profile_handler_class = DatabaseProfileHandlerMock
         else:
             _LOGGER.info("Real database will be used")
             profile_handler_class = DatabaseProfileHandler
+        models_databases = []
         for model_class_name, db_index in self._db_map.items():
             _LOGGER.info(
                 f"Update profiles at DB {db_index:02d} from model {model_class_name}"
             )
             model_class = getattr(wenet_analysis_models, model_class_name)
             model = model_class.load(f"_models_{db_index:02d}_{model_class_name}.p")
-            profile_writter = ProfileWritter(
-                source_locations,
-                source_labels,
-                model,
-                bow_trainer,
-                profile_handler_class.get_instance(db_index=db_index),
+            models_databases.append(
+                (model, profile_handler_class.get_instance(db_index=db_index))
             )
-            profile_writter.update_profiles()
-            _LOGGER.info("profiles updated")
+        #  features are computed once per user and shared by all the models
+        profile_writter = ProfileWritterMultiModels(
+            source_locations,
+            source_labels,
+            models_databases,
+            bow_trainer,
+            incremental=config.PCB_PROFILES_INCREMENTAL,
+            state_file=self.profiles_state_file,
+        )
+        profile_writter.update_profiles()
+        _LOGGER.info("profiles updated")
+        refresh_similarity_indexes(self._db_map.values(), profile_handler_class)
         _LOGGER.info("done")
 
 
@@ -135,8 +161,9 @@ class PipelineWithCorpus(BasePipeline):
         mock_db: bool = False,
         mock_datasources: bool = False,
         db_map: Optional[Dict[str, int]] = None,
+        sparse: Optional[bool] = None,
     ):
-        super().__init__(mock_db, mock_datasources, db_map)
+        super().__init__(mock_db, mock_datasources, db_map, sparse)
 
     def train(self):
         if self._mock_datasources:
@@ -148,6 +175,8 @@ class PipelineWithCorpus(BasePipeline):
             source_locations = MockWenetSourceLocations()
             source_labels = MockWenetSourceLabels(source_locations)
         bow_trainer = HDPTrainer(source_locations, source_labels)
+        #  features are computed once and shared by all the models
+        X = bow_trainer.vectorize()
         for model_class_name, db_index in self._db_map.items():
             _LOGGER.info(f"Train model {model_class_name}")
             model_class = getattr(wenet_analysis_models, model_class_name)
@@ -155,7 +184,7 @@ class PipelineWithCorpus(BasePipeline):
             model_trainer = BaseModelTrainer(
                 source_locations, source_labels, bow_trainer, model_untrained
             )
-            model = model_trainer.train()
+            model = model_trainer.train(X)
             model.save(filename=f"_models_{db_index:02d}_{model_class_name}.p")
             _LOGGER.info(f"Model {model_class_name} saved")
         _LOGGER.info("done")
@@ -176,19 +205,21 @@ class PipelineWithCorpus(BasePipeline):
         else:
             _LOGGER.info("Real database will be used")
             profile_handler_class = DatabaseProfileHandler
+        models_databases = []
         for model_class_name, db_index in self._db_map.items():
             _LOGGER.info(
                 f"Update profiles at DB {db_index:02d} from model {model_class_name}"
             )
             model_class = getattr(wenet_analysis_models, model_class_name)
             model = model_class.load(f"_models_{db_index:02d}_{model_class_name}.p")
-            profile_writter = ProfileWritter(
-                source_locations,
-                source_labels,
-                model,
-                bow_trainer,
-                profile_handler_class.get_instance(db_index=db_index),
+            models_databases.append(
+                (model, profile_handler_class.get_instance(db_index=db_index))
             )
-            profile_writter.update_profiles()
-            _LOGGER.info("profiles updated")
+        #  features are computed once per user and shared by all the models
+        profile_writter = ProfileWritterMultiModels(
+            source_locations, source_labels, models_databases, bow_trainer
+        )
+        profile_writter.update_profiles()
+        _LOGGER.info("profiles updated")
+        refresh_similarity_indexes(self._db_map.values(), profile_handler_class)
         _LOGGER.info("done")
@@ -5,20 +5,24 @@ Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
 Written by William Droz <william.droz@idiap.ch>,
 
 """
+from __future__ import annotations
+
 import datetime
 import json
+import logging
+import threading
+from array import array
 from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import asdict, dataclass
 from json import JSONDecodeError
 from pprint import pprint
-from time import sleep
-from typing import Dict, List, Optional
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
 
 import pandas as pd  # type: ignore
 import requests  # type: ignore
 from cachetools import LRUCache, TTLCache, cached  # type: ignore
-from regions_builder.algorithms import estimate_stay_points  # type: ignore
-from regions_builder.algorithms import estimate_stay_regions, labelize_stay_region
+from regions_builder.algorithms import labelize_stay_region  # type: ignore
 from regions_builder.data_loading import BaseSourceLabels  # type: ignore
 from regions_builder.data_loading import BaseSourceLocations
 from regions_builder.models import StayPoint  # type: ignore
@@ -27,12 +31,182 @@ from requests.exceptions import RequestException  # type: ignore
 
 from personal_context_builder import config, wenet_exceptions
 from personal_context_builder.wenet_logger import create_logger
+from personal_context_builder.wenet_stay_analysis import StayAnalysisStore
+from personal_context_builder.wenet_streambase_client import StreamBaseClient
+from personal_context_builder.wenet_streambase_store import (
+    StreamBaseStore,
+    streambase_ts_to_datetime,
+)
+
+try:
+    import ijson  # type: ignore
+except ImportError:  # pragma: no cover
+    ijson = None
 
 _LOGGER = create_logger(__name__)
 
+T = TypeVar("T")
+
+#  columns of the locations of a user: timestamps of StreamBase, latitudes, longitudes
+LocationColumns = Tuple[array, array, array]
+
+
+def _location_columns(records: Iterable[Dict]) -> LocationColumns:
+    """put the location records of StreamBase in columnar arrays
+
+    Args:
+        records: records of the property locationeventpertime
+
+    Return:
+        the columns, in the order of the records
+    """
+    timestamps, lats, lngs = array("q"), array("d"), array("d")
+    for record in records:
+        point = record["payload"]["point"]
+        timestamps.append(record["ts"])
+        lats.append(point["latitude"])
+        lngs.append(point["longitude"])
+    return timestamps, lats, lngs
+
+
+def _columns_to_user_locations(
+    columns: LocationColumns, user: str
+) -> List[UserLocationPoint]:
+    """create the locations of a user, sorted by time
+
+    Args:
+        columns: the columns of the locations
+        user: the user
+
+    Return:
+        the sorted locations
+    """
+    timestamps, lats, lngs = columns
+    pts_ts = [streambase_ts_to_datetime(timestamp) for timestamp in timestamps]
+    order: Iterable[int] = range(len(pts_ts))
+    #  StreamBase gives the records in order most of the time
+    if any(later < earlier for earlier, later in zip(pts_ts, pts_ts[1:])):
+        order = sorted(order, key=pts_ts.__getitem__)
+    return [UserLocationPoint(pts_ts[i], lats[i], lngs[i], user=user) for i in order]
+
+
+def _response_json(response: requests.Response) -> List[Dict]:
+    """JSON of a response of StreamBase, rendered in the logs only in DEBUG"""
+    payload = json.loads(response.content)
+    if _LOGGER.isEnabledFor(logging.DEBUG):
+        _LOGGER.debug(f"answer of stream base {payload}")
+    return payload
+
+
+def _response_location_records(response: requests.Response) -> Iterator[Dict]:
+    """iterate over the location records of a response of StreamBase
+
+    With ijson, the response is parsed as a stream and the whole payload is never in
+    memory (except in DEBUG, to log it)
+    """
+    if ijson is None or _LOGGER.isEnabledFor(logging.DEBUG):
+        payload = _response_json(response)
+        if len(payload) == 0 or "data" not in payload[0]:
+            _LOGGER.warn(f"no data from streambase {payload}")
+            return iter(())
+        return iter(payload[0]["data"].get("locationeventpertime", []))
+    response.raw.decode_content = True
+    return ijson.items(
+        response.raw, "item.data.locationeventpertime.item", use_float=True
+    )
+
+
+def _response_location_columns(response: requests.Response) -> LocationColumns:
+    """parse the locations of a response of StreamBase into columns"""
+    return _location_columns(_response_location_records(response))
+
+
+def _response_location_payload(response: requests.Response) -> List[Dict]:
+    """parse the locations of a response of StreamBase, for the StreamBase store
+
+    Only the location records are kept, in the format of StreamBase
+    """
+    records = list(_response_location_records(response))
+    return [{"data": {"locationeventpertime": records}}]
+
+
+class _PrefetchedUsersData(object):
+    """data of users loaded on demand, in the order of the users
+
+    When the data of a user is asked, the data of the next users is loaded in
+    background and the data of the previous users is dropped. The data of a
+    dropped user is loaded again if it is asked again. close has to be called to
+    stop the background threads
+    """
+
+    def __init__(self, users: List[str], load: Callable[[str], T], prefetch: int):
+        """Constructor
+        Args:
+            users: the users, in the order they will be asked
+            load: load the data of a user
+            prefetch: how many next users are loaded in background
+        """
+        self._users = list(users)
+        self._positions = {user: position for position, user in enumerate(users)}
+        self._load = load
+        self._prefetch = prefetch
+        self._executor = ThreadPoolExecutor(max_workers=max(1, prefetch))
+        self._futures: Dict[str, Future] = dict()
+        self._lock = threading.Lock()
+
+    def get(self, user: str) -> T:
+        """data of a user, wait if it is not loaded yet"""
+        position = self._positions.get(user)
+        if position is None:
+            return self._load(user)
+        with self._lock:
+            for other in list(self._futures.keys()):
+                if self._positions[other] < position:
+                    self._futures.pop(other).cancel()
+            for next_user in self._users[position : position + self._prefetch + 1]:
+                if next_user not in self._futures:
+                    self._futures[next_user] = self._executor.submit(
+                        self._load, next_user
+                    )
+            future = self._futures[user]
+        return future.result()
+
+    def __enter__(self) -> _PrefetchedUsersData:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """cancel the pending loads and stop the background threads
+
+        The data can still be asked after, it is then loaded in the current thread
+        """
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
+            self._users = []
+            self._positions = dict()
+        self._executor.shutdown(wait=True)
+
 
 class StreamBaseLocationsLoader(BaseSourceLocations):
-    def __init__(self, name: str = "Streambase locations loader", last_days: int = 24):
+    def __init__(
+        self,
+        name: str = "Streambase locations loader",
+        last_days: int = 24,
+        lazy: bool = config.PCB_STREAMBASE_LAZY,
+        prefetch: int = config.PCB_STREAMBASE_PREFETCH,
+    ):
+        """Constructor
+        Args:
+            name: name of the source
+            last_days: how many days of locations
+            lazy: if true, the locations of a user are loaded when first asked
+                  instead of loading all users now
+            prefetch: in lazy mode, how many next users are loaded in background
+        """
         super().__init__(name)
 
         users = self.get_latest_users()
@@ -40,7 +214,35 @@ class StreamBaseLocationsLoader(BaseSourceLocations):
         self._users_locations = dict()
         date_to = datetime.datetime.now()
         date_from = date_to - datetime.timedelta(hours=24 * last_days)
-        self._users_locations = self.load_users_locations(users, date_from, date_to)
+        self._lazy_locations: Optional[_PrefetchedUsersData] = None
+        if lazy:
+            self._users = users
+            self._lazy_locations = _PrefetchedUsersData(
+                users,
+                lambda user: self.load_user_locations(
+                    user, date_from, date_to, self._url
+                ),
+                prefetch,
+            )
+        else:
+            self._users_locations = self.load_users_locations(users, date_from, date_to)
+            self._users = list(self._users_locations.keys())
+
+    @property
+    def is_lazy(self) -> bool:
+        """true if the locations are loaded on demand"""
+        return self._lazy_locations is not None
+
+    def __enter__(self) -> StreamBaseLocationsLoader:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """stop the background loads of the lazy mode"""
+        if self._lazy_locations is not None:
+            self._lazy_locations.close()
 
     @staticmethod
     def load_users_locations(
@@ -48,12 +250,30 @@ class StreamBaseLocationsLoader(BaseSourceLocations):
         date_from: datetime.datetime,
         date_to: Optional[datetime.datetime] = None,
         url: str = config.PCB_STREAMBASE_BATCH_URL,
+        client: Optional[StreamBaseClient] = None,
     ):
+        """load the locations of the users, with concurrent requests
+
+        Args:
+            users: the users
+            date_from: start of the locations
+            date_to: end of the locations, now if None
+            url: url of StreamBase
+            client: client to use, the shared client if None
+
+        Return:
+            dict user -> locations, without the users that failed
+        """
+        if client is None:
+            client = StreamBaseClient.get_instance()
+        all_locations = client.map(
+            lambda user: StreamBaseLocationsLoader.load_user_locations(
+                user, date_from, date_to, url, client
+            ),
+            users,
+        )
         users_locations = dict()
-        for user in users:
-            locations = StreamBaseLocationsLoader.load_user_locations(
-                user, date_from, date_to, url
-            )
+        for user, locations in zip(users, all_locations):
             if locations is not None:
                 users_locations[user] = locations
         if len(users_locations) < 1:
@@ -67,10 +287,77 @@ class StreamBaseLocationsLoader(BaseSourceLocations):
         date_from: datetime.datetime,
         date_to: Optional[datetime.datetime] = None,
         url: str = config.PCB_STREAMBASE_BATCH_URL,
-        max_retry: int = 3,
+        client: Optional[StreamBaseClient] = None,
     ):
+        """load the locations of a user
+
+        If the StreamBase store is enabled, only the locations newer than the stored
+        ones are requested and the window is served from the store
+
+        Args:
+            user: the user
+            date_from: start of the locations
+            date_to: end of the locations, now if None
+            url: url of StreamBase
+            client: client to use, the shared client if None
+
+        Return:
+            the sorted locations, None if the request failed
+        """
         if date_to is None:
             date_to = datetime.datetime.now()
+        store = StreamBaseStore.get_instance()
+        try:
+            if store is None:
+                columns = StreamBaseLocationsLoader._request_locations(
+                    user, date_from, date_to, url, _response_location_columns, client
+                )
+                if columns is None:
+                    return None
+                return _columns_to_user_locations(columns, user)
+            payload = store.sync(
+                user,
+                "locationeventpertime",
+                date_from,
+                date_to,
+                lambda fetch_from: StreamBaseLocationsLoader._request_locations(
+                    user, fetch_from, date_to, url, _response_location_payload, client
+                ),
+            )
+            if payload is None:
+                return None
+            return StreamBaseLocationsLoader._gps_streambase_to_user_locations(
+                payload, user
+            )
+        except Exception as e:
+            _LOGGER.warn(
+                f"locations from stream base can't be parsed for user {user} - {e} unhandle exception"
+            )
+
+    @staticmethod
+    def _request_locations(
+        user: str,
+        date_from: datetime.datetime,
+        date_to: datetime.datetime,
+        url: str,
+        parse: Callable[[requests.Response], T],
+        client: Optional[StreamBaseClient] = None,
+    ) -> Optional[T]:
+        """request the locations of a user to StreamBase
+
+        Args:
+            user: the user
+            date_from: start of the locations
+            date_to: end of the locations
+            url: url of StreamBase
+            parse: parse the (streamed) answer of StreamBase
+            client: client to use, the shared client if None
+
+        Return:
+            the parsed answer, None if the request failed
+        """
+        if client is None:
+            client = StreamBaseClient.get_instance()
         date_to_str = date_to.strftime("%Y%m%d%H%M%S") + "000"
         date_from_str = date_from.strftime("%Y%m%d%H%M%S") + "000"
         parameters = dict()
@@ -82,7 +369,7 @@ class StreamBaseLocationsLoader(BaseSourceLocations):
         if config.PCB_WENET_API_KEY == "":
             _LOGGER.warn(f"PCB_WENET_API_KEY is empty")
         try:
-            r = requests.get(
+            r = client.get(
                 user_url,
                 params=parameters,
                 headers={
@@ -90,36 +377,29 @@ class StreamBaseLocationsLoader(BaseSourceLocations):
                     "Accept": "application/json",
                     "x-wenet-component-apikey": config.PCB_WENET_API_KEY,
                 },
+                stream=True,
             )
             if r.status_code == 200:
                 try:
+                    res = parse(r)
                     _LOGGER.debug(
-                        f"request to stream base for locations success for user {user} -  {r.json()}"
-                    )
-                    return StreamBaseLocationsLoader._gps_streambase_to_user_locations(
-                        r.json(), user
+                        f"request to stream base for locations success for user {user}"
                     )
+                    return res
                 except JSONDecodeError:
                     _LOGGER.warn(
                         f"locations json from stream base is not json {r.content}"
                     )
+                finally:
+                    r.close()
             else:
+                r.close()
                 _LOGGER.warn(
                     f"request to stream base failed for user {user} with code {r.status_code} URL : {r.url}"
                 )
         except RequestException as e:
             _LOGGER.warn(f"request to stream base failed for user {user} - {e}")
             #  _LOGGER.exception(e)
-        except TimeoutError as e:
-            _LOGGER.warn(
-                f"request to stream base failed for user {user} - {e} remaining retry {max_retry}"
-            )
-            #  _LOGGER.exception(e)
-            if max_retry > 0:
-                sleep(5)
-                return StreamBaseLocationsLoader.load_user_locations(
-                    user, date_from, date_to, url, max_retry - 1
-                )
         except Exception as e:
             _LOGGER.warn(
                 f"request to stream base failed for user {user} - {e} unhandle exception"
@@ -151,52 +431,37 @@ class StreamBaseLocationsLoader(BaseSourceLocations):
 
     @staticmethod
     def _gps_streambase_to_user_locations(gps_streambase: List[Dict], user: str):
-        def _get_only_gps_locations(gps_streambase):
-            gps_streambase = gps_streambase[0]
-            if "data" not in gps_streambase:
-                _LOGGER.warn(
-                    f"no data for user {user} from streambase {gps_streambase}"
-                )
-                return None
-            data = gps_streambase["data"]
-            locationeventpertime = data["locationeventpertime"]
-            for _property in locationeventpertime:
-                _property["payload"]["ts"] = _property["ts"]
-                yield _property["payload"]
-
-        locations = []
-        locationeventpertime_list = _get_only_gps_locations(gps_streambase)
-        for locationeventpertime in locationeventpertime_list:
-            lat = locationeventpertime["point"]["latitude"]
-            lng = locationeventpertime["point"]["longitude"]
-            #  // 1000 because their ts is in milisec
-            timestamp = locationeventpertime["ts"] // 1000
-            try:
-                pts_t = datetime.datetime.fromtimestamp(timestamp)
-            except Exception as e:
-                #  They dont use unix timestamp...
-                # TODO change me when ppl respect unix timestamp...........
-                _LOGGER.debug(
-                    "invalid timestamp format from streambase - will try to use anyway"
-                )
-                pts_t = datetime.datetime.strptime(str(timestamp)[:-3], "%Y%m%d%H%M%S")
-
-            location = UserLocationPoint(pts_t, lat, lng, user=user)
-            locations.append(location)
-        if len(locations) > 0:
-            locations = sorted(locations, key=lambda x: x._pts_t)
-        return locations
+        gps_streambase = gps_streambase[0]
+        if "data" not in gps_streambase:
+            _LOGGER.warn(f"no data for user {user} from streambase {gps_streambase}")
+            return []
+        columns = _location_columns(gps_streambase["data"]["locationeventpertime"])
+        return _columns_to_user_locations(columns, user)
 
     def get_users(self):
-        return list(self._users_locations.keys())
+        return list(self._users)
 
     def get_locations(self, user_id: str, max_n: Optional[int] = None):
+        if self._lazy_locations is not None:
+            locations = self._lazy_locations.get(user_id)
+            if locations is None:
+                return []
+            return locations[:max_n]
         try:
             return self._users_locations[user_id][:max_n]
         except KeyError:
             return []
 
     def get_locations_all_users(self, max_n: Optional[int] = None):
+        """locations of all the users
+
+        In lazy mode, the locations of all the users are loaded again, one user
+        after the other, and all of them are kept in the result. Use get_users and
+        get_locations to have one user at a time
+        """
+        if self._lazy_locations is not None:
+            #  all the users are loaded one after the other
+            return [l for user in self._users for l in self.get_locations(user, max_n)]
         return [
             l for locations in self._users_locations.values() for l in locations[:max_n]
         ]
@@ -208,46 +473,131 @@ class StreambaseLabelsLoader(BaseSourceLabels):
         location_loader: BaseSourceLocations,
         name: str = "Streambase labels loader",
         last_days: int = 14,
+        lazy: Optional[bool] = None,
+        prefetch: int = config.PCB_STREAMBASE_PREFETCH,
+        stay_analysis: Optional[StayAnalysisStore] = None,
     ):
+        """Constructor
+        Args:
+            location_loader: source of the locations
+            name: name of the source
+            last_days: the surveys of the last 100 * last_days days are used
+            lazy: if true, the labels of a user are computed when first asked and
+                  only the labels of the last user are kept. If None, lazy if the
+                  locations loader is lazy
+            prefetch: in lazy mode, how many surveys of next users are loaded in
+                      background
+            stay_analysis: store of the stay points and stay regions, to share
+                           with the semantic model of the same run
+        """
         super().__init__(name)
         self._location_loader = location_loader
+        if stay_analysis is None:
+            stay_analysis = StayAnalysisStore()
+        self._stay_analysis = stay_analysis
         self._url = config.PCB_STREAMBASE_BATCH_URL
         self._users_places = dict()
         self._users_staypoints = dict()
         self._users_stayregions = dict()
-        for user in self.get_users():
-            #  user_url = self._url + user
-            user_url = self._url
-            surveys = self._load_survey(user=user, url=user_url, last_days=last_days)
-            if "timediariesanswers" not in str(surveys):
-                surveys = None
-            if surveys is None:
-                _LOGGER.debug(f"No surveys for user {user}")
-                continue
-            _LOGGER.debug(f"Loaded {len(surveys)} surveys for user {user}")
-            try:
-                locations = location_loader.get_locations(user)
-                _LOGGER.debug(f"{len(locations)} locations for user {user}")
-                stay_points = estimate_stay_points(locations)
-                _LOGGER.debug(f"{len(stay_points)} staypoints for user {user}")
-                stay_points = sorted(stay_points, key=lambda sp: sp._t_start)
-                stay_regions = estimate_stay_regions(
-                    stay_points, distance_threshold_m=50
-                )
-                _LOGGER.debug(f"{len(stay_regions)} stay_regions for user {user}")
-                self._users_staypoints[user] = stay_points
-                self._users_stayregions[user] = stay_regions
-                self._users_places[user] = self._load_user_places(
-                    user, surveys, stay_regions
-                )
-            except ValueError as e:
-                _LOGGER.debug(f"Can't load labels for user {user}")
+        if lazy is None:
+            lazy = getattr(location_loader, "is_lazy", False)
+        users = self.get_users()
+        self._lazy_surveys: Optional[_PrefetchedUsersData] = None
+        if lazy:
+            self._lazy_surveys = _PrefetchedUsersData(
+                users,
+                lambda user: self._load_survey(
+                    user=user, url=self._url, last_days=last_days
+                ),
+                prefetch,
+            )
+            return
+        client = StreamBaseClient.get_instance()
+        all_surveys = client.map(
+            lambda user: self._load_survey(
+                user=user, url=self._url, last_days=last_days, client=client
+            ),
+            users,
+        )
+        for user, surveys in zip(users, all_surveys):
+            self._add_user(user, surveys)
+
+    def _add_user(self, user: str, surveys: Optional[List[Dict]]):
+        """compute the labels of a user from the surveys"""
+        if "timediariesanswers" not in str(surveys):
+            surveys = None
+        if surveys is None:
+            _LOGGER.debug(f"No surveys for user {user}")
+            return
+        _LOGGER.debug(f"Loaded {len(surveys)} surveys for user {user}")
+        try:
+            locations = self._location_loader.get_locations(user)
+            _LOGGER.debug(f"{len(locations)} locations for user {user}")
+            #  the labels are matched to the stay points in time order
+            stay_points = self._stay_analysis.stay_points(
+                user, locations, sort_by_time=True
+            )
+            _LOGGER.debug(f"{len(stay_points)} staypoints for user {user}")
+            stay_regions = self._stay_analysis.stay_regions(
+                user, locations, sort_by_time=True, distance_threshold_m=50
+            )
+            _LOGGER.debug(f"{len(stay_regions)} stay_regions for user {user}")
+            self._users_staypoints[user] = stay_points
+            self._users_stayregions[user] = stay_regions
+            self._users_places[user] = self._load_user_places(
+                user, surveys, stay_regions
+            )
+        except ValueError as e:
+            _LOGGER.debug(f"Can't load labels for user {user}")
 
     @staticmethod
-    def _load_survey(user: str, url: str, last_days: int):
-        parameters = dict()
+    def _load_survey(
+        user: str,
+        url: str,
+        last_days: int,
+        client: Optional[StreamBaseClient] = None,
+    ):
+        """load the surveys answers of a user, from the store if enabled
+
+        Return:
+            the JSON answer of StreamBase, None if the request failed
+        """
         date_to = datetime.datetime.now()
         date_from = date_to - datetime.timedelta(hours=24 * last_days * 100)
+        store = StreamBaseStore.get_instance()
+        if store is None:
+            return StreambaseLabelsLoader._request_survey(
+                user, url, date_from, date_to, client
+            )
+        surveys = store.sync(
+            user,
+            "timediariesanswers",
+            date_from,
+            date_to,
+            lambda fetch_from: StreambaseLabelsLoader._request_survey(
+                user, url, fetch_from, date_to, client
+            ),
+        )
+        if surveys is None or len(surveys[0]["data"]["timediariesanswers"]) == 0:
+            return None
+        return surveys
+
+    @staticmethod
+    def _request_survey(
+        user: str,
+        url: str,
+        date_from: datetime.datetime,
+        date_to: datetime.datetime,
+        client: Optional[StreamBaseClient] = None,
+    ):
+        """request the surveys answers of a user to StreamBase
+
+        Return:
+            the JSON answer, None if the request failed
+        """
+        if client is None:
+            client = StreamBaseClient.get_instance()
+        parameters = dict()
         date_to_str = date_to.strftime("%Y%m%d%H%M%S") + "000"
         date_from_str = date_from.strftime("%Y%m%d%H%M%S") + "000"
         parameters["from"] = date_from_str
@@ -255,7 +605,7 @@ class StreambaseLabelsLoader(BaseSourceLabels):
         parameters["properties"] = "timediariesanswers"
         parameters["userId"] = user
         try:
-            r = requests.get(
+            r = client.get(
                 url,
                 params=parameters,
                 headers={
@@ -316,12 +666,43 @@ class StreambaseLabelsLoader(BaseSourceLabels):
         return self._location_loader.get_users()
 
     def get_labels(self, user_id: str, max_n: Optional[int] = None):
+        if self._lazy_surveys is not None and user_id not in self._users_places:
+            #  only the labels of the last user are kept
+            self._users_places.clear()
+            self._users_staypoints.clear()
+            self._users_stayregions.clear()
+            self._add_user(user_id, self._lazy_surveys.get(user_id))
         try:
             return self._users_places[user_id][:max_n]
         except KeyError:
             return []
 
+    def __enter__(self) -> StreambaseLabelsLoader:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """stop the background loads of the lazy mode, the locations loader is not
+        closed"""
+        if self._lazy_surveys is not None:
+            self._lazy_surveys.close()
+
     def get_labels_all_users(self, max_n: Optional[int] = None):
+        """labels of all the users
+
+        In lazy mode, the surveys, locations and stay regions of all the users are
+        loaded again, one user after the other, only the labels are kept. Use
+        get_users and get_labels to have one user at a time
+        """
+        if self._lazy_surveys is not None:
+            #  all the users are loaded one after the other
+            return [
+                user_place
+                for user in self.get_users()
+                for user_place in self.get_labels(user)
+            ]
         return [
             user_place
             for sublist in self._users_places.values()
@@ -4,7 +4,12 @@ Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
 Written by William Droz <william.droz@idiap.ch>,
 
 """
-from typing import Any, List, Optional
+from __future__ import annotations
+
+import pickle
+from os import remove
+from os.path import exists, join
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 from regions_builder.data_loading import BaseSourceLabels  # type: ignore
@@ -13,15 +18,103 @@ from regions_builder.data_loading import (
     MockWenetSourceLabels,
     MockWenetSourceLocations,
 )
+from regions_builder.models import LocationPoint  # type: ignore
 
-from personal_context_builder.wenet_analysis import BagOfWordsVectorizer
+from personal_context_builder import config
 from personal_context_builder.wenet_analysis_models import SimpleLDA
+from personal_context_builder.wenet_logger import create_logger
 from personal_context_builder.wenet_trainer import BaseBOWTrainer
 from personal_context_builder.wenet_user_profile_db import (
     DatabaseProfileHandlerBase,
     DatabaseProfileHandlerMock,
 )
 
+_LOGGER = create_logger(__name__)
+
+
+def _locations_days(locations: List[LocationPoint]) -> np.ndarray:
+    """day of each location, as group_by_days_array bins them
+
+    Args:
+        locations: list of locations
+
+    Return:
+        datetime64[D] array
+    """
+    return np.array(
+        [location._pts_t for location in locations], dtype="datetime64[ns]"
+    ).astype("datetime64[D]")
+
+
+def _outputs_per_day(model_instance: Any, X: Any) -> np.ndarray:
+    """outputs of a model for each day
+
+    Args:
+        model_instance: the model, predict gives one row per day or the mean of the days
+        X: vectorized days
+
+    Return:
+        2D array with one row per day
+    """
+    res = model_instance.predict(X)
+    if len(res.shape) == 2:
+        return np.asarray(res, dtype=np.float64)
+    return np.array(
+        [model_instance.predict(X[i : i + 1]) for i in range(X.shape[0])],
+        dtype=np.float64,
+    ).reshape(X.shape[0], -1)
+
+
+class ProfilesSink(object):
+    """Buffer the profiles of a database and write them by chunks with set_profiles
+
+    The producer is blocked while a full chunk is written, so at most chunk_size
+    profiles are kept in memory. flush has to be called after the last profile
+    """
+
+    def __init__(
+        self,
+        database_instance: DatabaseProfileHandlerBase,
+        chunk_size: int = config.PCB_PROFILES_WRITE_CHUNK_SIZE,
+    ):
+        """Constructor
+        Args:
+            database_instance: database where the profiles are written
+            chunk_size: number of profiles written at once
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        self._database_instance = database_instance
+        self._chunk_size = chunk_size
+        self._user_ids: List[str] = []
+        self._vectors: List[List[float]] = []
+
+    def __enter__(self) -> ProfilesSink:
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def add(self, user_id: str, vector: List[float]):
+        """add a profile, write the chunk if it is full
+        Args:
+            user_id: user to update
+            vector: profile to use
+        """
+        self._user_ids.append(user_id)
+        self._vectors.append(vector)
+        if len(self._user_ids) >= self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        """write the buffered profiles"""
+        if len(self._user_ids) == 0:
+            return
+        _LOGGER.debug(f"write {len(self._user_ids)} profiles")
+        self._database_instance.set_profiles(self._user_ids, self._vectors)
+        self._user_ids = []
+        self._vectors = []
+
 
 class ProfileWritter(object):
     def __init__(
@@ -31,44 +124,238 @@ class ProfileWritter(object):
         model_instance: Any,
         bow_trainer: BaseBOWTrainer,
         database_instance: DatabaseProfileHandlerBase,
+        incremental: bool = False,
+        state_file: str = config.PCB_PROFILES_STATE_FILE,
+        chunk_size: int = config.PCB_PROFILES_WRITE_CHUNK_SIZE,
+        max_runs: int = config.PCB_PROFILES_INCREMENTAL_MAX_RUNS,
     ):
         """Handle the writting in the db of the profiles
+
+        The profiles are buffered and written by chunks, see ProfilesSink
+
         Args:
             locations_source: data source for location
             labels_source: data source for the labels
             model_instance: instance of the model to use (ML)
             bow_trainer: Bag-Of-Words trainer to use
+            database_instance: database where the profiles are written
+            incremental: if true, only the new days of each user are processed, see
+                         update_profiles
+            state_file: file in PCB_DATA_FOLDER with the state of the users
+            chunk_size: number of profiles written at once in each database
+            max_runs: in incremental mode, the state of a user is built again after
+                      this number of runs
         """
         self._locations_source = locations_source
         self._labels_source = labels_source
         self._model_instance = model_instance
         self._bow_trainer = bow_trainer
         self._database_instance = database_instance
+        self._models_databases = [(model_instance, database_instance)]
+        self._incremental = incremental
+        self._state_file = state_file
+        self._chunk_size = chunk_size
+        self._max_runs = max_runs
+        #  id of the database instance -> sink
+        self._sinks: Dict[int, ProfilesSink] = dict()
+        #  user -> (day -> outputs of each model, stay regions, number of runs)
+        self._state: Dict[
+            str,
+            Tuple[
+                Dict[np.datetime64, List[np.ndarray]],
+                Tuple[List[Any], List[Any]],
+                int,
+            ],
+        ] = dict()
+        if incremental:
+            self._state = self.load_state(state_file)
+
+    @staticmethod
+    def load_state(state_file: str = config.PCB_PROFILES_STATE_FILE) -> Dict:
+        """load the state of the incremental profiles
+        Args:
+            state_file: file in PCB_DATA_FOLDER
+        Return:
+            dict user -> (day -> outputs of each model, stay regions, number of runs),
+            empty if no file
+        """
+        location = join(config.PCB_DATA_FOLDER, state_file)
+        if not exists(location):
+            return dict()
+        with open(location, "rb") as f:
+            return pickle.load(f)
+
+    @staticmethod
+    def clean_state(state_file: str = config.PCB_PROFILES_STATE_FILE):
+        """delete the state, the next incremental update is a full rebuild
+
+        Should be called when the models are trained again
+        Args:
+            state_file: file in PCB_DATA_FOLDER
+        """
+        location = join(config.PCB_DATA_FOLDER, state_file)
+        if exists(location):
+            remove(location)
+
+    def save_state(self):
+        """save the state of the incremental profiles"""
+        location = join(config.PCB_DATA_FOLDER, self._state_file)
+        with open(location, "wb") as f:
+            pickle.dump(self._state, f)
 
     def update_profiles(self):
-        """update all profiles"""
+        """update all profiles
+
+        The features of each user are computed once and given to all the models,
+        the stay regions and days come from the features cache when enabled.
+
+        In incremental mode, the outputs of the models for each day and the stay
+        regions are kept for each user. Only the days after the last kept day are
+        vectorized, the kept days older than the locations of the user (out of the
+        window of the loader) are dropped and the profile is the mean of the days.
+        The newest day can still receive locations, so it is never kept but
+        recomputed each time. The stay regions are estimated when the state of the
+        user is built, which is done again after max_runs runs (or by clean_state)
+        """
         users_locations = self._locations_source.get_locations_all_users()
-        for user, locations in users_locations.items():
-            X = []
-            bow_user = self._bow_trainer.train(user)
-            for day in BagOfWordsVectorizer.group_by_days(locations, user):
-                data = bow_user.vectorize(day)
-                X.append(data)
-            X = np.array(X).reshape(len(X), -1)
-            res = self._model_instance.predict(X)
-            if len(res.shape) == 2:
-                profile = np.mean(res, axis=0)
-            else:
-                profile = res.copy()
-            self.update_profile(user, profile.tolist())
-
-    def update_profile(self, user: str, profile: List[float]):
-        """update a single profile
+        try:
+            for user, locations in users_locations.items():
+                if self._incremental:
+                    self._update_profile_incremental(user, locations)
+                    continue
+                X = self._bow_trainer.vectorize_user(user, locations)
+                for model_instance, database_instance in self._models_databases:
+                    res = model_instance.predict(X)
+                    if len(res.shape) == 2:
+                        profile = np.mean(res, axis=0)
+                    else:
+                        profile = res.copy()
+                    self.update_profile(user, profile.tolist(), database_instance)
+        finally:
+            self.flush()
+        if self._incremental:
+            self.save_state()
+
+    def _update_profile_incremental(self, user: str, locations: List[LocationPoint]):
+        """update the profiles of a user with its new days
+        Args:
+            user: user to update
+            locations: all the locations of the user
+        """
+        days = _locations_days(locations)
+        if len(days) == 0:
+            return
+        nb_models = len(self._models_databases)
+        state = self._state.get(user)
+        #  states without the days come from an older version
+        if (
+            state is None
+            or len(state) != 3
+            or state[2] >= self._max_runs
+            or any(len(outputs) != nb_models for outputs in state[0].values())
+        ):
+            regions = self._bow_trainer.user_regions(user, locations)
+            state = (dict(), regions, 0)
+        days_outputs, regions, nb_runs = state
+        #  the days out of the window of the loader
+        oldest_day = days.min()
+        days_outputs = {
+            day: outputs for day, outputs in days_outputs.items() if day >= oldest_day
+        }
+        if len(days_outputs) > 0:
+            watermark = max(days_outputs.keys())
+            locations = [
+                location for location, day in zip(locations, days) if day > watermark
+            ]
+        newest_day = days.max()
+        if len(locations) > 0:
+            new_days, X = self._bow_trainer.vectorize_with_regions(regions, locations)
+            new_outputs = [
+                _outputs_per_day(model_instance, X)
+                for model_instance, _ in self._models_databases
+            ]
+        else:
+            new_days = np.empty(0, dtype="datetime64[D]")
+            new_outputs = [np.empty((0, 0)) for _ in self._models_databases]
+        for i, day in enumerate(new_days):
+            #  the newest day is not complete
+            if day < newest_day:
+                days_outputs[day] = [outputs[i] for outputs in new_outputs]
+        nb_days = len(days_outputs) + int(np.sum(new_days >= newest_day))
+        if nb_days == 0:
+            return
+        for model, (_, database_instance) in enumerate(self._models_databases):
+            kept = [outputs[model] for outputs in days_outputs.values()]
+            newest = new_outputs[model][new_days >= newest_day]
+            profile = (np.sum(kept, axis=0) + np.sum(newest, axis=0)) / nb_days
+            self.update_profile(user, profile.tolist(), database_instance)
+        self._state[user] = (days_outputs, regions, nb_runs + 1)
+
+    def update_profile(
+        self,
+        user: str,
+        profile: List[float],
+        database_instance: Optional[DatabaseProfileHandlerBase] = None,
+    ):
+        """update a single profile, buffered until the chunk is full or flush is called
         Args:
             user: user to update
             profile: profile to use
+            database_instance: database to use, default is the one of the writter
+        """
+        if database_instance is None:
+            database_instance = self._database_instance
+        sink = self._sinks.get(id(database_instance))
+        if sink is None:
+            sink = ProfilesSink(database_instance, self._chunk_size)
+            self._sinks[id(database_instance)] = sink
+        sink.add(user, profile)
+
+    def flush(self):
+        """write all the buffered profiles"""
+        for sink in self._sinks.values():
+            sink.flush()
+
+
+class ProfileWritterMultiModels(ProfileWritter):
+    def __init__(
+        self,
+        locations_source: BaseSourceLocations,
+        labels_source: BaseSourceLabels,
+        models_databases: List[Tuple[Any, DatabaseProfileHandlerBase]],
+        bow_trainer: BaseBOWTrainer,
+        incremental: bool = False,
+        state_file: str = config.PCB_PROFILES_STATE_FILE,
+        chunk_size: int = config.PCB_PROFILES_WRITE_CHUNK_SIZE,
+    ):
+        """Handle the writting in the db of the profiles for several models
+
+        Args:
+            locations_source: data source for location
+            labels_source: data source for the labels
+            models_databases: list of (model instance, database instance), the
+                              profiles of each model are written to its database
+            bow_trainer: Bag-Of-Words trainer to use (shared by all models)
+            incremental: if true, only the new days are processed
+            state_file: file in PCB_DATA_FOLDER with the state of the users
+            chunk_size: number of profiles written at once in each database
+            max_runs: in incremental mode, the state of a user is built again after
+                      this number of runs
         """
-        self._database_instance.set_profile(user, profile)
+        if len(models_databases) == 0:
+            raise ValueError("models_databases must not be empty")
+        model_instance, database_instance = models_databases[0]
+        super().__init__(
+            locations_source,
+            labels_source,
+            model_instance,
+            bow_trainer,
+            database_instance,
+            incremental,
+            state_file,
+            chunk_size,
+        )
+        self._models_databases = list(models_databases)
 
 
 class ProfileWritterFromMock(ProfileWritter):
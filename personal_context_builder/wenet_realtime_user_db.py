@@ -7,18 +7,149 @@ Written by William Droz <william.droz@idiap.ch>,
 from __future__ import annotations
 
 import json
+import math
+import struct
 from abc import ABC, abstractmethod
-from datetime import datetime
-from typing import Dict, List
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
 
+import fakeredis  # type: ignore
+import numpy as np
 import redis  # type: ignore
 from regions_builder.models import UserLocationPoint, UserPlace  # type: ignore
+from sklearn.neighbors import BallTree  # type: ignore
 
 from personal_context_builder import config
 from personal_context_builder.wenet_logger import create_logger
 
 _LOGGER = create_logger(__name__)
 
+#  same earth radius as the GEO commands of Redis
+_EARTH_RADIUS_M = 6372797.560856
+
+#  key of the sorted set with the GEO index of the locations, in its own db
+#  (PCB_CLOSEST_USERS_GEO_INDEX_DB) so the keys of the locations are only users
+GEO_INDEX_KEY = "pcb:closest_users:geo"
+#  the index is built under this key and then renamed, so it is never half built
+_GEO_INDEX_BUILD_KEY = GEO_INDEX_KEY + ":build"
+#  GEOSEARCH needs Redis 6.2
+_GEOSEARCH_MIN_VERSION = (6, 2)
+#  GEOADD refuses the latitudes out of the Web Mercator range
+_GEO_MAX_LAT = 85.05112878
+
+
+#  binary locations are 32 bytes, legacy locations are JSON dicts and can't start
+#  with the magic
+_LOCATION_MAGIC = b"PCL"
+_LOCATION_VERSION = 1
+#  magic, version, timestamp (microseconds since epoch), lat, lng, accuracy (NaN
+#  if unknown)
+_LOCATION_STRUCT = struct.Struct("<3sBqddf")
+_EPOCH = datetime(1970, 1, 1)
+
+
+def encode_location(location: UserLocationPoint) -> bytes:
+    """encode a location to be stored in Redis, the user is the key
+
+    Args:
+        location: the location, with a naive datetime, the accuracy can be None
+
+    Return:
+        the encoded location
+    """
+    return _LOCATION_STRUCT.pack(
+        _LOCATION_MAGIC,
+        _LOCATION_VERSION,
+        (location._pts_t - _EPOCH) // timedelta(microseconds=1),
+        location._lat,
+        location._lng,
+        math.nan if location._accuracy_m is None else location._accuracy_m,
+    )
+
+
+def decode_location(user_id: str, value: bytes) -> UserLocationPoint:
+    """decode a stored location, binary or legacy JSON
+
+    Args:
+        user_id: the user of the location
+        value: the encoded location
+
+    Return:
+        the user location
+    """
+    if value[: len(_LOCATION_MAGIC)] != _LOCATION_MAGIC:
+        dict_user_location = json.loads(value)
+        dict_user_location["_pts_t"] = datetime.strptime(
+            dict_user_location["_pts_t"], config.PCB_DATETIME_FORMAT
+        )
+        return UserLocationPoint.from_dict(dict_user_location)
+    _, version, pts_t, lat, lng, accuracy_m = _LOCATION_STRUCT.unpack(value)
+    if version != _LOCATION_VERSION:
+        raise ValueError(f"unknown location version {version}")
+    return UserLocationPoint.from_dict(
+        {
+            "_pts_t": _EPOCH + timedelta(microseconds=pts_t),
+            "_lat": lat,
+            "_lng": lng,
+            "_accuracy_m": None if math.isnan(accuracy_m) else accuracy_m,
+            "_user": user_id,
+        }
+    )
+
+
+def _geo_indexable(location: UserLocationPoint) -> bool:
+    """true if GEOADD accepts the coordinates of the location"""
+    return bool(
+        np.isfinite(location._lat)
+        and np.isfinite(location._lng)
+        and abs(location._lat) <= _GEO_MAX_LAT
+        and abs(location._lng) <= 180
+    )
+
+
+def _haversine_m(
+    lat: float, lng: float, lats: np.ndarray, lngs: np.ndarray
+) -> np.ndarray:
+    """distances in meters from (lat, lng) to the points (lats, lngs)"""
+    lat, lng, lats, lngs = map(np.radians, (lat, lng, lats, lngs))
+    a = (
+        np.sin((lats - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2
+    )
+    return 2 * _EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def fake_users_locations(
+    nb_users: int = config.PCB_MOCK_REALTIME_NB_USERS,
+    seed: int = config.PCB_MOCK_REALTIME_SEED,
+) -> List[UserLocationPoint]:
+    """generate the same fake locations for a given seed, one per user
+
+    The users are mock_user_0 to mock_user_{nb_users - 1}, in a box of about
+    100km around PCB_MOCK_REALTIME_CENTER_LAT, PCB_MOCK_REALTIME_CENTER_LNG
+
+    Args:
+        nb_users: how many users
+        seed: seed of the random generator
+
+    Return:
+        list of users locations
+    """
+    rng = np.random.default_rng(seed)
+    lats = config.PCB_MOCK_REALTIME_CENTER_LAT + rng.uniform(-0.5, 0.5, nb_users)
+    lngs = config.PCB_MOCK_REALTIME_CENTER_LNG + rng.uniform(-0.5, 0.5, nb_users)
+    seconds = rng.integers(0, 24 * 60 * 60, nb_users)
+    start = datetime(2021, 1, 1)
+    return [
+        UserLocationPoint(
+            start + timedelta(seconds=int(second)),
+            float(lat),
+            float(lng),
+            user=f"mock_user_{i}",
+        )
+        for i, (lat, lng, second) in enumerate(zip(lats, lngs, seconds))
+    ]
+
 
 class DatabaseRealtimeLocationsHandlerBase(ABC):
     """Base interface for handling database access for the Realtime locations of the user
@@ -38,7 +169,7 @@ class DatabaseRealtimeLocationsHandlerBase(ABC):
         Can be have multiple instance when multiple db_index are used
         """
         if db_index not in cls._INSTANCES:
-            cls._INSTANCES[db_index] = cls(*args, **kwargs)
+            cls._INSTANCES[db_index] = cls(*args, db_index=db_index, **kwargs)
         return cls._INSTANCES[db_index]
 
     @abstractmethod
@@ -53,15 +184,60 @@ class DatabaseRealtimeLocationsHandlerBase(ABC):
     def get_users(self, users_id: str):
         """get some users"""
 
+    @abstractmethod
+    def closest_users(
+        self, lat: float, lng: float, N: int
+    ) -> List[Tuple[int, UserLocationPoint]]:
+        """the N closest users to the point (lat, lng)
+
+        Args:
+            lat: the latitude
+            lng: the longitude
+            N: how many users (max)
+
+        Return:
+            list of (distance in meters, user location) by increasing distance
+        """
+
 
 class DatabaseRealtimeLocationsHandlerMock(DatabaseRealtimeLocationsHandlerBase):
     def __init__(self, db_index: int = 0):
         self._my_dict: Dict[str, UserPlace] = dict()
+        #  ball tree over the locations, built again at the first query after updates
+        self._tree: Optional[BallTree] = None
+        self._tree_users: List[str] = []
 
     def update(self, userplaces: List[UserPlace]):
         _LOGGER.info("mock update real-time user locations")
         for userplace in userplaces:
             self._my_dict[userplace._user] = userplace
+        self._tree = None
+
+    def _build_tree(self):
+        """build the ball tree of the locations, with the haversine metric"""
+        self._tree_users = list(self._my_dict.keys())
+        coordinates = np.radians(
+            [
+                (self._my_dict[user]._lat, self._my_dict[user]._lng)
+                for user in self._tree_users
+            ]
+        )
+        self._tree = BallTree(coordinates, metric="haversine")
+
+    def closest_users(
+        self, lat: float, lng: float, N: int
+    ) -> List[Tuple[int, UserLocationPoint]]:
+        if len(self._my_dict) == 0:
+            return []
+        if self._tree is None:
+            self._build_tree()
+        distances, indexes = self._tree.query(
+            np.radians([(lat, lng)]), k=min(N, len(self._tree_users))
+        )
+        return [
+            (int(distance * _EARTH_RADIUS_M), self._my_dict[self._tree_users[index]])
+            for distance, index in zip(distances[0], indexes[0])
+        ]
 
     def get_all_users(self):
         _LOGGER.info("mock get all real-time location of users")
@@ -78,6 +254,9 @@ class DatabaseRealtimeLocationsHandlerMock(DatabaseRealtimeLocationsHandlerBase)
 class DatabaseRealtimeLocationsHandler(DatabaseRealtimeLocationsHandlerBase):
     """Handle database to the redis server for real-time data
 
+    The GEO index of the closest users is kept in the db geo_db_index of the same
+    server, the db of the locations only has the keys of the real-time service
+
     Not thread safe
 
     """
@@ -87,8 +266,21 @@ class DatabaseRealtimeLocationsHandler(DatabaseRealtimeLocationsHandlerBase):
         db_index: int = 0,
         host: str = config.PCB_REALTIME_REDIS_HOST,
         port: int = config.PCB_REALTIME_REDIS_PORT,
+        use_fake: bool = config.PCB_IS_UNITTESTING,
+        geo_db_index: int = config.PCB_CLOSEST_USERS_GEO_INDEX_DB,
     ):
-        self._server = redis.Redis(host=host, port=port, db=db_index)
+        if geo_db_index == db_index:
+            raise ValueError("the GEO index needs its own db")
+        #  None until the server is asked
+        self._has_geosearch: Optional[bool] = None
+        self._use_fake = use_fake
+        if not use_fake:
+            self._server = redis.Redis(host=host, port=port, db=db_index)
+            self._geo_server = redis.Redis(host=host, port=port, db=geo_db_index)
+        else:
+            fake_server = fakeredis.FakeServer()
+            self._server = fakeredis.FakeRedis(server=fake_server, db=db_index)
+            self._geo_server = fakeredis.FakeRedis(server=fake_server, db=geo_db_index)
         try:
             self._server.ping()
         except:  # TODO catch specific exception
@@ -99,40 +291,180 @@ class DatabaseRealtimeLocationsHandler(DatabaseRealtimeLocationsHandlerBase):
         _LOGGER.info("update real-time user locations")
         pipeline = self._server.pipeline()
         for userplace in userplaces:
-            userplace._pts_t = userplace._pts_t.strftime(config.PCB_DATETIME_FORMAT)
-            value = json.dumps(userplace.__dict__)
-            pipeline.set(userplace._user, value)
+            pipeline.set(userplace._user, encode_location(userplace))
         pipeline.execute()
+        if not self.has_geosearch():
+            return
+        geo_pipeline = self._geo_server.pipeline()
+        for userplace in userplaces:
+            if _geo_indexable(userplace):
+                geo_pipeline.geoadd(
+                    GEO_INDEX_KEY, (userplace._lng, userplace._lat, userplace._user)
+                )
+        geo_pipeline.execute()
 
-    def get_all_users(self):
-        """get all users locations
+    def rebuild_geo_index(self, ttl_s: int = config.PCB_CLOSEST_USERS_GEO_INDEX_TTL_S):
+        """index again the locations of all users
+
+        The locations are mostly written by the real-time service, without the
+        index, so the index expires after ttl_s and is built again by the next query.
+        The locations out of the range of GEOADD are not indexed
+
+        Args:
+            ttl_s: time to live of the index in seconds
+        """
+        _LOGGER.info("rebuild the GEO index of the real-time users locations")
+        users_locations = self.get_all_users()
+        pipeline = self._geo_server.pipeline()
+        pipeline.delete(_GEO_INDEX_BUILD_KEY)
+        nb_indexed = 0
+        for user_id, location in users_locations.items():
+            if not _geo_indexable(location):
+                _LOGGER.debug(f"location of {user_id} can't be GEO indexed")
+                continue
+            pipeline.geoadd(
+                _GEO_INDEX_BUILD_KEY, (location._lng, location._lat, user_id)
+            )
+            nb_indexed += 1
+        if nb_indexed > 0:
+            pipeline.expire(_GEO_INDEX_BUILD_KEY, ttl_s)
+            pipeline.rename(_GEO_INDEX_BUILD_KEY, GEO_INDEX_KEY)
+        else:
+            pipeline.delete(GEO_INDEX_KEY)
+        pipeline.execute()
+
+    def has_geosearch(self) -> bool:
+        """true if the server knows GEOSEARCH (Redis >= 6.2)"""
+        if self._has_geosearch is None and self._use_fake:
+            #  fakeredis doesn't implement INFO, and older versions have no GEO
+            try:
+                self._geo_server.geosearch(
+                    GEO_INDEX_KEY, longitude=0, latitude=0, radius=1, unit="m"
+                )
+                self._has_geosearch = True
+            except redis.ResponseError:
+                self._has_geosearch = False
+        if self._has_geosearch is None:
+            version = self._server.info("server")["redis_version"]
+            self._has_geosearch = (
+                tuple(int(number) for number in version.split(".")[:2])
+                >= _GEOSEARCH_MIN_VERSION
+            )
+            if not self._has_geosearch:
+                _LOGGER.warn(
+                    f"Redis {version} doesn't know GEOSEARCH, closest users are found by a full scan"
+                )
+        return self._has_geosearch
+
+    def _closest_users_scan(
+        self, lat: float, lng: float, N: int
+    ) -> List[Tuple[int, UserLocationPoint]]:
+        """the N closest users to the point (lat, lng), from all the locations"""
+        users_locations = list(self.get_all_users().values())
+        if len(users_locations) == 0:
+            return []
+        distances = _haversine_m(
+            lat,
+            lng,
+            np.array([location._lat for location in users_locations]),
+            np.array([location._lng for location in users_locations]),
+        )
+        closest = np.argsort(distances, kind="stable")[:N]
+        return [(int(distances[i]), users_locations[i]) for i in closest]
+
+    def closest_users(
+        self, lat: float, lng: float, N: int
+    ) -> List[Tuple[int, UserLocationPoint]]:
+        """the N closest users to the point (lat, lng), with GEOSEARCH
+
+        The radius of the search starts at PCB_CLOSEST_USERS_RADIUS_M and is doubled
+        until N users are found or the whole earth is covered. The GEO index is
+        built again when it expired (see rebuild_geo_index). Without GEOSEARCH
+        (Redis < 6.2), all the locations are scanned
+
+        Args:
+            lat: the latitude
+            lng: the longitude
+            N: how many users (max)
+
+        Return:
+            list of (distance in meters, user location) by increasing distance
+        """
+        if not self.has_geosearch():
+            return self._closest_users_scan(lat, lng, N)
+        #  -2 if the index doesn't exist, -1 if it was created by update() only
+        if self._geo_server.ttl(GEO_INDEX_KEY) < 0:
+            self.rebuild_geo_index()
+        nb_users = self._geo_server.zcard(GEO_INDEX_KEY)
+        radius = config.PCB_CLOSEST_USERS_RADIUS_M
+        while True:
+            found = self._geo_server.geosearch(
+                GEO_INDEX_KEY,
+                longitude=lng,
+                latitude=lat,
+                radius=radius,
+                unit="m",
+                sort="ASC",
+                count=N,
+                withdist=True,
+            )
+            if len(found) >= min(N, nb_users) or radius > np.pi * _EARTH_RADIUS_M:
+                break
+            radius *= 2
+        users_id = [user_id.decode("utf-8") for user_id, _ in found]
+        locations = self.get_users(users_id)
+        return [
+            (int(distance), locations[user_id])
+            for user_id, (_, distance) in zip(users_id, found)
+            if user_id in locations
+        ]
+
+    def _mget_locations(self, users_id: List[str]) -> Dict[str, UserLocationPoint]:
+        """get the locations of users with one MGET, missing users are skipped"""
+        if len(users_id) == 0:
+            return dict()
+        values = self._server.mget(users_id)
+        return {
+            user_id: decode_location(user_id, value)
+            for user_id, value in zip(users_id, values)
+            if value is not None
+        }
+
+    def get_all_users(self, batch_size: int = config.PCB_REALTIME_BATCH_SIZE):
+        """get all users locations, with SCAN and one MGET per batch
+
+        Args:
+            batch_size: about how many users per batch
 
         Return:
             dict with user_id -> UserLocationPoint
         """
         _LOGGER.info("get all real-time users locations")
         my_dict = dict()
-        for key in self._server.scan_iter():
-            dict_user_location = json.loads(self._server.get(key))
-            dict_user_location["_pts_t"] = datetime.strptime(
-                dict_user_location["_pts_t"], config.PCB_DATETIME_FORMAT
-            )
-            my_dict[key.decode("utf-8")] = UserLocationPoint.from_dict(
-                dict_user_location
-            )
-        return my_dict
+        cursor = 0
+        while True:
+            cursor, keys = self._server.scan(cursor, count=batch_size)
+            users_id = [key.decode("utf-8") for key in keys]
+            my_dict.update(self._mget_locations(users_id))
+            if cursor == 0:
+                return my_dict
 
-    def get_users(self, users_id: str):
-        """get some users locations
+    def get_users(
+        self,
+        users_id: Iterable[str],
+        batch_size: int = config.PCB_REALTIME_BATCH_SIZE,
+    ):
+        """get some users locations, with one MGET per batch
         Args:
             users_id -> list of user_id
+            batch_size -> how many users per MGET
 
         Return:
-            dict with user_id -> UserLocationPoint
+            dict with user_id -> UserLocationPoint, without the unknown users
         """
-        _LOGGER.info("mock get real-time location of some users")
+        _LOGGER.info("get real-time location of some users")
+        users_id = list(users_id)
         new_dict = dict()
-        for user_id in users_id:
-            user_location_dict = json.loads(self._server.get(user_id))
-            new_dict[user_id] = UserLocationPoint.from_dict(user_location_dict)
+        for start in range(0, len(users_id), batch_size):
+            new_dict.update(self._mget_locations(users_id[start : start + batch_size]))
         return new_dict
@@ -0,0 +1,197 @@
+""" module with a spatial index over the stay regions of a user
+
+The index is a uniform grid over the bounding boxes of the regions, so a location
+is only tested against the few regions that overlap its cell.
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+
+"""
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from regions_builder.models import LabelledStayRegion, StayRegion  # type: ignore
+
+from personal_context_builder import config
+
+#  cells are keyed by lat_cell * _CELL_KEY_OFFSET + lng_cell
+_CELL_KEY_OFFSET = 1 << 32
+
+
+def _regions_bounds(regions: List[StayRegion]) -> np.ndarray:
+    """stack the bounding boxes of the regions
+
+    Args:
+        regions: list of (labelled) stay regions
+
+    Return:
+        array of shape (n_regions, 4) with min_lat, max_lat, min_lng, max_lng
+    """
+    bounds = np.empty((len(regions), 4), dtype=np.float64)
+    for i, region in enumerate(regions):
+        bounds[i, 0:2] = sorted((region._topleft_lat, region._bottomright_lat))
+        bounds[i, 2:4] = sorted((region._topleft_lng, region._bottomright_lng))
+    return bounds
+
+
+def _points_in_bounds(
+    lats: np.ndarray, lngs: np.ndarray, bounds: np.ndarray
+) -> np.ndarray:
+    """test all points against all bounding boxes at once
+
+    Args:
+        lats: 1D array of latitudes
+        lngs: 1D array of longitudes
+        bounds: array of bounding boxes, as given by _regions_bounds
+
+    Return:
+        boolean array of shape (n_points, n_regions)
+    """
+    lats = lats[:, np.newaxis]
+    lngs = lngs[:, np.newaxis]
+    return (
+        (bounds[:, 0] <= lats)
+        & (lats <= bounds[:, 1])
+        & (bounds[:, 2] <= lngs)
+        & (lngs <= bounds[:, 3])
+    )
+
+
+class _RegionsGrid(object):
+    """uniform grid over the bounding boxes of a list of regions
+
+    The regions with invalid bounds (NaN or infinite) or over more than max_cells
+    cells are not put in the grid, they are tested against every location
+    """
+
+    def __init__(
+        self,
+        regions: List[StayRegion],
+        cell_deg: float,
+        max_cells: int = config.PCB_REGIONS_INDEX_MAX_CELLS,
+    ):
+        self._cell_deg = cell_deg
+        self._bounds = _regions_bounds(regions)
+        cells: Dict[int, List[int]] = defaultdict(list)
+        fallback = []
+        for i, (min_lat, max_lat, min_lng, max_lng) in enumerate(self._bounds):
+            if not np.isfinite(self._bounds[i]).all():
+                fallback.append(i)
+                continue
+            lat_cells = range(
+                int(np.floor(min_lat / cell_deg)), int(np.floor(max_lat / cell_deg)) + 1
+            )
+            lng_cells = range(
+                int(np.floor(min_lng / cell_deg)), int(np.floor(max_lng / cell_deg)) + 1
+            )
+            if len(lat_cells) * len(lng_cells) > max_cells:
+                fallback.append(i)
+                continue
+            for lat_cell in lat_cells:
+                for lng_cell in lng_cells:
+                    cells[lat_cell * _CELL_KEY_OFFSET + lng_cell].append(i)
+        #  regions are appended in order, so each cell keeps the priority of the list
+        self._cells = {key: np.array(ids) for key, ids in cells.items()}
+        self._fallback = np.array(fallback, dtype=np.int64)
+
+    def first_region(self, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+        """index of the first region that contains each point
+
+        Args:
+            lats: 1D array of latitudes, NaN for no data
+            lngs: 1D array of longitudes, NaN for no data
+
+        Return:
+            1D array with the region index or -1 if outside all the regions
+        """
+        res = np.full(lats.shape[0], -1, dtype=np.int64)
+        if len(self._cells) == 0 and len(self._fallback) == 0:
+            return res
+        points = np.flatnonzero(~(np.isnan(lats) | np.isnan(lngs)))
+        if len(points) == 0:
+            return res
+        lat_cells = np.floor(lats[points] / self._cell_deg).astype(np.int64)
+        lng_cells = np.floor(lngs[points] / self._cell_deg).astype(np.int64)
+        keys = lat_cells * _CELL_KEY_OFFSET + lng_cells
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        splits = np.cumsum(np.bincount(inverse))[:-1]
+        for key, cell_points in zip(unique_keys, np.split(points[order], splits)):
+            candidates = self._cells.get(key)
+            if candidates is None:
+                continue
+            inside = _points_in_bounds(
+                lats[cell_points], lngs[cell_points], self._bounds[candidates]
+            )
+            found = inside.any(axis=1)
+            res[cell_points[found]] = candidates[inside[found].argmax(axis=1)]
+        if len(self._fallback) > 0:
+            inside = _points_in_bounds(
+                lats[points], lngs[points], self._bounds[self._fallback]
+            )
+            found = inside.any(axis=1)
+            fallback_res = np.where(found, self._fallback[inside.argmax(axis=1)], -1)
+            grid_res = res[points]
+            #  the region first in the list wins, from the grid or the fallback
+            use_fallback = found & ((grid_res < 0) | (fallback_res < grid_res))
+            res[points[use_fallback]] = fallback_res[use_fallback]
+        return res
+
+
+class RegionsIndex(object):
+    """Spatial index over the labelled and unlabelled stay regions of a user
+
+    Lookups keep the order of the lists: the first labelled region that contains
+    a location wins, the unlabelled regions are checked independently
+    """
+
+    def __init__(
+        self,
+        labelled_stay_regions: Optional[List[LabelledStayRegion]],
+        stay_regions: Optional[List[StayRegion]],
+        cell_deg: float = config.PCB_REGIONS_INDEX_CELL_DEG,
+    ):
+        """Constructor
+        Args:
+            labelled_stay_regions: the labelled stay regions
+            stay_regions: the unlabelled stay regions
+            cell_deg: size of the cells of the grid in degrees
+        """
+        if labelled_stay_regions is None:
+            labelled_stay_regions = []
+        if stay_regions is None:
+            stay_regions = []
+        self._labels = [region._label for region in labelled_stay_regions]
+        self._labelled_grid = _RegionsGrid(labelled_stay_regions, cell_deg)
+        self._stay_grid = _RegionsGrid(stay_regions, cell_deg)
+
+    def words(
+        self, lats: np.ndarray, lngs: np.ndarray, regions_mapping: Dict[str, int]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """find the regions of the locations
+
+        Args:
+            lats: 1D array of latitudes, NaN for no data
+            lngs: 1D array of longitudes, NaN for no data
+            regions_mapping: mapping from the labels to the words
+
+        Return:
+            tuple with the word of the first labelled region that contains the location
+            (-1 if none) and a boolean array that is True when the location is
+            inside an unlabelled region
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        labels_words = np.array(
+            [
+                regions_mapping.get(label, regions_mapping["unknown_labelled_region"])
+                for label in self._labels
+            ]
+            + [-1],
+            dtype=np.int64,
+        )
+        #  -1 (not in a labelled region) picks the trailing -1 of labels_words
+        labelled_words = labels_words[self._labelled_grid.first_region(lats, lngs)]
+        in_stay_region = self._stay_grid.first_region(lats, lngs) >= 0
+        return labelled_words, in_stay_region
@@ -11,21 +11,30 @@ Written by William Droz <william.droz@idiap.ch>,
 
 from collections import defaultdict
 from pprint import pprint
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
-from regions_builder.algorithms import estimate_stay_points  # type: ignore
-from regions_builder.algorithms import estimate_stay_regions, labelize_stay_region
+from regions_builder.algorithms import labelize_stay_region  # type: ignore
 from regions_builder.data_loading import BaseSourceLabels  # type: ignore
 from regions_builder.data_loading import BaseSourceLocations
 from regions_builder.models import LabelledStayRegion  # type: ignore
 from regions_builder.models import LocationPoint, StayRegion
 
 from personal_context_builder import config
-from personal_context_builder.wenet_analysis import BagOfWordsVectorizer, _loads_regions
+from personal_context_builder.wenet_analysis import (
+    BagOfWordsVectorizer,
+    _loads_regions,
+    _locations_to_arrays,
+)
 from personal_context_builder.wenet_exceptions import SemanticRoutinesComputationError
+from personal_context_builder.wenet_features_cache import (
+    cached_features,
+    stay_parameters,
+)
 from personal_context_builder.wenet_logger import create_logger
 from personal_context_builder.wenet_profile_manager import Label
+from personal_context_builder.wenet_regions_index import RegionsIndex
+from personal_context_builder.wenet_stay_analysis import StayAnalysisStore
 
 _LOGGER = create_logger(__name__)
 
@@ -37,31 +46,48 @@ class SemanticModel(object):
         labels_source: BaseSourceLabels,
         name: str = "unknown_semantic_model",
         regions_mapping_file: str = config.PCB_REGION_MAPPING_FILE,
+        stay_analysis: Optional[StayAnalysisStore] = None,
     ):
         """Constructor
         Args:
             locations_source: source of the locations
             labels_sources: source of the labels
             name: name of the model
+            stay_analysis: store of the stay points and stay regions, to share
+                           with the labels source of the same run
         """
         self._locations_source = locations_source
         self._labels_source = labels_source
         self._name = name
         self._regions_mapping = _loads_regions(regions_mapping_file)
+        if stay_analysis is None:
+            stay_analysis = StayAnalysisStore()
+        self._stay_analysis = stay_analysis
 
-    def _compute_indexed_weekday_locations(self, user_id: str):
-        locations = self._locations_source.get_locations(user_id)
-        if len(locations) == 0:
-            raise SemanticRoutinesComputationError(f"no locations for user {user_id}")
-        stay_points = estimate_stay_points(locations)
+    @staticmethod
+    def _estimate_regions(
+        user_id: str,
+        locations: List[LocationPoint],
+        user_places: List,
+        stay_analysis: StayAnalysisStore,
+    ) -> Tuple[List[LabelledStayRegion], List[StayRegion]]:
+        """estimate the labelled and unlabelled stay regions of a user
+        Args:
+            user_id: the user
+            locations: locations of the user
+            user_places: labels of the user
+            stay_analysis: store of the stay points and stay regions
+
+        Returns: tuple with the labelled stay regions and the unlabelled stay regions
+        """
+        stay_points = stay_analysis.stay_points(user_id, locations)
         if len(stay_points) == 0:
             raise SemanticRoutinesComputationError(f"no stay_points for user {user_id}")
-        stay_regions = estimate_stay_regions(stay_points)
+        stay_regions = stay_analysis.stay_regions(user_id, locations)
         if len(stay_regions) == 0:
             raise SemanticRoutinesComputationError(
                 f"no stay_regions for user {user_id}"
             )
-        user_places = self._labels_source.get_labels(user_id)
         if len(user_places) == 0 and not config.PCB_FILL_UNKNOWN:
             raise SemanticRoutinesComputationError(f"no user_places for user {user_id}")
         labelled_stay_regions = labelize_stay_region(
@@ -72,6 +98,23 @@ class SemanticModel(object):
                 f"no labelled_stay_regions for user {user_id}"
             )
         stay_regions = list(set(stay_regions) - set(labelled_stay_regions))
+        return labelled_stay_regions, stay_regions
+
+    def _compute_indexed_weekday_locations(self, user_id: str):
+        locations = self._locations_source.get_locations(user_id)
+        if len(locations) == 0:
+            raise SemanticRoutinesComputationError(f"no locations for user {user_id}")
+        user_places = self._labels_source.get_labels(user_id)
+        labelled_stay_regions, stay_regions = cached_features(
+            user_id,
+            "semantic_stay_regions",
+            lambda: self._estimate_regions(
+                user_id, locations, user_places, self._stay_analysis
+            ),
+            locations,
+            user_places,
+            (config.PCB_FILL_UNKNOWN,) + stay_parameters(),
+        )
         all_days_locations = BagOfWordsVectorizer.group_by_days(locations, user_id)
         indexed_weekday_locations = self.index_per_weekday(all_days_locations)
         return indexed_weekday_locations, labelled_stay_regions, stay_regions
@@ -154,16 +197,15 @@ class SemanticModelHist(SemanticModel):
         labels_count: Dict[int, Dict[str, Dict[str, float]]] = defaultdict(
             lambda: defaultdict(lambda: defaultdict(lambda: 0))
         )
+        regions_index = RegionsIndex(labelled_stay_regions, stay_regions)
         for weekday, days_locations in indexed_weekday_locations.items():
             for day_locations in days_locations:
-                for location in day_locations:
-                    self._fill_with_labels_count(
-                        location,
-                        labels_count,
-                        weekday,
-                        labelled_stay_regions,
-                        stay_regions,
-                    )
+                self._fill_with_labels_count(
+                    day_locations,
+                    labels_count,
+                    weekday,
+                    regions_index,
+                )
         labels_dist = self._compute_labels_dist(labels_count)
 
         return labels_dist, labelled_stay_regions
@@ -187,46 +229,33 @@ class SemanticModelHist(SemanticModel):
 
     def _fill_with_labels_count(
         self,
-        location: LocationPoint,
+        day_locations: List[LocationPoint],
         labels_count: Dict[int, Dict[str, Dict[str, float]]],
         weekday: int,
-        labelled_stay_regions: List[LabelledStayRegion],
-        stay_regions: List[StayRegion],
+        regions_index: RegionsIndex,
     ):
         """determine the labels and fill hierarchically labels_count with
             the number of each labels per timeslot per weekday
         Args:
-            location: location point to check
+            day_locations: location points of a day to check
             labels_count: hierarchical labels count (dict of dict of dict)
             weekday: day of the week (number)
-            labelled_stay_regions: the labelled stay regions
-            stay_regions: the unlabelled stay regions
+            regions_index: index over the labelled and unlabelled stay regions
         """
-        if location is None or np.isnan(location._lat):
-            labels_count[weekday][location._pts_t.strftime("%H:%M:%S")][
-                self._regions_mapping["no_data"]
-            ] += 1
-        else:
-            is_in_region = False
-            for region in labelled_stay_regions:
-                if location in region:
-                    if region._label in self._regions_mapping:
-                        label = self._regions_mapping[region._label]
-                    else:
-                        label = self._regions_mapping["unknown_labelled_region"]
-                    labels_count[weekday][location._pts_t.strftime("%H:%M:%S")][
-                        label
-                    ] += 1
-                    is_in_region = True
-                    break
-            for region in stay_regions:
-                if location in region:
-                    labels_count[weekday][location._pts_t.strftime("%H:%M:%S")][
-                        self._regions_mapping["unknown_region"]
-                    ] += 1
-                    is_in_region = True
-                    break
-            if not is_in_region:
-                labels_count[weekday][location._pts_t.strftime("%H:%M:%S")][
-                    self._regions_mapping["unknown"]
-                ] += 1
+        lats, lngs = _locations_to_arrays(day_locations)
+        labelled_words, in_stay = regions_index.words(lats, lngs, self._regions_mapping)
+        for location, lat, labelled_word, is_in_stay in zip(
+            day_locations, lats, labelled_words, in_stay
+        ):
+            time_slot_count = labels_count[weekday][
+                location._pts_t.strftime("%H:%M:%S")
+            ]
+            if np.isnan(lat):
+                time_slot_count[self._regions_mapping["no_data"]] += 1
+                continue
+            if labelled_word >= 0:
+                time_slot_count[int(labelled_word)] += 1
+            if is_in_stay:
+                time_slot_count[self._regions_mapping["unknown_region"]] += 1
+            if labelled_word < 0 and not is_in_stay:
+                time_slot_count[self._regions_mapping["unknown"]] += 1
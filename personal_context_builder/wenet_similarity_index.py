@@ -0,0 +1,210 @@
+""" module with an index over the routines of a model to find similar users
+
+The routines are compared with the cosine distance. Small sets are searched by
+brute force with NumPy, large sets use an HNSW index when hnswlib is installed.
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+
+"""
+from __future__ import annotations
+
+import pickle
+import tempfile
+from os import remove, replace
+from os.path import exists, getmtime, join
+from typing import Dict, Iterable, List, Optional, Tuple, Type
+
+import numpy as np
+
+from personal_context_builder import config
+from personal_context_builder.wenet_logger import create_logger
+from personal_context_builder.wenet_user_profile_db import (
+    DatabaseProfileHandlerBase,
+)
+
+try:
+    import hnswlib  # type: ignore
+except ImportError:  # pragma: no cover
+    hnswlib = None
+
+_LOGGER = create_logger(__name__)
+
+
+def similarity_index_filename(db_index: int) -> str:
+    """file in PCB_DATA_FOLDER of the index of a model
+
+    Args:
+        db_index: database index of the model
+
+    Return:
+        the filename
+    """
+    return f"_similarity_index_{db_index:02d}.p"
+
+
+class SimilarityIndex(object):
+    """Index over the routines of a model, by cosine distance"""
+
+    def __init__(
+        self,
+        user_ids: Optional[List[str]] = None,
+        routines: Optional[np.ndarray] = None,
+        use_hnsw: Optional[bool] = None,
+    ):
+        """Constructor
+        Args:
+            user_ids: users of the routines
+            routines: 2D array with one routine per row
+            use_hnsw: if None, HNSW is used when hnswlib is installed and there are at
+                      least PCB_SIMILARITY_INDEX_HNSW_MIN_SIZE routines
+        """
+        if user_ids is None:
+            user_ids = []
+        if routines is None:
+            routines = np.empty((0, 0), dtype=np.float32)
+        self._user_ids = list(user_ids)
+        self._rows = {user_id: row for row, user_id in enumerate(self._user_ids)}
+        routines = np.asarray(routines, dtype=np.float32)
+        norms = np.linalg.norm(routines, axis=1, keepdims=True)
+        #  empty routines stay at zero, at distance 1 of all routines
+        norms[norms == 0] = 1
+        self._routines = routines / norms
+        if use_hnsw is None:
+            use_hnsw = (
+                hnswlib is not None
+                and len(self._user_ids) >= config.PCB_SIMILARITY_INDEX_HNSW_MIN_SIZE
+            )
+        self._hnsw = None
+        if use_hnsw:
+            self._hnsw = hnswlib.Index(space="cosine", dim=self._routines.shape[1])
+            self._hnsw.init_index(
+                max_elements=len(self._user_ids), ef_construction=200, M=16
+            )
+            self._hnsw.add_items(self._routines, np.arange(len(self._user_ids)))
+
+    @classmethod
+    def from_profiles(
+        cls, profiles: Iterable[Tuple[str, List[float]]], **kwargs
+    ) -> SimilarityIndex:
+        """build the index from the profiles of a database
+        Args:
+            profiles: iterable over (user_id, routine)
+        Return:
+            the index
+        """
+        user_ids = []
+        routines = []
+        for user_id, routine in profiles:
+            user_ids.append(user_id)
+            routines.append(routine)
+        if len(routines) == 0:
+            return cls(**kwargs)
+        return cls(user_ids, np.array(routines, dtype=np.float32), **kwargs)
+
+    def __len__(self) -> int:
+        return len(self._user_ids)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._rows
+
+    def similar(self, user_id: str, k: int) -> List[Tuple[str, float]]:
+        """the k users with the most similar routines
+        Args:
+            user_id: the user, must be in the index
+            k: number of users
+        Return:
+            list of (user_id, cosine distance) by increasing distance
+        """
+        row = self._rows[user_id]
+        nb = min(k + 1, len(self._user_ids))
+        if self._hnsw is not None:
+            self._hnsw.set_ef(max(config.PCB_SIMILARITY_INDEX_HNSW_EF, nb))
+            labels, distances = self._hnsw.knn_query(self._routines[row], k=nb)
+            candidates, distances = labels[0], distances[0]
+        else:
+            all_distances = 1.0 - self._routines @ self._routines[row]
+            candidates = np.argpartition(all_distances, nb - 1)[:nb]
+            candidates = candidates[np.argsort(all_distances[candidates])]
+            distances = all_distances[candidates]
+        return [
+            (self._user_ids[candidate], float(distance))
+            for candidate, distance in zip(candidates, distances)
+            if candidate != row
+        ][:k]
+
+    def save(self, filename: str):
+        """save the index
+
+        The index is written in a temporary file that replaces the file at the end,
+        so the API never loads a half written index
+
+        Args:
+            filename: file in PCB_DATA_FOLDER
+        """
+        location = join(config.PCB_DATA_FOLDER, filename)
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=config.PCB_DATA_FOLDER, prefix=filename, delete=False
+        ) as f:
+            try:
+                pickle.dump(self.__dict__, f)
+            except Exception:
+                f.close()
+                remove(f.name)
+                raise
+        replace(f.name, location)
+
+    @classmethod
+    def load(cls, filename: str) -> SimilarityIndex:
+        """load a previously saved index
+        Args:
+            filename: file in PCB_DATA_FOLDER
+        Return:
+            the index
+        """
+        location = join(config.PCB_DATA_FOLDER, filename)
+        with open(location, "rb") as f:
+            index = cls()
+            index.__dict__ = pickle.load(f)
+            return index
+
+
+def refresh_similarity_indexes(
+    db_indexes: Iterable[int], handler_class: Type[DatabaseProfileHandlerBase]
+):
+    """build again and save the indexes of some models
+
+    Args:
+        db_indexes: database indexes of the models
+        handler_class: class of the database handler
+    """
+    for db_index in db_indexes:
+        handler = handler_class.get_instance(db_index=db_index)
+        index = SimilarityIndex.from_profiles(handler.iter_profiles())
+        index.save(similarity_index_filename(db_index))
+        _LOGGER.info(f"similarity index of DB {db_index:02d} with {len(index)} users")
+
+
+#  db_index -> (modification time of the file, index)
+_LOADED_INDEXES: Dict[int, Tuple[float, SimilarityIndex]] = dict()
+
+
+def get_similarity_index(db_index: int) -> Optional[SimilarityIndex]:
+    """get the saved index of a model, loaded again when the file changes
+
+    Args:
+        db_index: database index of the model
+
+    Return:
+        the index, None if there is no saved index
+    """
+    filename = similarity_index_filename(db_index)
+    location = join(config.PCB_DATA_FOLDER, filename)
+    if not exists(location):
+        return None
+    mtime = getmtime(location)
+    loaded = _LOADED_INDEXES.get(db_index)
+    if loaded is None or loaded[0] != mtime:
+        loaded = (mtime, SimilarityIndex.load(filename))
+        _LOADED_INDEXES[db_index] = loaded
+    return loaded[1]
@@ -0,0 +1,131 @@
+""" module with the stay analysis (stay points, stay regions) of the users, shared in a run
+
+The labels loader and the semantic model both need the stay points of the same users,
+from the same locations. They are computed once per run and kept, keyed by user,
+fingerprint of the locations and the parameters given to regions_builder. The stay
+regions are only shared by calls with the same parameters: the labels loader uses
+distance_threshold_m=50 and the semantic model the defaults, so each computes its own.
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+
+"""
+from typing import Any, Collection, Dict, List, Tuple
+
+from regions_builder.algorithms import estimate_stay_points  # type: ignore
+from regions_builder.algorithms import estimate_stay_regions
+from regions_builder.models import LocationPoint  # type: ignore
+
+from personal_context_builder.wenet_features_cache import fingerprint
+from personal_context_builder.wenet_logger import create_logger
+
+_LOGGER = create_logger(__name__)
+
+#  (kind, fingerprint of the locations, parameters)
+ArtifactKey = Tuple[str, str, Tuple[Tuple[str, Any], ...]]
+
+
+class StayAnalysisStore(object):
+    """Stay points and stay regions of the users, computed once
+
+    One store is used for a run, the artifacts of a user can be discarded when the
+    user is done
+    """
+
+    def __init__(self):
+        self._artifacts: Dict[str, Dict[ArtifactKey, Any]] = dict()
+        self._hits = 0
+        self._misses = 0
+
+    def _get(
+        self,
+        user_id: str,
+        kind: str,
+        locations: List[LocationPoint],
+        parameters: Dict[str, Any],
+        compute,
+    ) -> Any:
+        key = (kind, fingerprint(locations), tuple(sorted(parameters.items())))
+        user_artifacts = self._artifacts.setdefault(user_id, dict())
+        if key in user_artifacts:
+            self._hits += 1
+            _LOGGER.debug(f"{kind} of user {user_id} reused")
+        else:
+            self._misses += 1
+            user_artifacts[key] = compute()
+        return user_artifacts[key]
+
+    def stay_points(
+        self,
+        user_id: str,
+        locations: List[LocationPoint],
+        sort_by_time: bool = False,
+        **parameters,
+    ) -> Collection[Any]:
+        """stay points of a user
+
+        Args:
+            user_id: the user
+            locations: locations of the user
+            sort_by_time: if true, a list sorted by start time, else the stay points
+                          as given by estimate_stay_points
+            parameters: given to estimate_stay_points, the defaults of
+                        regions_builder are used for the missing ones
+
+        Return:
+            the stay points (shared, must not be modified)
+        """
+        stay_points = self._get(
+            user_id,
+            "stay_points",
+            locations,
+            parameters,
+            lambda: estimate_stay_points(locations, **parameters),
+        )
+        if sort_by_time:
+            return self._get(
+                user_id,
+                "sorted_stay_points",
+                locations,
+                parameters,
+                lambda: sorted(stay_points, key=lambda sp: sp._t_start),
+            )
+        return stay_points
+
+    def stay_regions(
+        self,
+        user_id: str,
+        locations: List[LocationPoint],
+        sort_by_time: bool = False,
+        **parameters,
+    ) -> List[Any]:
+        """stay regions of a user, from the stay points with default parameters
+
+        Args:
+            user_id: the user
+            locations: locations of the user
+            sort_by_time: if true, the stay points are given sorted by start time
+                          to estimate_stay_regions
+            parameters: given to estimate_stay_regions, e.g. distance_threshold_m,
+                        the defaults of regions_builder are used for the missing ones
+
+        Return:
+            the stay regions (shared, must not be modified)
+        """
+        return self._get(
+            user_id,
+            "sorted_stay_regions" if sort_by_time else "stay_regions",
+            locations,
+            parameters,
+            lambda: estimate_stay_regions(
+                self.stay_points(user_id, locations, sort_by_time), **parameters
+            ),
+        )
+
+    def discard(self, user_id: str):
+        """forget the artifacts of a user"""
+        self._artifacts.pop(user_id, None)
+
+    def stats(self) -> Tuple[int, int]:
+        """number of artifacts reused and computed"""
+        return self._hits, self._misses
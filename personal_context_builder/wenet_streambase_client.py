@@ -0,0 +1,151 @@
+""" module with the HTTP client used to request StreamBase
+
+One requests.Session is shared by a bounded pool of threads, the requests are
+rate limited per host and retried with an exponential backoff.
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+
+"""
+from __future__ import annotations
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, TypeVar
+from urllib.parse import urlsplit
+
+import requests  # type: ignore
+from requests.adapters import HTTPAdapter  # type: ignore
+from requests.exceptions import RequestException  # type: ignore
+
+from personal_context_builder import config
+from personal_context_builder.wenet_logger import create_logger
+
+_LOGGER = create_logger(__name__)
+
+#  status codes worth a retry, the others are given to the caller
+_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class _RateLimiter(object):
+    """at most rate requests per second, shared by the threads"""
+
+    def __init__(self, rate: float):
+        self._interval = 1.0 / rate if rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        """wait until the next request can be sent"""
+        if self._interval == 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self._interval
+        time.sleep(start - now)
+
+
+class StreamBaseClient(object):
+    """Concurrent HTTP client for StreamBase
+
+    is a Singleton
+    """
+
+    _INSTANCE: Optional[StreamBaseClient] = None
+
+    def __init__(
+        self,
+        max_workers: int = config.PCB_STREAMBASE_MAX_WORKERS,
+        rate_limit: float = config.PCB_STREAMBASE_RATE_LIMIT,
+        max_retry: int = config.PCB_STREAMBASE_MAX_RETRY,
+        backoff_s: float = config.PCB_STREAMBASE_BACKOFF_S,
+        timeout_s: float = config.PCB_STREAMBASE_TIMEOUT_S,
+    ):
+        """Constructor
+        Args:
+            max_workers: number of concurrent requests
+            rate_limit: maximum requests per second to each host, 0 for no limit
+            max_retry: how many times a failed request is sent again
+            backoff_s: wait before the first retry, doubled at each retry
+            timeout_s: timeout of each request
+        """
+        self._max_workers = max_workers
+        self._rate_limit = rate_limit
+        self._max_retry = max_retry
+        self._backoff_s = backoff_s
+        self._timeout_s = timeout_s
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._limiters: Dict[str, _RateLimiter] = dict()
+        self._limiters_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls) -> StreamBaseClient:
+        """get the instance or create if doesn't exist"""
+        if cls._INSTANCE is None:
+            cls._INSTANCE = cls()
+        return cls._INSTANCE
+
+    def _limiter(self, url: str) -> _RateLimiter:
+        host = urlsplit(url).netloc
+        with self._limiters_lock:
+            if host not in self._limiters:
+                self._limiters[host] = _RateLimiter(self._rate_limit)
+            return self._limiters[host]
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """GET with rate limit and retries
+
+        Args:
+            url: the url
+            kwargs: given to requests.Session.get
+
+        Return:
+            the last response, even if its status code is an error
+
+        Raise:
+            RequestException if the last retry raised it
+        """
+        kwargs.setdefault("timeout", self._timeout_s)
+        limiter = self._limiter(url)
+        backoff_s = self._backoff_s
+        for retry in range(self._max_retry + 1):
+            remaining = self._max_retry - retry
+            limiter.wait()
+            try:
+                response = self._session.get(url, **kwargs)
+                if response.status_code not in _RETRY_STATUS_CODES or remaining == 0:
+                    return response
+                response.close()
+                _LOGGER.warn(
+                    f"request to {url} failed with code {response.status_code} - remaining retry {remaining}"
+                )
+            except RequestException as e:
+                if remaining == 0:
+                    raise
+                _LOGGER.warn(
+                    f"request to {url} failed - {e} remaining retry {remaining}"
+                )
+            time.sleep(backoff_s)
+            backoff_s *= 2
+        raise AssertionError("unreachable")  # pragma: no cover
+
+    def map(self, function: Callable[[T], R], items: Iterable[T]) -> List[R]:
+        """call function on all items with the pool of threads
+
+        Args:
+            function: function that does the requests
+            items: arguments of the function
+
+        Return:
+            list of the results, in the order of the items
+        """
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            return list(executor.map(function, items))
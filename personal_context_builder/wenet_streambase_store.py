@@ -0,0 +1,254 @@
+""" module with a local store of the data downloaded from StreamBase
+
+The records of StreamBase (locations, surveys answers) are kept in a SQLite file with,
+for each user and property, the timestamp of the newest record. The next runs only
+request StreamBase from that timestamp and the windows are served from the store.
+
+Copyright (c) 2021 Idiap Research Institute, https://www.idiap.ch/
+Written by William Droz <william.droz@idiap.ch>,
+
+"""
+from __future__ import annotations
+
+import datetime
+import json
+import sqlite3
+import threading
+from os.path import join
+from typing import Callable, Dict, List, Optional
+
+from personal_context_builder import config
+from personal_context_builder.wenet_logger import create_logger
+
+_LOGGER = create_logger(__name__)
+
+
+def streambase_ts_to_datetime(ts: int) -> datetime.datetime:
+    """convert a timestamp of StreamBase to a datetime
+
+    Args:
+        ts: unix timestamp in milliseconds, or YYYYmmddHHMMSS followed by milliseconds
+
+    Return:
+        the (local) datetime
+    """
+    #  // 1000 because their ts is in milisec
+    timestamp = ts // 1000
+    try:
+        return datetime.datetime.fromtimestamp(timestamp)
+    except Exception:
+        #  They dont use unix timestamp...
+        # TODO change me when ppl respect unix timestamp...........
+        _LOGGER.debug(
+            "invalid timestamp format from streambase - will try to use anyway"
+        )
+        return datetime.datetime.strptime(str(timestamp)[:-3], "%Y%m%d%H%M%S")
+
+
+class StreamBaseStore(object):
+    """Records of StreamBase, in a SQLite file
+
+    is a Singleton
+    """
+
+    _INSTANCE: Optional[StreamBaseStore] = None
+
+    def __init__(self, filename: str = config.PCB_STREAMBASE_STORE_FILE):
+        """Constructor
+        Args:
+            filename: SQLite file, in PCB_DATA_FOLDER
+        """
+        self._location = join(config.PCB_DATA_FOLDER, filename)
+        #  the loaders use the store from a pool of threads
+        self._local = threading.local()
+
+    @classmethod
+    def get_instance(cls) -> Optional[StreamBaseStore]:
+        """get the instance or create if doesn't exist
+
+        Return:
+            the store, None if PCB_STREAMBASE_STORE_FILE is empty (disabled)
+        """
+        if config.PCB_STREAMBASE_STORE_FILE == "":
+            return None
+        if cls._INSTANCE is None:
+            cls._INSTANCE = cls()
+        return cls._INSTANCE
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """connection to the SQLite file, one per thread"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._location, timeout=60)
+            with connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS records ("
+                    "user_id TEXT, property TEXT, ts INTEGER, pts_t REAL, "
+                    "record TEXT, PRIMARY KEY (user_id, property, ts))"
+                )
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS high_water_marks ("
+                    "user_id TEXT, property TEXT, pts_t REAL, "
+                    "PRIMARY KEY (user_id, property))"
+                )
+            self._local.connection = connection
+        return connection
+
+    def high_water_mark(
+        self, user_id: str, streambase_property: str
+    ) -> Optional[datetime.datetime]:
+        """date of the newest record of a user
+
+        Args:
+            user_id: the user
+            streambase_property: property of StreamBase, e.g. locationeventpertime
+
+        Return:
+            the date, None if nothing was stored
+        """
+        row = (
+            self._get_connection()
+            .execute(
+                "SELECT pts_t FROM high_water_marks WHERE user_id=? AND property=?",
+                (user_id, streambase_property),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return datetime.datetime.fromtimestamp(row[0])
+
+    def add(self, user_id: str, streambase_property: str, payload: List[Dict]):
+        """add the records of a StreamBase answer, the known records are replaced
+
+        Args:
+            user_id: the user
+            streambase_property: property of StreamBase
+            payload: the JSON answer of StreamBase, nothing is stored if it has no data
+        """
+        if (
+            not isinstance(payload, list)
+            or len(payload) == 0
+            or not isinstance(payload[0], dict)
+            or not isinstance(payload[0].get("data"), dict)
+        ):
+            _LOGGER.debug(f"no data from streambase for user {user_id}")
+            return
+        records = payload[0]["data"].get(streambase_property, [])
+        rows = [
+            (
+                user_id,
+                streambase_property,
+                record["ts"],
+                streambase_ts_to_datetime(record["ts"]).timestamp(),
+                json.dumps(record),
+            )
+            for record in records
+        ]
+        if len(rows) == 0:
+            return
+        connection = self._get_connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)", rows
+            )
+            connection.execute(
+                "INSERT INTO high_water_marks VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id, property) "
+                "DO UPDATE SET pts_t=MAX(pts_t, excluded.pts_t)",
+                (user_id, streambase_property, max(row[3] for row in rows)),
+            )
+
+    def window(
+        self,
+        user_id: str,
+        streambase_property: str,
+        date_from: datetime.datetime,
+        date_to: datetime.datetime,
+    ) -> List[Dict]:
+        """the stored records of a user in a window, as answered by StreamBase
+
+        Args:
+            user_id: the user
+            streambase_property: property of StreamBase
+            date_from: start of the window
+            date_to: end of the window
+
+        Return:
+            the records in the format of StreamBase
+        """
+        records = [
+            json.loads(record)
+            for record, in self._get_connection().execute(
+                "SELECT record FROM records WHERE user_id=? AND property=? "
+                "AND pts_t BETWEEN ? AND ? ORDER BY pts_t",
+                (
+                    user_id,
+                    streambase_property,
+                    date_from.timestamp(),
+                    date_to.timestamp(),
+                ),
+            )
+        ]
+        return [{"data": {streambase_property: records}}]
+
+    def prune(
+        self, user_id: str, streambase_property: str, date_from: datetime.datetime
+    ):
+        """delete the records of a user older than date_from
+
+        Args:
+            user_id: the user
+            streambase_property: property of StreamBase
+            date_from: oldest date to keep
+        """
+        connection = self._get_connection()
+        with connection:
+            connection.execute(
+                "DELETE FROM records WHERE user_id=? AND property=? AND pts_t<?",
+                (user_id, streambase_property, date_from.timestamp()),
+            )
+
+    def sync(
+        self,
+        user_id: str,
+        streambase_property: str,
+        date_from: datetime.datetime,
+        date_to: datetime.datetime,
+        fetch: Callable[[datetime.datetime], Optional[List[Dict]]],
+    ) -> Optional[List[Dict]]:
+        """fetch the new records of a user and give the stored window
+
+        Args:
+            user_id: the user
+            streambase_property: property of StreamBase
+            date_from: start of the window
+            date_to: end of the window
+            fetch: request StreamBase from the given date up to date_to, gives
+                   the JSON answer or None if the request failed
+
+        Return:
+            the records of the window in the format of StreamBase, None if the
+            request failed and nothing was stored
+        """
+        high_water_mark = self.high_water_mark(user_id, streambase_property)
+        fetch_from = date_from
+        if high_water_mark is not None and high_water_mark > date_from:
+            fetch_from = high_water_mark
+        payload = fetch(fetch_from)
+        if payload is not None:
+            self.add(user_id, streambase_property, payload)
+        elif high_water_mark is None:
+            return None
+        else:
+            _LOGGER.warn(f"StreamBase sync failed for user {user_id}, use stored data")
+        self.prune(user_id, streambase_property, date_from)
+        return self.window(user_id, streambase_property, date_from, date_to)
+
+    def clean(self):
+        """delete all the records"""
+        connection = self._get_connection()
+        with connection:
+            connection.execute("DELETE FROM records")
+            connection.execute("DELETE FROM high_water_marks")
@@ -6,19 +6,30 @@ Written by William Droz <william.droz@idiap.ch>,
 """
 from __future__ import annotations
 
-from typing import Any, Optional
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import numpy as np
+from scipy import sparse as scipy_sparse  # type: ignore
 from regions_builder.algorithms import estimate_stay_points  # type: ignore
 from regions_builder.algorithms import estimate_stay_regions, labelize_stay_region
 from regions_builder.data_loading import BaseSourceLabels  # type: ignore
 from regions_builder.data_loading import BaseSourceLocations
+from regions_builder.models import LocationPoint, UserPlace  # type: ignore
 
 from personal_context_builder import config
 from personal_context_builder.wenet_analysis import (
     BagOfWordsCorpuzer,
     BagOfWordsVectorizer,
 )
+from personal_context_builder.wenet_features_cache import (
+    cached_features,
+    stay_parameters,
+)
+from personal_context_builder.wenet_logger import create_logger
+
+_LOGGER = create_logger(__name__)
 
 
 class BaseModelTrainer(object):
@@ -41,32 +52,65 @@ class BaseModelTrainer(object):
         self._bow_trainer = bow_trainer
         self._untrained_model_instance = untrained_model_instance
 
-    def train(self):
+    def train(self, X: Optional[Any] = None):
         """Train to untrained_model_instance using bow_trainer
+        Args:
+            X: already vectorized data, if None bow_trainer is used to compute it
         Return:
             trained instance of the model
         """
-        X = self._bow_trainer.vectorize()
+        if X is None:
+            X = self._bow_trainer.vectorize()
         self._untrained_model_instance.fit(X)
         return self._untrained_model_instance
 
 
+def _estimate_regions(
+    locations: List[LocationPoint], user_places: List[UserPlace]
+) -> Tuple[List[Any], List[Any]]:
+    """estimate the labelled and unlabelled stay regions of a user
+    Args:
+        locations: locations of the user
+        user_places: labels of the user
+    Return:
+        tuple with the labelled stay regions and the unlabelled stay regions
+    """
+    stay_points = estimate_stay_points(locations)
+    stay_regions = estimate_stay_regions(stay_points)
+    labelled_stay_regions = labelize_stay_region(stay_regions, user_places)
+    stay_regions = list(set(stay_regions) - set(labelled_stay_regions))
+    return labelled_stay_regions, stay_regions
+
+
 class BaseBOWTrainer(object):
+    _vectorizer_class: Any = BagOfWordsVectorizer
+
     def __init__(
         self,
         locations_source: BaseSourceLocations,
         labels_source: BaseSourceLabels,
         regions_mapping_file: str = config.PCB_REGION_MAPPING_FILE,
+        workers: int = config.PCB_TRAIN_WORKERS,
+        matrix_file: str = config.PCB_TRAIN_MATRIX_FILE,
+        sparse: bool = False,
     ):
         """Handle the trainer of the Bag-Of-Words
         Args:
             locations_source: source of data of locations
             labels_source: source of data for the labels
             regions_mapping_file: region mapping file to use
+            workers: number of processes used to vectorize the users, 1 to stay
+                     in the current process
+            matrix_file: if not empty, the training matrix is a memory-mapped
+                         .npy file with that name in PCB_DATA_FOLDER
+            sparse: if true, the days are vectorized as sparse CSR matrices
         """
         self._locations_source = locations_source
         self._labels_source = labels_source
         self._regions_mapping_file = regions_mapping_file
+        self._workers = workers
+        self._matrix_file = matrix_file
+        self._sparse = sparse
 
     def train(self, user_id: str) -> BagOfWordsVectorizer:
         """train by using this user_id
@@ -75,77 +119,317 @@ class BaseBOWTrainer(object):
         Return:
             Trained bow vectorizer
         """
-        stay_points = estimate_stay_points(
-            self._locations_source.get_locations(user_id)
+        return self._train_from_data(
+            user_id,
+            self._locations_source.get_locations(user_id),
+            self._labels_source.get_labels(user_id),
+            self._regions_mapping_file,
         )
-        stay_regions = estimate_stay_regions(stay_points)
-        user_places = self._labels_source.get_labels(user_id)
-        labelled_stay_regions = labelize_stay_region(stay_regions, user_places)
-        stay_regions = list(set(stay_regions) - set(labelled_stay_regions))
-        bow_vectorizer = BagOfWordsVectorizer(
-            labelled_stay_regions, stay_regions, self._regions_mapping_file
+
+    @classmethod
+    def _train_from_data(
+        cls,
+        user_id: str,
+        locations: List[LocationPoint],
+        user_places: List[UserPlace],
+        regions_mapping_file: str,
+    ) -> BagOfWordsVectorizer:
+        """train a bow vectorizer from the data of a user
+
+        The stay regions are served from the features cache when the data of the
+        user didn't change
+
+        Args:
+            user_id: the user
+            locations: locations of the user
+            user_places: labels of the user
+            regions_mapping_file: region mapping file to use
+        Return:
+            Trained bow vectorizer
+        """
+        labelled_stay_regions, stay_regions = cls._user_regions(
+            user_id, locations, user_places
+        )
+        return cls._vectorizer_class(
+            labelled_stay_regions, stay_regions, regions_mapping_file
         )
-        return bow_vectorizer
 
-    def vectorize(self) -> Optional[np.ndarray]:
-        """Vectorize the data for all users, for all days
+    @staticmethod
+    def _user_regions(
+        user_id: str, locations: List[LocationPoint], user_places: List[UserPlace]
+    ) -> Tuple[List[Any], List[Any]]:
+        """stay regions of a user, from the features cache when enabled
+        Args:
+            user_id: the user
+            locations: locations of the user
+            user_places: labels of the user
         Return:
-            2D array with data or None if zero data
+            tuple with the labelled stay regions and the unlabelled stay regions
         """
-        data = []
-        cpt = 0
-        for (
+        return cached_features(
             user_id,
+            "bow_stay_regions",
+            lambda: _estimate_regions(locations, user_places),
             locations,
-        ) in self._locations_source.get_locations_all_users().items():
-            bow_vectorizer = self.train(user_id)
-            for day in BagOfWordsVectorizer.group_by_days(locations, user_id):
-                X = bow_vectorizer.vectorize(day)
-                data += X
-                cpt += 1
-        if cpt > 0:
-            return np.array(data).reshape(cpt, -1)
+            user_places,
+            stay_parameters(),
+        )
+
+    def user_regions(
+        self, user_id: str, locations: List[LocationPoint]
+    ) -> Tuple[List[Any], List[Any]]:
+        """estimate the stay regions of a user
+        Args:
+            user_id: the user
+            locations: all the locations of the user
+        Return:
+            tuple with the labelled stay regions and the unlabelled stay regions
+        """
+        return self._user_regions(
+            user_id, locations, self._labels_source.get_labels(user_id)
+        )
+
+    def vectorize_with_regions(
+        self, regions: Tuple[List[Any], List[Any]], locations: List[LocationPoint]
+    ) -> Tuple[np.ndarray, Any]:
+        """vectorize all days of the locations with stay regions already estimated
+
+        Nothing is trained and the days are not put in the features cache, so the
+        locations can be only a part of the ones of the user
+        Args:
+            regions: labelled stay regions and unlabelled stay regions, see user_regions
+            locations: locations to vectorize
+        Return:
+            tuple with the days (datetime64[D] array) and the 2D array (or CSR
+            matrix if sparse) with one row per day
+        """
+        bow_vectorizer = self._vectorizer_class(
+            regions[0], regions[1], self._regions_mapping_file
+        )
+        days, slots = BagOfWordsVectorizer.group_by_days_array(locations)
+        if self._sparse:
+            return days, bow_vectorizer.vectorize_sparse(slots[:, :, 0], slots[:, :, 1])
+        return days, bow_vectorizer.vectorize_array(slots[:, :, 0], slots[:, :, 1])
+
+    def vectorize_user(self, user_id: str, locations: List[LocationPoint]) -> Any:
+        """train by using this user_id, then vectorize all days of the locations
+        Args:
+            user_id: user to use to train
+            locations: locations to vectorize
+        Return:
+            2D array (or CSR matrix if sparse) with one row per day
+        """
+        return self._vectorize_days(
+            user_id, self.train(user_id), locations, self._sparse
+        )
+
+    @staticmethod
+    def _vectorize_days(
+        user_id: str,
+        bow_vectorizer: BagOfWordsVectorizer,
+        locations: List[LocationPoint],
+        sparse: bool,
+    ) -> Any:
+        """vectorize all days of the locations
+        Args:
+            user_id: the user
+            bow_vectorizer: trained bow vectorizer
+            locations: locations to vectorize
+            sparse: if true, give a CSR matrix
+        Return:
+            2D array (or CSR matrix if sparse) with one row per day
+        """
+        _, slots = cached_features(
+            user_id,
+            "days",
+            lambda: BagOfWordsVectorizer.group_by_days_array(locations),
+            locations,
+        )
+        if sparse:
+            return bow_vectorizer.vectorize_sparse(slots[:, :, 0], slots[:, :, 1])
+        return bow_vectorizer.vectorize_array(slots[:, :, 0], slots[:, :, 1])
+
+    @classmethod
+    def _vectorize_user(
+        cls,
+        user_id: str,
+        locations: List[LocationPoint],
+        user_places: List[UserPlace],
+        regions_mapping_file: str,
+        sparse: bool = False,
+    ) -> Any:
+        """vectorize all days of a user, can run in a worker process
+        Args:
+            user_id: the user
+            locations: locations of the user
+            user_places: labels of the user
+            regions_mapping_file: region mapping file to use
+            sparse: if true, give a CSR matrix
+        Return:
+            2D array (or CSR matrix if sparse) with one row per day
+        """
+        bow_vectorizer = cls._train_from_data(
+            user_id, locations, user_places, regions_mapping_file
+        )
+        return cls._vectorize_days(user_id, bow_vectorizer, locations, sparse)
+
+    def _users_vectors(self, users_locations: Dict[str, List]) -> Iterator[Any]:
+        """vectorize the users, in parallel if more than one worker is used
+
+        Args:
+            users_locations: dict user_id -> locations
+        Return:
+            iterator over the vectors of each user, in the order of the users
+        """
+        users = list(users_locations.keys())
+        locations = [users_locations[user_id] for user_id in users]
+        user_places = [self._labels_source.get_labels(user_id) for user_id in users]
+        regions_mapping_files = [self._regions_mapping_file] * len(users)
+        sparse_flags = [self._sparse] * len(users)
+        if self._workers > 1 and len(users) > 1:
+            _LOGGER.info(f"vectorize {len(users)} users with {self._workers} workers")
+            with ProcessPoolExecutor(max_workers=self._workers) as executor:
+                #  map keeps the order of the users, so the matrix is reproducible
+                yield from executor.map(
+                    self._vectorize_user,
+                    users,
+                    locations,
+                    user_places,
+                    regions_mapping_files,
+                    sparse_flags,
+                    chunksize=max(1, len(users) // (4 * self._workers)),
+                )
         else:
+            yield from map(
+                self._vectorize_user,
+                users,
+                locations,
+                user_places,
+                regions_mapping_files,
+                sparse_flags,
+            )
+
+    def vectorize(self) -> Optional[np.ndarray]:
+        """Vectorize the data for all users, for all days
+
+        The number of days is counted first, then each user is written in place in
+        a preallocated uint8 matrix (memory-mapped if a matrix_file is set).
+        In sparse mode, the CSR matrices of the users are stacked instead
+
+        Return:
+            2D array (or CSR matrix if sparse) with data or None if zero data
+        """
+        users_locations = self._locations_source.get_locations_all_users()
+        if self._sparse:
+            data = list(self._users_vectors(users_locations))
+            if sum(X.shape[0] for X in data) == 0:
+                return None
+            return scipy_sparse.vstack(data, format="csr")
+        nb_days = sum(
+            BagOfWordsVectorizer.count_days(locations)
+            for locations in users_locations.values()
+        )
+        if nb_days == 0:
             return None
+        matrix = None
+        row = 0
+        for X in self._users_vectors(users_locations):
+            if matrix is None:
+                matrix = self._allocate_matrix((nb_days, X.shape[1]))
+            matrix[row : row + len(X)] = X
+            row += len(X)
+        return matrix
+
+    def _allocate_matrix(self, shape: Tuple[int, int]) -> np.ndarray:
+        """allocate the training matrix
+        Args:
+            shape: shape of the matrix
+        Return:
+            array of zeros, memory-mapped to matrix_file if set
+        """
+        if self._matrix_file == "":
+            return np.zeros(shape, dtype=np.uint8)
+        location = join(config.PCB_DATA_FOLDER, self._matrix_file)
+        _LOGGER.info(f"training matrix {shape} memory-mapped to {location}")
+        return np.lib.format.open_memmap(
+            location, mode="w+", dtype=np.uint8, shape=shape
+        )
 
 
 class HDPTrainer(BaseBOWTrainer):
+    _vectorizer_class = BagOfWordsCorpuzer
+
     def __init__(
         self,
         locations_source: BaseSourceLocations,
         labels_source: BaseSourceLabels,
         regions_mapping_file: str = config.PCB_REGION_MAPPING_FILE,
+        workers: int = config.PCB_TRAIN_WORKERS,
     ):
         """Handle the trainer of the HDP
         Args:
             locations_source: source of data of locations
             labels_source: source of data for the labels
             regions_mapping_file: region mapping file to use
+            workers: number of processes used to vectorize the users
         """
         super().__init__(
             locations_source,
             labels_source,
             regions_mapping_file=config.PCB_REGION_MAPPING_FILE,
+            workers=workers,
         )
 
-    def train(self, user_id: str) -> BagOfWordsCorpuzer:
-        """train by using this user_id
+    def vectorize_user(self, user_id: str, locations: List[LocationPoint]) -> Any:
+        """train by using this user_id, then vectorize all days as a corpus
         Args:
             user_id: user to use to train
+            locations: locations to vectorize
         Return:
-            Trained bow vectorizer
+            2D array with the "word" lists, one row per day
         """
-        stay_points = estimate_stay_points(
-            self._locations_source.get_locations(user_id)
-        )
-        stay_regions = estimate_stay_regions(stay_points)
-        user_places = self._labels_source.get_labels(user_id)
-        labelled_stay_regions = labelize_stay_region(stay_regions, user_places)
-        stay_regions = list(set(stay_regions) - set(labelled_stay_regions))
-        bow_vectorizer = BagOfWordsCorpuzer(
-            labelled_stay_regions, stay_regions, self._regions_mapping_file
+        days = self._vectorize_days(user_id, self.train(user_id), locations, False)
+        return np.array(days).reshape(len(days), -1)
+
+    def vectorize_with_regions(
+        self, regions: Tuple[List[Any], List[Any]], locations: List[LocationPoint]
+    ) -> Tuple[np.ndarray, Any]:
+        """vectorize all days of the locations as a corpus, with stay regions
+        already estimated
+        Args:
+            regions: labelled stay regions and unlabelled stay regions, see user_regions
+            locations: locations to vectorize
+        Return:
+            tuple with the days (datetime64[D] array) and the 2D array with the
+            "word" lists, one row per day
+        """
+        bow_vectorizer = self._vectorizer_class(
+            regions[0], regions[1], self._regions_mapping_file
         )
-        return bow_vectorizer
+        corpus = self._vectorize_days("", bow_vectorizer, locations, False)
+        days, _ = BagOfWordsVectorizer.group_by_days_array(locations)
+        return days, np.array(corpus).reshape(len(corpus), -1)
+
+    @staticmethod
+    def _vectorize_days(
+        user_id: str,
+        bow_vectorizer: BagOfWordsVectorizer,
+        locations: List[LocationPoint],
+        sparse: bool,
+    ) -> List[List[List[str]]]:
+        """vectorize all days of the locations as a corpus
+        Args:
+            user_id: the user
+            bow_vectorizer: trained bow corpuzer
+            locations: locations to vectorize
+            sparse: not used, a corpus is never sparse
+        Return:
+            for each day, the list of "word" lists
+        """
+        return [
+            bow_vectorizer.vectorize(day)
+            for day in BagOfWordsVectorizer.group_by_days(locations)
+        ]
 
     def vectorize(self) -> Optional[np.ndarray]:
         """Vectorize the data for all users, for all days
@@ -154,13 +438,9 @@ class HDPTrainer(BaseBOWTrainer):
         """
         data = []
         cpt = 0
-        for (
-            user_id,
-            locations,
-        ) in self._locations_source.get_locations_all_users().items():
-            bow_vectorizer = self.train(user_id)
-            for day in BagOfWordsVectorizer.group_by_days(locations, user_id):
-                X = bow_vectorizer.vectorize(day)
+        users_locations = self._locations_source.get_locations_all_users()
+        for days in self._users_vectors(users_locations):
+            for X in days:
                 data += X
                 cpt += 1
         if cpt > 0:
@@ -7,19 +7,109 @@ Written by William Droz <william.droz@idiap.ch>,
 """
 from __future__ import annotations
 
+import asyncio
 import json
+import struct
 from abc import ABC, abstractmethod
 from logging import error
-from typing import Dict, List, Optional
+from typing import (
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+)
 
 import fakeredis  # type: ignore
+import numpy as np
 import redis  # type: ignore
+from redis import asyncio as redis_asyncio  # type: ignore
 
 from personal_context_builder import config
 from personal_context_builder.wenet_logger import create_logger
 
 _LOGGER = create_logger(__name__)
 
+#  binary profiles are a header followed by the little-endian floats,
+#  legacy profiles are JSON lists and can't start with the magic
+_PROFILE_MAGIC = b"PCB"
+_PROFILE_VERSION = 1
+#  magic, version, dtype code, padding to keep the floats aligned
+_PROFILE_HEADER = struct.Struct("<3sBB3x")
+_PROFILE_DTYPES = {
+    "float32": (1, np.dtype("<f4")),
+    "float16": (2, np.dtype("<f2")),
+}
+_PROFILE_DTYPES_BY_CODE = {code: dtype for code, dtype in _PROFILE_DTYPES.values()}
+_PROFILE_ENCODINGS_BY_CODE = {code: name for name, (code, _) in _PROFILE_DTYPES.items()}
+
+#  the fake Redis of the sync and asyncio handlers share the same data, one db per model
+_FAKE_REDIS_SERVER = fakeredis.FakeServer()
+
+
+def encode_profile(
+    vector: Union[List[float], np.ndarray],
+    encoding: str = config.PCB_PROFILE_ENCODING,
+) -> Union[str, bytes]:
+    """encode a profile to be stored in Redis
+
+    Args:
+        vector: the profile
+        encoding: "float32", "float16" or "json" (legacy)
+
+    Return:
+        the encoded profile
+    """
+    if encoding == "json":
+        if isinstance(vector, np.ndarray):
+            vector = vector.tolist()
+        return json.dumps(vector)
+    try:
+        code, dtype = _PROFILE_DTYPES[encoding]
+    except KeyError:
+        raise ValueError(f"unknown profile encoding {encoding}")
+    header = _PROFILE_HEADER.pack(_PROFILE_MAGIC, _PROFILE_VERSION, code)
+    return header + np.asarray(vector, dtype=dtype).tobytes()
+
+
+def profile_encoding(value: bytes) -> str:
+    """encoding of a stored profile
+
+    Args:
+        value: the encoded profile
+
+    Return:
+        "float32", "float16" or "json"
+    """
+    if value[: len(_PROFILE_MAGIC)] != _PROFILE_MAGIC:
+        return "json"
+    _, _, code = _PROFILE_HEADER.unpack_from(value)
+    return _PROFILE_ENCODINGS_BY_CODE[code]
+
+
+def decode_profile(value: bytes) -> np.ndarray:
+    """decode a stored profile, binary or legacy JSON
+
+    Binary profiles are not copied, the array is a read-only view of value
+
+    Args:
+        value: the encoded profile
+
+    Return:
+        the profile as 1D array
+    """
+    if value[: len(_PROFILE_MAGIC)] != _PROFILE_MAGIC:
+        return np.array(json.loads(value), dtype=np.float64)
+    _, version, code = _PROFILE_HEADER.unpack_from(value)
+    if version != _PROFILE_VERSION:
+        raise ValueError(f"unknown profile version {version}")
+    return np.frombuffer(
+        value, dtype=_PROFILE_DTYPES_BY_CODE[code], offset=_PROFILE_HEADER.size
+    )
+
 
 class DatabaseProfileHandlerBase(ABC):
     """Base interface for handling database access for the profiles
@@ -27,7 +117,7 @@ class DatabaseProfileHandlerBase(ABC):
     is a dict of Singleton
     """
 
-    _INSTANCES: Dict[int, DatabaseProfileHandlerBase] = dict()
+    _INSTANCES: Dict[Tuple[str, int], DatabaseProfileHandlerBase] = dict()
 
     def __init__(self, db_index: int = 0):
         pass
@@ -40,9 +130,10 @@ class DatabaseProfileHandlerBase(ABC):
 
         Can be have multiple instance when multiple db_index are used
         """
-        if db_index not in cls._INSTANCES:
-            cls._INSTANCES[db_index] = cls(*args, **kwargs)
-        return cls._INSTANCES[db_index]
+        key = (cls.__name__, db_index)
+        if key not in cls._INSTANCES:
+            cls._INSTANCES[key] = cls(*args, db_index=db_index, **kwargs)
+        return cls._INSTANCES[key]
 
     @abstractmethod
     def clean_db(self):
@@ -64,6 +155,37 @@ class DatabaseProfileHandlerBase(ABC):
             match: expression to use
         """
 
+    @abstractmethod
+    def iter_profiles(
+        self,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> Iterator[Tuple[str, List[float]]]:
+        """iterate over all profiles that match a given expression
+
+        Args:
+            match: expression to use
+            batch_size: number of profiles retrieved at once
+        """
+
+    @abstractmethod
+    def scan_profiles(
+        self,
+        cursor: int = 0,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> Tuple[int, List[Tuple[str, List[float]]]]:
+        """get a batch of profiles from a cursor
+
+        Args:
+            cursor: cursor given by the previous call, 0 to start
+            match: expression to use
+            batch_size: number of profiles to retrieve (approximately)
+
+        Return:
+            tuple with the next cursor (0 when done) and the list of (user_id, vector)
+        """
+
     @abstractmethod
     def get_profile(self, user_id: str):
         """get a given profile
@@ -72,6 +194,16 @@ class DatabaseProfileHandlerBase(ABC):
             user_id: user to retreive
         """
 
+    @abstractmethod
+    def get_profiles(self, user_ids: List[str]) -> Dict[str, Optional[List[float]]]:
+        """get multiple profiles at once
+
+        Args:
+            user_ids: users to retreive
+        Return:
+            dict user_id -> vector, None for the users without profile
+        """
+
     @abstractmethod
     def set_profile(self, user_id: str, vector: List[float]):
         """set profile to a given user_id to vector
@@ -90,6 +222,17 @@ class DatabaseProfileHandlerBase(ABC):
             vectors: list of vectors as values
         """
 
+    @abstractmethod
+    def migrate_profiles(self, encoding: str = config.PCB_PROFILE_ENCODING) -> int:
+        """encode again all the profiles that don't use the given encoding
+
+        Args:
+            encoding: encoding to use
+
+        Return:
+            number of migrated profiles
+        """
+
 
 class DatabaseProfileHandlerMock(DatabaseProfileHandlerBase):
     def __init__(self, db_index: int = 0):
@@ -110,6 +253,27 @@ class DatabaseProfileHandlerMock(DatabaseProfileHandlerBase):
         _LOGGER.info("mock get all profiles")
         return self._my_dict
 
+    def iter_profiles(
+        self,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> Iterator[Tuple[str, List[float]]]:
+        _LOGGER.info("mock iter profiles")
+        yield from list(self._my_dict.items())
+
+    def scan_profiles(
+        self,
+        cursor: int = 0,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> Tuple[int, List[Tuple[str, List[float]]]]:
+        _LOGGER.info(f"mock scan profiles from {cursor}")
+        profiles = list(self._my_dict.items())[cursor : cursor + batch_size]
+        next_cursor = cursor + batch_size
+        if next_cursor >= len(self._my_dict):
+            next_cursor = 0
+        return next_cursor, profiles
+
     def get_profile(self, user_id: str) -> Optional[List[float]]:
         _LOGGER.info(f"mock get profile {user_id}")
         try:
@@ -118,6 +282,10 @@ class DatabaseProfileHandlerMock(DatabaseProfileHandlerBase):
             _LOGGER.warn(f"\tmock unable to get profile {user_id} - doesn't exist")
             return None
 
+    def get_profiles(self, user_ids: List[str]) -> Dict[str, Optional[List[float]]]:
+        _LOGGER.info(f"mock get {len(user_ids)} profiles")
+        return {user_id: self._my_dict.get(user_id) for user_id in user_ids}
+
     def set_profile(self, user_id: str, vector: List[float]):
         _LOGGER.info(f"mock set profile {user_id} with {vector}")
         self._my_dict[user_id] = vector
@@ -126,6 +294,10 @@ class DatabaseProfileHandlerMock(DatabaseProfileHandlerBase):
         for user_id, vector in zip(user_ids, vectors):
             self.set_profile(user_id, vector)
 
+    def migrate_profiles(self, encoding: str = config.PCB_PROFILE_ENCODING) -> int:
+        _LOGGER.info("mock migrate profiles")
+        return 0
+
 
 class DatabaseProfileHandler(DatabaseProfileHandlerBase):
     """Handle database to the redis server
@@ -140,11 +312,13 @@ class DatabaseProfileHandler(DatabaseProfileHandlerBase):
         host: str = config.PCB_REDIS_HOST,
         port: int = config.PCB_REDIS_PORT,
         use_fake: bool = config.PCB_IS_UNITTESTING,
+        encoding: str = config.PCB_PROFILE_ENCODING,
     ):
+        self._encoding = encoding
         if not use_fake:
             self._server = redis.Redis(host=host, port=port, db=db_index)
         else:
-            self._server = fakeredis.FakeServer()
+            self._server = fakeredis.FakeRedis(server=_FAKE_REDIS_SERVER, db=db_index)
         try:
             self._server.ping()
         except:  # TODO catch specific exception
@@ -164,18 +338,71 @@ class DatabaseProfileHandler(DatabaseProfileHandlerBase):
         _LOGGER.info(f"delete profile {user_id}")
         self._server.delete(user_id)
 
-    def get_all_profiles(self, match: Optional[str] = None) -> Dict[str, List[float]]:
+    def get_all_profiles(
+        self,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> Dict[str, List[float]]:
         """get all profiles
         Args:
             match: pattern to retreive the profiles (not regex)
+            batch_size: number of profiles retrieved at once
         Return:
             dict with user_id -> vector
         """
         _LOGGER.info("get all profiles")
-        my_dict = dict()
-        for key in self._server.scan_iter(match=match):
-            my_dict[key.decode("utf-8")] = json.loads(self._server.get(key))
-        return my_dict
+        return dict(self.iter_profiles(match, batch_size))
+
+    def iter_profiles(
+        self,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> Iterator[Tuple[str, List[float]]]:
+        """iterate over all profiles, without keeping them in memory
+
+        Each SCAN batch is retrieved with a single MGET
+
+        Args:
+            match: pattern to retreive the profiles (not regex)
+            batch_size: number of profiles retrieved at once
+        Return:
+            iterator over (user_id, vector)
+        """
+        cursor = 0
+        while True:
+            cursor, profiles = self.scan_profiles(cursor, match, batch_size)
+            yield from profiles
+            if cursor == 0:
+                break
+
+    def scan_profiles(
+        self,
+        cursor: int = 0,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> Tuple[int, List[Tuple[str, List[float]]]]:
+        """one SCAN step, then retrieve the profiles of the keys with MGET
+
+        As with SCAN, a profile can be given more than once during a full iteration
+        and the number of profiles is only about batch_size
+
+        Args:
+            cursor: SCAN cursor, 0 to start
+            match: pattern to retreive the profiles (not regex)
+            batch_size: COUNT hint given to SCAN
+        Return:
+            tuple with the next cursor (0 when done) and the list of (user_id, vector)
+        """
+        cursor, keys = self._server.scan(cursor, match=match, count=batch_size)
+        if len(keys) == 0:
+            return cursor, []
+        profiles = [
+            (key.decode("utf-8"), decode_profile(value).tolist())
+            for key, value in zip(keys, self._server.mget(keys))
+            #  the key can be deleted between SCAN and MGET
+            if value is not None
+        ]
+        return cursor, profiles
 
     def get_profile(self, user_id: str) -> Optional[List[float]]:
         """get a specific profile
@@ -185,10 +412,37 @@ class DatabaseProfileHandler(DatabaseProfileHandlerBase):
             a vector (list of float)
         """
         _LOGGER.info(f"get profile {user_id}")
+        res = self.get_profile_array(user_id)
+        if res is None:
+            return res
+        return res.tolist()
+
+    def get_profile_array(self, user_id: str) -> Optional[np.ndarray]:
+        """get a specific profile, without conversion to a list
+        Args:
+            user_id: user_id of the profile
+        Return:
+            1D array (read-only for binary profiles) or None
+        """
         res = self._server.get(user_id)
         if res is None:
             return res
-        return json.loads(res)
+        return decode_profile(res)
+
+    def get_profiles(self, user_ids: List[str]) -> Dict[str, Optional[List[float]]]:
+        """get multiple profiles with a single MGET
+        Args:
+            user_ids: list of user_id
+        Return:
+            dict user_id -> vector, None for the users without profile
+        """
+        _LOGGER.info(f"get {len(user_ids)} profiles")
+        if len(user_ids) == 0:
+            return dict()
+        return {
+            user_id: None if value is None else decode_profile(value).tolist()
+            for user_id, value in zip(user_ids, self._server.mget(user_ids))
+        }
 
     def set_profile(self, user_id: str, vector: List[float]):
         """create or modify a profile
@@ -196,8 +450,9 @@ class DatabaseProfileHandler(DatabaseProfileHandlerBase):
             user_id: user_id of the profile
             vector: list of float for that profile
         """
-        _LOGGER.info(f"set profile {user_id} with {vector}")
-        value = json.dumps(vector)
+        _LOGGER.info(f"set profile {user_id}")
+        _LOGGER.debug(f"profile {user_id} is {vector}")
+        value = encode_profile(vector, self._encoding)
         self._server.set(user_id, value)
 
     def set_profiles(self, user_ids: List[str], vectors: List[List[float]]):
@@ -209,9 +464,321 @@ class DatabaseProfileHandler(DatabaseProfileHandlerBase):
             user_ids: list of user_id
             vectors: list of vector
         """
-        _LOGGER.info("set profiles in batch")
+        _LOGGER.info(f"set {len(user_ids)} profiles in batch")
         pipeline = self._server.pipeline()
         for user_id, vector in zip(user_ids, vectors):
-            value = json.dumps(vector)
+            value = encode_profile(vector, self._encoding)
             pipeline.set(user_id, value)
         pipeline.execute()
+
+    def migrate_profiles(
+        self,
+        encoding: str = config.PCB_PROFILE_ENCODING,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> int:
+        """encode again all the profiles that don't use the given encoding
+
+        Legacy JSON profiles can be migrated to binary (and back), new profiles
+        are written with the encoding of the handler
+
+        Args:
+            encoding: encoding to use
+            batch_size: number of keys read and written at once
+
+        Return:
+            number of migrated profiles
+        """
+        _LOGGER.info(f"migrate profiles to {encoding}")
+        nb_migrated = 0
+        cursor = 0
+        while True:
+            cursor, keys = self._server.scan(cursor, count=batch_size)
+            if len(keys) > 0:
+                pipeline = self._server.pipeline()
+                for key, value in zip(keys, self._server.mget(keys)):
+                    if value is None or profile_encoding(value) == encoding:
+                        continue
+                    pipeline.set(key, encode_profile(decode_profile(value), encoding))
+                    nb_migrated += 1
+                pipeline.execute()
+            if cursor == 0:
+                break
+        _LOGGER.info(f"{nb_migrated} profiles migrated to {encoding}")
+        return nb_migrated
+
+
+class AsyncDatabaseProfileHandlerBase(ABC):
+    """Base interface for handling database access for the profiles with asyncio
+
+    is a dict of Singleton
+    """
+
+    _INSTANCES: Dict[Tuple[str, int], AsyncDatabaseProfileHandlerBase] = dict()
+
+    def __init__(self, db_index: int = 0):
+        pass
+
+    @classmethod
+    def get_instance(
+        cls, *args, db_index: int = 0, **kwargs
+    ) -> AsyncDatabaseProfileHandlerBase:
+        """get the instance or create if doesn't exist
+
+        Can be have multiple instance when multiple db_index are used
+        """
+        key = (cls.__name__, db_index)
+        if key not in cls._INSTANCES:
+            cls._INSTANCES[key] = cls(*args, db_index=db_index, **kwargs)
+        return cls._INSTANCES[key]
+
+    @abstractmethod
+    async def get_profile(self, user_id: str) -> Optional[List[float]]:
+        """get a given profile
+
+        Args:
+            user_id: user to retreive
+        """
+
+    @abstractmethod
+    async def get_profiles(
+        self, user_ids: List[str]
+    ) -> Dict[str, Optional[List[float]]]:
+        """get multiple profiles at once
+
+        Args:
+            user_ids: users to retreive
+        Return:
+            dict user_id -> vector, None for the users without profile
+        """
+
+    @abstractmethod
+    async def get_all_profiles(
+        self,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> Dict[str, List[float]]:
+        """get all profiles that match a given expression
+
+        Args:
+            match: expression to use
+            batch_size: number of profiles retrieved at once
+        """
+
+    @abstractmethod
+    def iter_profiles(
+        self,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> AsyncIterator[Tuple[str, List[float]]]:
+        """iterate over all profiles that match a given expression
+
+        Args:
+            match: expression to use
+            batch_size: number of profiles retrieved at once
+        """
+
+    @abstractmethod
+    async def scan_profiles(
+        self,
+        cursor: int = 0,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> Tuple[int, List[Tuple[str, List[float]]]]:
+        """get a batch of profiles from a cursor
+
+        Args:
+            cursor: cursor given by the previous call, 0 to start
+            match: expression to use
+            batch_size: number of profiles to retrieve (approximately)
+
+        Return:
+            tuple with the next cursor (0 when done) and the list of (user_id, vector)
+        """
+
+
+class AsyncDatabaseProfileHandlerMock(AsyncDatabaseProfileHandlerBase):
+    """asyncio interface over DatabaseProfileHandlerMock, with the same data"""
+
+    def __init__(self, db_index: int = 0):
+        self._handler = DatabaseProfileHandlerMock.get_instance(db_index=db_index)
+
+    async def get_profile(self, user_id: str) -> Optional[List[float]]:
+        return self._handler.get_profile(user_id)
+
+    async def get_profiles(
+        self, user_ids: List[str]
+    ) -> Dict[str, Optional[List[float]]]:
+        return self._handler.get_profiles(user_ids)
+
+    async def get_all_profiles(
+        self,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> Dict[str, List[float]]:
+        return self._handler.get_all_profiles(match)
+
+    async def iter_profiles(
+        self,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> AsyncIterator[Tuple[str, List[float]]]:
+        for profile in self._handler.iter_profiles(match, batch_size):
+            yield profile
+
+    async def scan_profiles(
+        self,
+        cursor: int = 0,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> Tuple[int, List[Tuple[str, List[float]]]]:
+        return self._handler.scan_profiles(cursor, match, batch_size)
+
+
+class AsyncDatabaseProfileHandler(AsyncDatabaseProfileHandlerBase):
+    """Handle database to the redis server with asyncio
+
+    The connections come from a pool, so the handler can be shared by concurrent
+    requests in the same event loop
+
+    """
+
+    def __init__(
+        self,
+        db_index: int = 0,
+        host: str = config.PCB_REDIS_HOST,
+        port: int = config.PCB_REDIS_PORT,
+        use_fake: bool = config.PCB_IS_UNITTESTING,
+        max_connections: int = config.PCB_REDIS_MAX_CONNECTIONS,
+    ):
+        if not use_fake:
+            self._server = redis_asyncio.Redis(
+                host=host, port=port, db=db_index, max_connections=max_connections
+            )
+        else:
+            from fakeredis import aioredis as fake_aioredis  # type: ignore
+
+            self._server = fake_aioredis.FakeRedis(
+                server=_FAKE_REDIS_SERVER, db=db_index
+            )
+
+    async def get_profile(self, user_id: str) -> Optional[List[float]]:
+        """get a specific profile
+        Args:
+            user_id: user_id of the profile
+        Return:
+            a vector (list of float)
+        """
+        _LOGGER.info(f"get profile {user_id}")
+        res = await self._server.get(user_id)
+        if res is None:
+            return res
+        return decode_profile(res).tolist()
+
+    async def get_profiles(
+        self, user_ids: List[str]
+    ) -> Dict[str, Optional[List[float]]]:
+        """get multiple profiles with a single MGET
+        Args:
+            user_ids: list of user_id
+        Return:
+            dict user_id -> vector, None for the users without profile
+        """
+        _LOGGER.info(f"get {len(user_ids)} profiles")
+        if len(user_ids) == 0:
+            return dict()
+        values = await self._server.mget(user_ids)
+        return {
+            user_id: None if value is None else decode_profile(value).tolist()
+            for user_id, value in zip(user_ids, values)
+        }
+
+    async def get_all_profiles(
+        self,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> Dict[str, List[float]]:
+        """get all profiles
+        Args:
+            match: pattern to retreive the profiles (not regex)
+            batch_size: number of profiles retrieved at once
+        Return:
+            dict with user_id -> vector
+        """
+        _LOGGER.info("get all profiles")
+        return {
+            user_id: vector
+            async for user_id, vector in self.iter_profiles(match, batch_size)
+        }
+
+    async def iter_profiles(
+        self,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> AsyncIterator[Tuple[str, List[float]]]:
+        """iterate over all profiles, without keeping them in memory
+        Args:
+            match: pattern to retreive the profiles (not regex)
+            batch_size: number of profiles retrieved at once
+        Return:
+            iterator over (user_id, vector)
+        """
+        cursor = 0
+        while True:
+            cursor, profiles = await self.scan_profiles(cursor, match, batch_size)
+            for profile in profiles:
+                yield profile
+            if cursor == 0:
+                break
+
+    async def scan_profiles(
+        self,
+        cursor: int = 0,
+        match: Optional[str] = None,
+        batch_size: int = config.PCB_PROFILES_BATCH_SIZE,
+    ) -> Tuple[int, List[Tuple[str, List[float]]]]:
+        """one SCAN step, then retrieve the profiles of the keys with MGET
+        Args:
+            cursor: SCAN cursor, 0 to start
+            match: pattern to retreive the profiles (not regex)
+            batch_size: COUNT hint given to SCAN
+        Return:
+            tuple with the next cursor (0 when done) and the list of (user_id, vector)
+        """
+        cursor, keys = await self._server.scan(cursor, match=match, count=batch_size)
+        if len(keys) == 0:
+            return cursor, []
+        values = await self._server.mget(keys)
+        profiles = [
+            (key.decode("utf-8"), decode_profile(value).tolist())
+            for key, value in zip(keys, values)
+            #  the key can be deleted between SCAN and MGET
+            if value is not None
+        ]
+        return cursor, profiles
+
+
+async def get_routines(
+    user_ids: List[str],
+    db_dict: Dict[int, str],
+    handler_class: Type[AsyncDatabaseProfileHandlerBase] = AsyncDatabaseProfileHandler,
+) -> Dict[str, Dict[str, Optional[List[float]]]]:
+    """get the profiles of many users for many models at once
+
+    There is a single MGET per database and the databases are queried concurrently
+
+    Args:
+        user_ids: users to retreive
+        db_dict: dict db_index -> model name
+        handler_class: class of the database handler
+
+    Return:
+        dict model name -> user_id -> vector (None if the user has no profile)
+    """
+    db_items = list(db_dict.items())
+    results = await asyncio.gather(
+        *[
+            handler_class.get_instance(db_index=db_index).get_profiles(user_ids)
+            for db_index, _ in db_items
+        ]
+    )
+    return {model_name: res for (_, model_name), res in zip(db_items, results)}